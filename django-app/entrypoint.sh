@@ -9,6 +9,15 @@ echo "Database is available"
 
 echo "Running migrations..."
 python manage.py migrate --noinput
+python manage.py createcachetable
+
+# Create the coming months' partitions of the sales tables if enabled. Converting
+# existing tables is a one-off task (partition_sales --convert), not run on start.
+case "${SALES_PARTITIONING,,}" in
+  true|on|yes|1)
+    python manage.py partition_sales
+    ;;
+esac
 
 echo "Creating initial data..."
 python manage.py create_initial_data
@@ -28,6 +37,14 @@ else:
     user.save()
 END
 
+# Start the write-behind sale queue worker if enabled
+case "${SALES_WRITE_BEHIND,,}" in
+  true|on|yes|1)
+    echo "Starting sale queue worker..."
+    python manage.py process_sale_queue &
+    ;;
+esac
+
 # Start uWSGI in background
 echo "Starting uWSGI..."
 uwsgi --ini /app/uwsgi.ini &
@@ -9,7 +9,7 @@ def get_database_config():
     Falls back to SQLite for local development if environment variables are not set.
     """
     if os.environ.get('DATABASE_HOST'):
-        return {
+        databases = {
             'default': {
                 'ENGINE': 'django.db.backends.postgresql',
                 'NAME': env('DATABASE_NAME'),
@@ -24,6 +24,31 @@ def get_database_config():
                 }
             }
         }
+        if env.bool('DATABASE_POOL', default=False):
+            # Connections go back to a bounded pool per process after every
+            # request; see product_management.postgresql_pool
+            transaction_mode = env.bool('DATABASE_POOL_TRANSACTION_MODE', default=False)
+            databases['default'].update({
+                'ENGINE': 'product_management.postgresql_pool',
+                'CONN_MAX_AGE': 0,
+                'DISABLE_SERVER_SIDE_CURSORS': transaction_mode,
+                'POOL': {
+                    'MAX_SIZE': env.int('DATABASE_POOL_MAX_SIZE', default=4),
+                    'TIMEOUT': env.float('DATABASE_POOL_TIMEOUT', default=10),
+                    'MAX_LIFETIME': env.int('DATABASE_POOL_MAX_LIFETIME', default=1800),
+                    'MAX_IDLE': env.int('DATABASE_POOL_MAX_IDLE', default=300),
+                    'TRANSACTION_MODE': transaction_mode,
+                },
+            })
+        # Read replicas of the same database; see products.routing
+        for number, host in enumerate(env.list('DATABASE_REPLICA_HOSTS', default=[]), start=1):
+            databases[f'replica{number}'] = {
+                **databases['default'],
+                'HOST': host,
+                'ATOMIC_REQUESTS': False,
+                'TEST': {'MIRROR': 'default'},
+            }
+        return databases
     
     # Fallback to SQLite for local development
     BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
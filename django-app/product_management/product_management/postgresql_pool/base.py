@@ -0,0 +1,267 @@
+"""
+PostgreSQL backend that borrows connections from a bounded pool per process.
+
+Enabled by DATABASE_POOL (see product_management.database). Django closes
+its connection at the end of every request (CONN_MAX_AGE 0); here that
+returns it to the alias's pool and the next request borrows it, so a uWSGI
+process holds at most MAX_SIZE connections per alias whatever its thread
+count, and TLS and authentication are only paid when the pool grows or
+recycles a connection.
+
+A connection that sat idle for more than CHECK_AFTER seconds is checked
+with ``SELECT 1`` when borrowed and replaced if dead. Connections older than
+MAX_LIFETIME or idle for more than MAX_IDLE are closed instead of reused.
+When all MAX_SIZE are borrowed, a thread waits up to TIMEOUT seconds and
+then gets PoolTimeout, an OperationalError. Pool.stats() counts borrows,
+waits, timeouts and connections in use.
+
+TRANSACTION_MODE is for a transaction pooler (PgBouncer, RDS Proxy) between
+the processes and the database, where consecutive transactions may run on
+different server sessions: nothing is set on the session, so the database's
+default time zone must be UTC (connections fail otherwise) and ``assume_role``
+is refused, and Django's server-side cursors are disabled. psycopg2 never
+prepares statements on the server.
+"""
+import os
+import threading
+import time
+from functools import partial
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.postgresql import base
+from psycopg2 import extensions
+
+Database = base.Database
+
+DEFAULTS = {
+    'MAX_SIZE': 4,
+    'TIMEOUT': 10,
+    'MAX_LIFETIME': 1800,
+    'MAX_IDLE': 300,
+    'CHECK_AFTER': 1,
+    'TRANSACTION_MODE': False,
+}
+
+# Names PostgreSQL may report for the UTC time zone
+UTC_NAMES = {'UTC', 'Etc/UTC', 'UCT', 'Etc/UCT', 'Universal', 'Etc/Universal', 'Zulu', 'Etc/Zulu'}
+
+class PoolTimeout(Database.OperationalError):
+    pass
+
+class Pool:
+    """Up to ``max_size`` connections shared by the threads of one process."""
+
+    def __init__(self, max_size, timeout, max_lifetime, max_idle, check_after, transaction_mode=False):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.transaction_mode = transaction_mode
+        self.pid = os.getpid()
+        self._condition = threading.Condition()
+        # (connection, returned at), most recently returned last
+        self._idle = []
+        # Opening time of every open connection, idle or borrowed
+        self._opened = {}
+        self._connecting = 0
+        self._counts = dict.fromkeys((
+            'borrows', 'connects', 'waits', 'timeouts', 'failed_checks', 'recycled', 'discarded',
+        ), 0)
+        self._wait_time = 0.0
+        self._peak_in_use = 0
+
+    @classmethod
+    def from_settings(cls, settings_dict):
+        options = {**DEFAULTS, **settings_dict.get('POOL', {})}
+        return cls(**{name.lower(): value for name, value in options.items()})
+
+    def _size(self):
+        return len(self._opened) + self._connecting
+
+    def _expired(self, connection, returned, now):
+        return (now - self._opened[connection] >= self.max_lifetime
+                or now - returned >= self.max_idle)
+
+    def _take(self, closing):
+        """
+        An idle connection and how long it sat idle, or None when this thread
+        may open a new one; waits while the pool is full. Called with the lock
+        held; expired connections are appended to ``closing``.
+        """
+        deadline = None
+        while True:
+            now = time.monotonic()
+            while self._idle:
+                connection, returned = self._idle.pop()
+                if self._expired(connection, returned, now):
+                    del self._opened[connection]
+                    self._counts['recycled'] += 1
+                    closing.append(connection)
+                    continue
+                return connection, now - returned
+            if self._size() < self.max_size:
+                self._connecting += 1
+                return None, 0
+            if deadline is None:
+                self._counts['waits'] += 1
+                deadline = now + self.timeout
+            if now >= deadline:
+                self._counts['timeouts'] += 1
+                raise PoolTimeout(
+                    f'No database connection free after {self.timeout}s; '
+                    f'all {self.max_size} of this process are in use')
+            started = now
+            self._condition.wait(deadline - now)
+            self._wait_time += time.monotonic() - started
+
+    def borrow(self, connect):
+        """A pooled connection, or a new one from ``connect()`` while the pool has room."""
+        while True:
+            closing = []
+            try:
+                with self._condition:
+                    connection, idle = self._take(closing)
+            finally:
+                for old in closing:
+                    _close(old)
+
+            if connection is None:
+                try:
+                    connection = connect()
+                except BaseException:
+                    with self._condition:
+                        self._connecting -= 1
+                        self._condition.notify()
+                    raise
+                with self._condition:
+                    self._connecting -= 1
+                    self._opened[connection] = time.monotonic()
+                    self._counts['connects'] += 1
+            elif idle > self.check_after and not _is_alive(connection):
+                with self._condition:
+                    del self._opened[connection]
+                    self._counts['failed_checks'] += 1
+                    self._condition.notify()
+                _close(connection)
+                continue
+
+            with self._condition:
+                self._counts['borrows'] += 1
+                self._peak_in_use = max(self._peak_in_use, len(self._opened) - len(self._idle))
+            return connection
+
+    def give_back(self, connection):
+        """Return a borrowed connection, or close it if it is broken or too old."""
+        status = connection.info.transaction_status if not connection.closed else None
+        if status in (extensions.TRANSACTION_STATUS_INTRANS, extensions.TRANSACTION_STATUS_INERROR):
+            try:
+                connection.rollback()
+                status = connection.info.transaction_status
+            except Database.Error:
+                status = None
+        now = time.monotonic()
+        with self._condition:
+            if status != extensions.TRANSACTION_STATUS_IDLE:
+                self._counts['discarded'] += 1
+            elif now - self._opened[connection] >= self.max_lifetime:
+                self._counts['recycled'] += 1
+            else:
+                self._idle.append((connection, now))
+                self._condition.notify()
+                return
+            del self._opened[connection]
+            self._condition.notify()
+        _close(connection)
+
+    def close_idle(self):
+        """Close the idle connections."""
+        with self._condition:
+            idle, self._idle = self._idle, []
+            for connection, returned in idle:
+                del self._opened[connection]
+        for connection, returned in idle:
+            _close(connection)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'max_size': self.max_size,
+                'size': self._size(),
+                'in_use': len(self._opened) - len(self._idle),
+                'idle': len(self._idle),
+                'peak_in_use': self._peak_in_use,
+                **self._counts,
+                'wait_seconds': round(self._wait_time, 3),
+                'transaction_mode': self.transaction_mode,
+            }
+
+def _is_alive(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        if not connection.autocommit:
+            connection.rollback()
+        return True
+    except Database.Error:
+        return False
+
+def _close(connection):
+    try:
+        connection.close()
+    except Database.Error:
+        pass
+
+_pools = {}
+_pools_lock = threading.Lock()
+# Pools inherited over a fork; their sockets belong to the parent, so they are
+# kept open rather than closed (closing would end the parent's sessions)
+_inherited = []
+
+def get_pool(alias, settings_dict):
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is not None and pool.pid != os.getpid():
+            _inherited.append(pool)
+            pool = None
+        if pool is None:
+            pool = _pools[alias] = Pool.from_settings(settings_dict)
+        return pool
+
+def pools():
+    """``{alias: Pool}`` of this process."""
+    with _pools_lock:
+        return {alias: pool for alias, pool in _pools.items() if pool.pid == os.getpid()}
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.settings_dict)
+
+    def get_new_connection(self, conn_params):
+        connection = self.pool.borrow(partial(super().get_new_connection, conn_params))
+        # Set by the parent on connect, also needed when the connection is reused
+        self.isolation_level = base.IsolationLevel(
+            self.settings_dict['OPTIONS'].get('isolation_level', base.IsolationLevel.READ_COMMITTED))
+        return connection
+
+    def ensure_timezone(self):
+        if not self.pool.transaction_mode or self.connection is None:
+            return super().ensure_timezone()
+        server_timezone = self.connection.info.parameter_status('TimeZone')
+        if self.timezone_name and server_timezone != self.timezone_name and not (
+                {server_timezone, self.timezone_name} <= UTC_NAMES):
+            raise ImproperlyConfigured(
+                f"The database's time zone is {server_timezone}, not {self.timezone_name}; in "
+                f"transaction mode it is not set per session. Run ALTER DATABASE ... SET timezone "
+                f"TO '{self.timezone_name}'.")
+        return False
+
+    def ensure_role(self):
+        if self.pool.transaction_mode and self.settings_dict['OPTIONS'].get('assume_role'):
+            raise ImproperlyConfigured('assume_role sets session state; it cannot be used in transaction mode')
+        return super().ensure_role()
+
+    def _close(self):
+        if self.connection is not None:
+            self.pool.give_back(self.connection)
@@ -1,3 +1,4 @@
+import importlib.util
 import os
 import environ
 
@@ -32,6 +33,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'products.routing.ReplicaMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -40,6 +42,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'products.transactions.SafeRequestTransactionMiddleware',
 ]
 
 ROOT_URLCONF = 'product_management.urls'
@@ -66,6 +69,72 @@ from .database import get_database_config
 
 DATABASES = get_database_config()
 
+# Transaction of GET, HEAD and OPTIONS requests: autocommit, read_only or
+# atomic (see products.transactions); other requests keep ATOMIC_REQUESTS
+SAFE_REQUEST_TRANSACTION = env('SAFE_REQUEST_TRANSACTION', default='autocommit')
+# Isolation level of read_only request transactions
+SAFE_REQUEST_ISOLATION = env('SAFE_REQUEST_ISOLATION', default='repeatable read')
+
+# Safe requests read from the replicas in DATABASE_REPLICA_HOSTS, if any
+DATABASE_ROUTERS = ['products.routing.ReplicaRouter']
+# Seconds a client keeps reading from the primary after a write, and data
+# written this recently is read from the primary; above the replicas' usual lag
+DATABASE_REPLICA_LAG = env.int('DATABASE_REPLICA_LAG', default=5)
+
+# Local memory by default. Point CACHE_URL at a shared backend
+# (e.g. rediscache://host:6379/1 or dbcache://django_cache) so that
+# all uWSGI processes and tasks share one warm cache.
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+# The dashboard and dashboard_stats figures, cached under the version counters
+# (products.caching). A per-process cache would keep serving figures another
+# process's writes have changed, so this also needs a shared cache.
+DASHBOARD_CACHE = env.bool(
+    'DASHBOARD_CACHE',
+    default=CACHES['default']['BACKEND'] != 'django.core.cache.backends.locmem.LocMemCache'
+)
+DASHBOARD_CACHE_TIMEOUT = env.int('DASHBOARD_CACHE_TIMEOUT', default=300)
+
+# ETag/Last-Modified on the API and list pages. The validators come from
+# version counters in the cache, so they need a cache shared by all processes.
+CONDITIONAL_GET = env.bool(
+    'CONDITIONAL_GET',
+    default=CACHES['default']['BACKEND'] != 'django.core.cache.backends.locmem.LocMemCache'
+)
+
+# Results of querysets marked cached() (products.querycache), kept in a
+# per-process LRU of QUERYSET_CACHE_LRU_BYTES and in the default cache.
+# Invalidation goes through the same version counters, so it also needs a
+# shared cache.
+QUERYSET_CACHE = env.bool(
+    'QUERYSET_CACHE',
+    default=CACHES['default']['BACKEND'] != 'django.core.cache.backends.locmem.LocMemCache'
+)
+QUERYSET_CACHE_TIMEOUT = env.int('QUERYSET_CACHE_TIMEOUT', default=300)
+QUERYSET_CACHE_LRU_BYTES = env.int('QUERYSET_CACHE_LRU_BYTES', default=32 * 1024 * 1024)
+
+# Counters per Space-Saving best-seller summary (error bound: total / capacity)
+BEST_SELLERS_CAPACITY = env.int('BEST_SELLERS_CAPACITY', default=100)
+# Seconds a process buffers committed sales before adding them to the summaries
+# in one locked update (0: one update per sale)
+BEST_SELLERS_FLUSH_INTERVAL = env.float('BEST_SELLERS_FLUSH_INTERVAL', default=1.0)
+
+# Rows per response of the /export/ endpoints; keep one response well inside uWSGI's harakiri
+EXPORT_MAX_ROWS = env.int('EXPORT_MAX_ROWS', default=500_000)
+
+# Rows per model above which the in-process typeahead index (products.autocomplete)
+# is not built; each worker holds its own copy, about 600 bytes per row
+AUTOCOMPLETE_MAX_ENTRIES = env.int('AUTOCOMPLETE_MAX_ENTRIES', default=100_000)
+
+# Queue POST /api/sales/ for process_sale_queue instead of writing sales in the request
+SALES_WRITE_BEHIND = env.bool('SALES_WRITE_BEHIND', default=False)
+
+# Partition the sales tables by month on PostgreSQL (see products.partitioning);
+# read by migration 0010, or convert later with partition_sales --convert
+SALES_PARTITIONING = env.bool('SALES_PARTITIONING', default=False)
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -93,9 +162,26 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# orjson-backed JSON (falling back to DRF's encoder without orjson), plus
+# MessagePack for clients that ask for it when msgpack is installed
+API_RENDERER_CLASSES = [
+    'products.renderers.FastJSONRenderer',
+    'rest_framework.renderers.BrowsableAPIRenderer',
+]
+API_PARSER_CLASSES = [
+    'products.parsers.FastJSONParser',
+    'rest_framework.parsers.FormParser',
+    'rest_framework.parsers.MultiPartParser',
+]
+if importlib.util.find_spec('msgpack'):
+    API_RENDERER_CLASSES.append('products.renderers.MessagePackRenderer')
+    API_PARSER_CLASSES.append('products.parsers.MessagePackParser')
+
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'products.pagination.KeysetPagination',
+    'DEFAULT_RENDERER_CLASSES': API_RENDERER_CLASSES,
+    'DEFAULT_PARSER_CLASSES': API_PARSER_CLASSES,
     'PAGE_SIZE': 10
 }
 
@@ -115,7 +201,8 @@ LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/login/'
 
 # Message Settings
-MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
+# Signed cookie, falling back to the session for messages too large for it
+MESSAGE_STORAGE = 'django.contrib.messages.storage.fallback.FallbackStorage'
 
 # File Upload Settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB
@@ -133,7 +220,13 @@ CSRF_COOKIE_NAME = 'csrftoken'
 SESSION_COOKIE_SECURE = True
 SESSION_COOKIE_HTTPONLY = True
 SESSION_COOKIE_SAMESITE = 'Strict'
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+# Database sessions, cached per process and rarely written (see products.sessions)
+SESSION_ENGINE = 'products.sessions'
+# Sessions each process keeps in memory, and for how many seconds
+SESSION_CACHE_SIZE = env.int('SESSION_CACHE_SIZE', default=10_000)
+SESSION_CACHE_TTL = env.int('SESSION_CACHE_TTL', default=10)
+# Seconds a session in use may lag behind SESSION_COOKIE_AGE before its expiry is pushed back
+SESSION_TOUCH_INTERVAL = env.int('SESSION_TOUCH_INTERVAL', default=3600)
 
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 USE_X_FORWARDED_HOST = True
@@ -0,0 +1,17 @@
+"""
+Settings for the tests with a read replica:
+
+    python manage.py test --settings=product_management.test_settings
+
+``replica1`` is a test mirror of ``default``, so reads routed to it see
+the data the tests write, and the routing tests can check which alias each
+request read from. See products.routing.
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES
+
+DATABASES['replica1'] = {
+    **DATABASES['default'],
+    'ATOMIC_REQUESTS': False,
+    'TEST': {'MIRROR': 'default'},
+}
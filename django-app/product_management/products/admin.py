@@ -1,34 +1,56 @@
 from django.contrib import admin
+from . import autocomplete
 from .models import Category, Product, Customer, Sale, SaleItem
 
+class TypeaheadSearchMixin:
+    """Answer the autocomplete widgets pointing at this model from the typeahead index."""
+    typeahead = None
+
+    def get_search_results(self, request, queryset, search_term):
+        match = request.resolver_match
+        if search_term and match and match.url_name == 'autocomplete':
+            matches = autocomplete.INDEXES[self.typeahead].lookup(search_term, autocomplete.MAX_LIMIT)
+            return queryset.filter(pk__in=[row['id'] for row in matches]), False
+        return super().get_search_results(request, queryset, search_term)
+
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
-    list_display = ('name', 'created_at', 'updated_at')
+    list_display = ('name', 'products_count', 'created_at', 'updated_at')
     search_fields = ('name',)
+    readonly_fields = ('products_count',)
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'category', 'price', 'stock', 'created_at')
+class ProductAdmin(TypeaheadSearchMixin, admin.ModelAdmin):
+    typeahead = 'product'
+    list_display = ('name', 'category', 'price', 'available_stock', 'total_units_sold', 'created_at')
     list_filter = ('category',)
     search_fields = ('name', 'description')
-    readonly_fields = ('created_at', 'updated_at')
+    readonly_fields = ('stock_shard_count', 'total_units_sold', 'total_revenue', 'created_at', 'updated_at')
+    exclude = ('units_sold', 'revenue')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_stock()
 
 @admin.register(Customer)
-class CustomerAdmin(admin.ModelAdmin):
-    list_display = ('name', 'email', 'phone', 'created_at')
+class CustomerAdmin(TypeaheadSearchMixin, admin.ModelAdmin):
+    typeahead = 'customer'
+    list_display = ('name', 'email', 'phone', 'total_purchases', 'total_spent', 'created_at')
+    ordering = ('name',)
     search_fields = ('name', 'email', 'phone')
-    readonly_fields = ('created_at', 'updated_at')
+    readonly_fields = ('total_purchases', 'total_spent', 'created_at', 'updated_at')
 
 class SaleItemInline(admin.TabularInline):
     model = SaleItem
     extra = 1
     readonly_fields = ('total_price',)
+    autocomplete_fields = ('product',)
 
 @admin.register(Sale)
 class SaleAdmin(admin.ModelAdmin):
     list_display = ('id', 'customer', 'sale_date', 'total_amount', 'status')
     list_filter = ('status', 'sale_date')
     search_fields = ('customer__name',)
+    autocomplete_fields = ('customer',)
     readonly_fields = ('created_at', 'updated_at')
     inlines = [SaleItemInline]
 
@@ -37,3 +59,4 @@ class SaleItemAdmin(admin.ModelAdmin):
     list_display = ('sale', 'product', 'quantity', 'unit_price', 'total_price')
     list_filter = ('sale', 'product')
     readonly_fields = ('total_price',)
+    autocomplete_fields = ('product',)
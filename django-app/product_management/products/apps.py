@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 class ProductsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
@@ -9,5 +10,17 @@ class ProductsConfig(AppConfig):
         """
         Import signal handlers when the app is ready
         """
-        # Import signal handlers here if needed in the future
-        pass
+        from . import signals  # noqa: F401
+        post_migrate.connect(install_search_indexes, sender=self)
+
+def install_search_indexes(using, **kwargs):
+    """Restore search indexes dropped when a migration rebuilt their table."""
+    from django.db import connections
+    from django.db.migrations.recorder import MigrationRecorder
+    from . import search
+    from .models import Customer, Product
+
+    connection = connections[using]
+    if ('products', '0006_search_indexes') in MigrationRecorder(connection).applied_migrations():
+        with connection.schema_editor() as schema_editor:
+            search.install([Product, Customer], schema_editor)
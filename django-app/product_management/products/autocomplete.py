@@ -0,0 +1,307 @@
+"""
+In-process typeahead for product and customer names.
+
+Each uWSGI worker keeps one index per model in memory, built in the
+background after the first lookup. Names are folded (NFKC, case, katakana to hiragana, so 'ﾜｲﾔﾚｽ' and
+'わいやれす' both find 'ワイヤレス') and indexed twice, customers' together
+with their email:
+
+- a sorted list of their words, for prefix lookup; Japanese names without
+  spaces are a single word, so this is a prefix of the whole name;
+- the slots of the names containing each character bigram (and ASCII
+  trigram), for substring lookup, which covers Japanese text without a
+  tokenizer.
+
+A lookup examines at most PREFIX_SCAN_LIMIT names from the first and
+SUBSTRING_SCAN_LIMIT from the rarest n-gram of the query, so it takes well
+under a millisecond whatever the size of the catalog, and returns the best
+of them: names starting with the query, then names with a word starting
+with it, then names merely containing it (every word of the query must
+occur), shorter names first. Single-character queries only use the prefix
+list.
+
+The index does not query the database to answer. At most every
+REFRESH_INTERVAL seconds it compares the model's version counter
+(products.caching) with the one it was built against and, when it moved,
+reads the rows whose ``updated_at`` is past the latest one seen, less
+OVERLAP for transactions that committed late. Deleted rows leave no trace
+there, so every RECONCILE_INTERVAL seconds a refresh also counts the rows
+and drops the ids that are gone when the count disagrees. With the
+per-process ``locmemcache://`` a worker does not see the others' counters
+and relies on MAX_AGE instead. Updates through ``QuerySet.update()`` do not
+set ``updated_at`` and are not picked up until the index is rebuilt.
+
+Memory grows with the number of rows, so a model with more than
+AUTOCOMPLETE_MAX_ENTRIES rows is not indexed and lookups fall back to
+products.search. stats() reports each index's size in this worker.
+"""
+import bisect
+import heapq
+import re
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+
+from . import caching, search
+from .models import Customer, Product
+
+REFRESH_INTERVAL = 1
+RECONCILE_INTERVAL = 15
+MAX_AGE = 60
+OVERLAP = timedelta(minutes=1)
+PREFIX_SCAN_LIMIT = 200
+SUBSTRING_SCAN_LIMIT = 1000
+MAX_LIMIT = 50
+
+_hiragana = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+_word = re.compile(r'\w+')
+
+def normalize(text):
+    """``text`` folded for matching: NFKC, case folded, katakana as hiragana."""
+    return ' '.join(unicodedata.normalize('NFKC', text).casefold().translate(_hiragana).split())
+
+def ngrams(text):
+    """Bigrams of ``text``, plus its ASCII trigrams, as ASCII bigrams are too common to narrow much."""
+    grams = {text[i:i + 2] for i in range(len(text) - 1)}
+    trigrams = {text[i:i + 3] for i in range(len(text) - 2)}
+    grams.update(trigrams if text.isascii() else [gram for gram in trigrams if gram.isascii()])
+    return grams
+
+class TypeaheadIndex:
+    """Typeahead over the names of one model, for this process."""
+
+    def __init__(self, model, fields=('name',)):
+        self.model = model
+        # Indexed together and returned with each match
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.built = self.too_large = False
+        self.version = self.watermark = None
+        self.checked_at = self.refreshed_at = self.reconciled_at = 0.0
+        self._clear()
+
+    def _clear(self):
+        self.rows = []              # slot -> (pk, *fields), None once replaced or deleted
+        self.keys = []              # slot -> normalized name
+        self.slots = {}             # pk -> slot
+        self.grams = {}             # bigram or trigram -> slots of the names containing it
+        self.words = []             # sorted words of the names
+        self.word_slots = array('I')
+        self.dead = 0
+
+    def _add(self, row):
+        """Index ``row`` except for its words; return them as (word, slot) pairs."""
+        slot = len(self.rows)
+        key = normalize(' '.join(row[1:]))
+        self.rows.append(row)
+        self.keys.append(key)
+        self.slots[row[0]] = slot
+        for gram in ngrams(key):
+            postings = self.grams.get(gram)
+            if postings is None:
+                postings = self.grams[gram] = array('I')
+            postings.append(slot)
+        return [(sys.intern(word), slot) for word in set(_word.findall(key))]
+
+    def _add_words(self, pairs):
+        if len(pairs) > 100:
+            pairs = sorted([*zip(self.words, self.word_slots), *pairs])
+            self.words = [word for word, _ in pairs]
+            self.word_slots = array('I', [slot for _, slot in pairs])
+            return
+        for word, slot in pairs:
+            index = bisect.bisect(self.words, word)
+            self.words.insert(index, word)
+            self.word_slots.insert(index, slot)
+
+    def _remove(self, pk):
+        # Postings and words of the slot stay behind and are skipped by lookups
+        slot = self.slots.pop(pk)
+        self.rows[slot] = self.keys[slot] = None
+        self.dead += 1
+
+    def _load(self, rows):
+        """Replace the contents of the index with ``rows``."""
+        self._clear()
+        pairs = []
+        for row in rows:
+            pairs += self._add(row)
+        self._add_words(pairs)
+
+    def _apply(self, rows, removed=()):
+        for pk in removed:
+            if pk in self.slots:
+                self._remove(pk)
+        pairs = []
+        for row in rows:
+            slot = self.slots.get(row[0])
+            if slot is not None:
+                if self.rows[slot] == row:
+                    continue
+                if self.keys[slot] == normalize(' '.join(row[1:])):
+                    self.rows[slot] = row
+                    continue
+                self._remove(row[0])
+            pairs += self._add(row)
+        self._add_words(pairs)
+        if self.dead > max(len(self.rows) // 2, 1000):
+            self._load(sorted((row for row in self.rows if row), key=lambda row: row[0]))
+
+    def _fetch(self, queryset):
+        """Rows of ``queryset`` as (pk, *fields), moving the watermark past them."""
+        rows = []
+        values = queryset.values_list('pk', *self.fields, 'updated_at')
+        for *row, updated_at in values.iterator(chunk_size=2000):
+            rows.append(tuple(row))
+            if self.watermark is None or updated_at > self.watermark:
+                self.watermark = updated_at
+        return rows
+
+    def _due(self, now):
+        if not self.built and not self.too_large or now - self.refreshed_at >= MAX_AGE:
+            return True
+        if now - self.checked_at < REFRESH_INTERVAL:
+            return False
+        self.checked_at = now
+        return caching.get_versions([self.model])[0] != self.version
+
+    def refresh(self, force=False):
+        """
+        Bring the index up to date with the database when it may be stale.
+        The first build takes seconds, so unless ``force`` is set it runs in
+        a background thread while lookups fall back to products.search.
+        """
+        # Lookups keep using the current data while another thread refreshes it
+        if not self.refresh_lock.acquire(blocking=force):
+            return
+        background = False
+        try:
+            now = time.monotonic()
+            if not force and not self._due(now):
+                return
+            if not self.built and not force:
+                threading.Thread(target=self._update_in_background, args=(now,), daemon=True).start()
+                background = True
+                return
+            self._update(now, force)
+        finally:
+            if not background:
+                self.refresh_lock.release()
+
+    def _update_in_background(self, now):
+        try:
+            self._update(now)
+        finally:
+            self.refresh_lock.release()
+            connections.close_all()
+
+    def _update(self, now, force=False):
+        # Read before the rows, so writes made meanwhile trigger another refresh
+        self.version = caching.get_versions([self.model])[0]
+        self.checked_at = self.refreshed_at = now
+        objects = self.model._default_manager.order_by()
+        if not self.built:
+            self._build(objects, now)
+            return
+
+        rows = self._fetch(objects.filter(updated_at__gte=self.watermark - OVERLAP)
+                           if self.watermark else objects)
+        removed = []
+        if force or now - self.reconciled_at >= RECONCILE_INTERVAL:
+            self.reconciled_at = now
+            with self.lock:
+                self._apply(rows)
+                rows = []
+                count = len(self.slots)
+            if objects.count() != count:
+                pks = set(objects.values_list('pk', flat=True))
+                removed = [pk for pk in list(self.slots) if pk not in pks]
+                rows = self._fetch(objects.filter(pk__in=pks.difference(self.slots)))
+        with self.lock:
+            self._apply(rows, removed)
+
+    def _build(self, objects, now):
+        self.reconciled_at = now
+        self.too_large = objects.count() > settings.AUTOCOMPLETE_MAX_ENTRIES
+        if self.too_large:
+            return
+        self.watermark = None
+        rows = self._fetch(objects.order_by('pk'))
+        with self.lock:
+            self._load(rows)
+            self.built = True
+
+    def lookup(self, text, limit=10):
+        """Up to ``limit`` rows whose name contains the words of ``text``, best first."""
+        query = normalize(text)
+        if not query:
+            return []
+        self.refresh()
+        if not self.built:
+            return list(search.search(self.model._default_manager.all(), text)
+                        .values('id', *self.fields)[:limit])
+
+        terms = query.split()
+        first, rest = terms[0], terms[1:]
+        # slot -> (0: name starts with the query, 1: a word does, 2: the name contains it,
+        # then shorter names first)
+        matches = {}
+        with self.lock:
+            # A rebuild replaces the lists, so they are read under the lock together
+            keys = self.keys
+            start = bisect.bisect_left(self.words, first)
+            end = bisect.bisect_left(self.words, first + '\U0010ffff', start,
+                                     min(start + PREFIX_SCAN_LIMIT, len(self.words)))
+            for slot in self.word_slots[start:end]:
+                key = keys[slot]
+                if key is not None and (not rest or all(term in key for term in rest)):
+                    matches[slot] = (0 if key.startswith(query) else 1, len(key), key, slot)
+
+            postings = [self.grams.get(gram) for term in terms for gram in ngrams(term)]
+            if len(matches) < limit and postings and all(postings):
+                # Newest names first
+                for slot in reversed(min(postings, key=len)[-SUBSTRING_SCAN_LIMIT:]):
+                    key = keys[slot]
+                    if key is None or slot in matches or first not in key \
+                            or rest and not all(term in key for term in rest):
+                        continue
+                    if key.startswith(query):
+                        score = 0
+                    else:
+                        score = 1 if key.startswith(first) or ' ' + first in key else 2
+                    matches[slot] = (score, len(key), key, slot)
+
+            return [dict(zip(('id', *self.fields), self.rows[match[3]]))
+                    for match in heapq.nsmallest(limit, matches.values())]
+
+    def stats(self):
+        """Size of the index in this process; ``bytes`` is an estimate."""
+        with self.lock:
+            size = sys.getsizeof(self.rows) + sys.getsizeof(self.keys) + sys.getsizeof(self.slots)
+            size += sum(sys.getsizeof(row) + sum(map(sys.getsizeof, row)) for row in self.rows if row)
+            size += sum(sys.getsizeof(key) for key in self.keys if key)
+            size += sys.getsizeof(self.grams) + sum(
+                sys.getsizeof(gram) + sys.getsizeof(slots) for gram, slots in self.grams.items())
+            size += sys.getsizeof(self.words) + sys.getsizeof(self.word_slots)
+            size += sum(sys.getsizeof(word) for word in set(self.words))
+            return {
+                'built': self.built,
+                'too_large': self.too_large,
+                'entries': len(self.slots),
+                'stale_slots': self.dead,
+                'ngrams': len(self.grams),
+                'bytes': size,
+                'age': round(time.monotonic() - self.refreshed_at, 1) if self.built else None,
+            }
+
+INDEXES = {
+    'product': TypeaheadIndex(Product),
+    'customer': TypeaheadIndex(Customer, fields=('name', 'email')),
+}
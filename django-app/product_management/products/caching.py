@@ -0,0 +1,110 @@
+"""
+Versioned caching of precomputed view data.
+
+Each model has a version counter in the cache that is bumped after every
+committed save or delete (see products.signals). Cached values are keyed by
+the versions of the models they were built from, so a write makes the old
+entries unreachable instead of having to find and delete them. Concurrent
+misses for the same key are coalesced with a short-lived lock in the cache,
+so only one worker rebuilds while the others wait for its result.
+
+All state lives in the ``default`` cache: with a shared backend (Redis,
+memcached, the database cache) one warm entry serves every uWSGI process.
+With the per-process ``locmemcache://`` a process would not see the version
+bumps of another's writes and keep serving stale values, so
+``DASHBOARD_CACHE`` defaults to on only when ``CACHE_URL`` is shared; with
+it off get_or_build() builds every value.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from . import routing
+
+KEY_PREFIX = 'products'
+LOCK_TIMEOUT = 30
+WAIT_INTERVAL = 0.05
+
+def _version_key(model):
+    return f'{KEY_PREFIX}:version:{model._meta.label_lower}'
+
+def _modified_key(model):
+    return f'{KEY_PREFIX}:modified:{model._meta.label_lower}'
+
+def _initial_version():
+    # Seeded from the clock so a counter that was evicted from the cache
+    # never restarts at a value an older entry was built against.
+    return time.time_ns() // 1000
+
+def bump_version(model):
+    """Invalidate everything cached from ``model`` once the current transaction commits."""
+    def bump():
+        key = _version_key(model)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, _initial_version(), timeout=None)
+        cache.set(_modified_key(model), time.time(), timeout=None)
+    transaction.on_commit(bump)
+
+def get_versions(models):
+    keys = [_version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _initial_version(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+def get_modified(models):
+    """
+    When any of ``models`` was last bumped, as a timestamp, or None when
+    that is not known for all of them.
+    """
+    keys = [_modified_key(model) for model in models]
+    modified = cache.get_many(keys)
+    if len(modified) < len(keys):
+        return None
+    return max(modified.values())
+
+def get_or_build(name, models, build, timeout=None, wait=None):
+    """
+    Return the cached value ``name`` for the current versions of ``models``,
+    calling ``build()`` to compute it on a miss.
+    """
+    if not settings.DASHBOARD_CACHE:
+        return build()
+    if timeout is None:
+        timeout = settings.DASHBOARD_CACHE_TIMEOUT
+    if wait is None:
+        wait = LOCK_TIMEOUT
+    versions = '.'.join(str(version) for version in get_versions(models))
+    key = f'{KEY_PREFIX}:{name}:{versions}'
+
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = f'{key}:lock'
+    deadline = time.monotonic() + wait
+    while not cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+        # Another worker is building this value; use its result when ready
+        time.sleep(WAIT_INTERVAL)
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if time.monotonic() >= deadline:
+            routing.use_primary_if_written(models)
+            return build()
+
+    try:
+        value = cache.get(key)
+        if value is None:
+            routing.use_primary_if_written(models)
+            value = build()
+            cache.set(key, value, timeout)
+    finally:
+        cache.delete(lock_key)
+    return value
@@ -0,0 +1,61 @@
+"""
+Conditional GET for the API and the list pages.
+
+A response's ETag is a hash of the request (path, query string, Accept
+header and user) and the products.caching version counters of the models
+it reads. Those counters are bumped after every committed save or delete,
+and by the bulk write paths, so the validator is computed from one cache
+read without running the view's queries. A request whose If-None-Match
+still matches gets a 304 before anything is queried or serialized.
+Last-Modified is the time of the latest bump of those models; it is left
+out while that bump is less than a second old, since If-Modified-Since
+cannot tell two writes within the same second apart.
+
+Validators are only as shared as the cache holding the counters. With the
+per-process ``locmemcache://`` one uWSGI process does not see another's
+writes and could answer 304 for a changed list, so ``CONDITIONAL_GET``
+defaults to on only when ``CACHE_URL`` points at a shared backend.
+"""
+import time
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.crypto import md5
+from django.utils.http import http_date, quote_etag
+
+from . import caching, routing
+
+def validators(request, models, *extra):
+    """``(etag, last_modified)`` of ``request`` for the current versions of ``models``."""
+    models = sorted(models, key=lambda model: model._meta.label)
+    parts = [request.get_full_path(), request.META.get('HTTP_ACCEPT', ''),
+             request.user.pk, *extra, *caching.get_versions(models)]
+    etag = quote_etag(md5('\n'.join(str(part) for part in parts).encode(),
+                          usedforsecurity=False).hexdigest())
+    last_modified = caching.get_modified(models)
+    if last_modified is not None and time.time() - last_modified < 1:
+        last_modified = None
+    return etag, last_modified and int(last_modified)
+
+def respond(request, models, get_response, *extra):
+    """
+    Answer a GET for data read from ``models``: 304 when the client's copy
+    is current, otherwise ``get_response()`` with the validators attached.
+    ``extra`` adds whatever else the response depends on to the ETag.
+    """
+    if not settings.CONDITIONAL_GET or request.method not in ('GET', 'HEAD'):
+        return get_response()
+
+    etag, last_modified = validators(request, models, *extra)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        routing.use_primary_if_written(models)
+        response = get_response()
+        if response.status_code != 200:
+            return response
+        response.headers.setdefault('ETag', etag)
+        if last_modified:
+            response.headers.setdefault('Last-Modified', http_date(last_modified))
+    # Clients revalidate on every use instead of guessing a freshness lifetime
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
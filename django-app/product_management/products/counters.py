@@ -0,0 +1,237 @@
+"""
+Stored aggregate counters.
+
+Category.products_count, Customer.total_purchases and total_spent, and
+Product.units_sold and revenue are kept exact by F() updates made in the
+same transaction as the write that changes them: from the model signals in
+products.signals, and from record_sales_created() and
+record_items_created() for sales inserted with bulk_create. List pages and
+serializers read them instead of grouping the child tables. Cancelled sales
+are not counted.
+
+The product row of a sharded product is never written by a sale (see
+products.stock), so its units and revenue are added to the stock shard the
+sale took its quantity from, a row the sale already holds locked, and
+Product.objects.with_stock() sums them back up like the stock itself.
+Saving a model instance leaves its counters alone (see
+models.CounterFieldsMixin).
+
+Writes that bypass model signals (QuerySet.update(), raw SQL) are not
+tracked; run ``manage.py recount`` after those.
+"""
+import random
+from collections import defaultdict
+from decimal import Decimal
+from functools import reduce
+from operator import or_
+
+from django.apps import apps as global_apps
+from django.db import transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from . import caching
+from .models import Category, Customer, Product, SaleItem, StockShard
+
+UNCOUNTED_STATUSES = ('cancelled',)
+
+def counted(state):
+    """Whether a sale in ``state`` (a rollups.SaleState, or None) is counted."""
+    return state is not None and state.status not in UNCOUNTED_STATUSES
+
+def _add(model, pk, **deltas):
+    if pk is not None and any(deltas.values()):
+        model.objects.filter(pk=pk).update(**{field: F(field) + value for field, value in deltas.items()})
+
+def _add_many(model, deltas):
+    """Add ``{pk: {field: delta}}`` to rows of ``model`` in one UPDATE."""
+    deltas = {pk: values for pk, values in deltas.items() if any(values.values())}
+    if not deltas:
+        return
+    fields = next(iter(deltas.values()))
+    model.objects.filter(pk__in=deltas).update(**{
+        field: F(field) + Case(
+            *(When(pk=pk, then=Value(values[field])) for pk, values in deltas.items()),
+            output_field=model._meta.get_field(field),
+        )
+        for field in fields
+    })
+
+def add_product_sales(product_id, units, revenue, shard_count=None, shard=None):
+    """
+    Add to a product's sales counters: on its row, or on a stock shard of a
+    sharded product, ``shard`` when given and a random one otherwise.
+    ``shard_count`` saves a query when known.
+    """
+    if not units and not revenue:
+        return
+    updates = {'units_sold': F('units_sold') + units, 'revenue': F('revenue') + revenue}
+    if shard is not None:
+        shard_count = shard + 1
+    elif shard_count is None:
+        if Product.objects.filter(pk=product_id, stock_shard_count=0).update(**updates):
+            return
+        shard_count = Product.objects.filter(pk=product_id).values_list(
+            'stock_shard_count', flat=True).first()
+    # The product row holds part of the totals too, and is the fallback when
+    # the shards were just rewritten
+    if shard is None and shard_count:
+        shard = random.randrange(shard_count)
+    if not shard_count or not StockShard.objects.filter(
+            product_id=product_id, index=shard).update(**updates):
+        Product.objects.filter(pk=product_id).update(**updates)
+
+def record_product_change(old_category_id, new_category_id):
+    """Move a product from one category to the other (None for an insert/delete)."""
+    if old_category_id == new_category_id:
+        return
+    _add(Category, old_category_id, products_count=-1)
+    _add(Category, new_category_id, products_count=1)
+    caching.bump_version(Category)
+
+def record_sale_change(sale_id, old, new):
+    """
+    Fold the change of one Sale from ``old`` to ``new`` (rollups.SaleState,
+    or None for an insert/delete) into the customer and product counters.
+    """
+    old_customer = old.customer_id if counted(old) else None
+    new_customer = new.customer_id if counted(new) else None
+    if old_customer is not None and old_customer == new_customer:
+        _add(Customer, new_customer, total_spent=Decimal(new.total_amount) - Decimal(old.total_amount))
+    else:
+        if old_customer is not None:
+            _add(Customer, old_customer, total_purchases=-1, total_spent=-Decimal(old.total_amount))
+        if new_customer is not None:
+            _add(Customer, new_customer, total_purchases=1, total_spent=Decimal(new.total_amount))
+    if old != new:
+        caching.bump_version(Customer)
+
+    if old and new and counted(old) != counted(new):
+        # Cancelled or reinstated: the sale's lines stop or start counting
+        sign = 1 if counted(new) else -1
+        lines = SaleItem.objects.filter(sale_id=sale_id).values('product_id').annotate(
+            units=Sum('quantity'), revenue=Sum('total_price')).order_by()
+        for line in lines:
+            add_product_sales(line['product_id'], sign * line['units'], sign * line['revenue'])
+        caching.bump_version(Product)
+
+def record_item_change(item, old, new):
+    """
+    Fold the change of one SaleItem from ``old`` to ``new``
+    (rollups.ItemState, or None for an insert/delete) into the product
+    counters.
+    """
+    if old == new or item.sale.status in UNCOUNTED_STATUSES:
+        return
+    if old and new and old.product_id == new.product_id:
+        add_product_sales(new.product_id, new.quantity - old.quantity,
+                          Decimal(new.total_price) - Decimal(old.total_price))
+    else:
+        if old:
+            add_product_sales(old.product_id, -old.quantity, -Decimal(old.total_price))
+        if new:
+            add_product_sales(new.product_id, new.quantity, Decimal(new.total_price))
+    caching.bump_version(Product)
+
+def record_sales_created(sales):
+    """Fold Sales inserted without model signals (bulk_create) into the customer counters."""
+    by_customer = defaultdict(lambda: {'total_purchases': 0, 'total_spent': Decimal('0')})
+    for sale in sales:
+        if sale.status not in UNCOUNTED_STATUSES:
+            totals = by_customer[sale.customer_id]
+            totals['total_purchases'] += 1
+            totals['total_spent'] += Decimal(sale.total_amount)
+    _add_many(Customer, by_customer)
+    caching.bump_version(Customer)
+
+def record_items_created(items, shards=None):
+    """
+    Fold SaleItems inserted without model signals (bulk_create) into the
+    product counters. Each item's ``sale`` and ``product`` should already be
+    loaded, the latter locked or read by stock.lock_products(). ``shards`` is
+    what stock.decrement() returned for the items, so that a sharded
+    product's counters go on the shard its stock was taken from; otherwise
+    transactions holding one shard could wait on another.
+    """
+    shards = shards or {}
+    by_product = defaultdict(lambda: {'units_sold': 0, 'revenue': Decimal('0')})
+    shard_counts = {}
+    for item in items:
+        if item.sale.status in UNCOUNTED_STATUSES:
+            continue
+        totals = by_product[item.product_id]
+        totals['units_sold'] += item.quantity
+        totals['revenue'] += item.total_price
+        shard_counts[item.product_id] = item.product.stock_shard_count
+    _add_many(Product, {pk: totals for pk, totals in by_product.items() if not shard_counts[pk]})
+    for pk, totals in by_product.items():
+        if shard_counts[pk]:
+            add_product_sales(pk, totals['units_sold'], totals['revenue'], shard_counts[pk], shards.get(pk))
+
+def fold_shards(product):
+    """
+    Move the sales counters on ``product``'s stock shards to its row, before
+    the shards are rewritten. The caller holds the lock on the product.
+    """
+    shards = StockShard.objects.filter(product=product).aggregate(
+        units=Sum('units_sold'), revenue=Sum('revenue'))
+    if shards['units'] or shards['revenue']:
+        Product.objects.filter(pk=product.pk).update(
+            units_sold=F('units_sold') + (shards['units'] or 0),
+            revenue=F('revenue') + (shards['revenue'] or 0))
+        StockShard.objects.filter(product=product).update(units_sold=0, revenue=0)
+
+def _total(queryset, field, aggregate, default):
+    totals = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(
+        total=aggregate).values('total')
+    return Coalesce(Subquery(totals), default)
+
+def _repair(queryset, expected):
+    """Set the fields of ``expected`` (field: expression) where they differ; return how many rows did."""
+    annotations = {f'expected_{field}': expression for field, expression in expected.items()}
+    drifted = queryset.annotate(**annotations).filter(reduce(or_, (
+        ~Q(**{field: F(f'expected_{field}')}) for field in expected)))
+    pks = list(drifted.values_list('pk', flat=True))
+    for start in range(0, len(pks), 1000):
+        queryset.filter(pk__in=pks[start:start + 1000]).update(**expected)
+    return len(pks)
+
+def recount(apps=global_apps):
+    """
+    Recompute every counter from the raw tables and return the number of
+    rows corrected per model. Sales written meanwhile may be missed, so run
+    it while writes are quiet. ``apps`` lets migrations run this against
+    historical models.
+    """
+    Category = apps.get_model('products', 'Category')
+    Customer = apps.get_model('products', 'Customer')
+    Product = apps.get_model('products', 'Product')
+    StockShard = apps.get_model('products', 'StockShard')
+    Sale = apps.get_model('products', 'Sale')
+    SaleItem = apps.get_model('products', 'SaleItem')
+    zero = Value(Decimal('0'))
+    sales = Sale.objects.exclude(status__in=UNCOUNTED_STATUSES)
+    items = SaleItem.objects.exclude(sale__status__in=UNCOUNTED_STATUSES)
+
+    with transaction.atomic():
+        # Folded into the product rows first, so only real drift is reported
+        list(StockShard.objects.select_for_update().order_by('product', 'index'))
+        _add_many(Product, {
+            row['product']: {'units_sold': row['units_sold'], 'revenue': row['revenue']}
+            for row in StockShard.objects.values('product').annotate(
+                units_sold=Sum('units_sold'), revenue=Sum('revenue')).order_by()
+        })
+        StockShard.objects.update(units_sold=0, revenue=0)
+        return {
+            'categories': _repair(Category.objects.all(), {
+                'products_count': _total(Product.objects.all(), 'category', Count('pk'), 0),
+            }),
+            'customers': _repair(Customer.objects.all(), {
+                'total_purchases': _total(sales, 'customer', Count('pk'), 0),
+                'total_spent': _total(sales, 'customer', Sum('total_amount'), zero),
+            }),
+            'products': _repair(Product.objects.all(), {
+                'units_sold': _total(items, 'product', Sum('quantity'), 0),
+                'revenue': _total(items, 'product', Sum('total_price'), zero),
+            }),
+        }
@@ -0,0 +1,119 @@
+"""
+Streaming exports of whole tables.
+
+An export streams rows in primary key order as NDJSON or CSV. Rows are read
+with the fast read path (see products.fastread) from ``iterator()``, a
+server-side cursor on PostgreSQL, and converted and encoded one chunk at a
+time, so memory use does not depend on the size of the export. With
+``Accept-Encoding: gzip`` the stream is gzipped as it is written.
+
+uWSGI's ``harakiri`` limits how long any one response may take, so a
+response holds at most ``EXPORT_MAX_ROWS`` rows. The rows it covers are
+fixed before streaming starts, and when more follow, its ``Link: rel="next"``
+header gives the URL that resumes after them (``?after=<id>``). A client
+exports a table of any size by following those links.
+"""
+import csv
+import datetime
+import io
+import json
+import re
+from itertools import islice
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.urls import replace_query_param
+
+CHUNK_SIZE = 2000
+
+_accepts_gzip = re.compile(r'\bgzip\b')
+
+def _start_of(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+def in_range(queryset, field, date_from=None, date_to=None):
+    """``queryset`` limited to rows whose ``field`` falls within the two dates, inclusive."""
+    if date_from:
+        queryset = queryset.filter(**{f'{field}__gte': _start_of(date_from)})
+    if date_to:
+        queryset = queryset.filter(**{f'{field}__lt': _start_of(date_to + datetime.timedelta(days=1))})
+    return queryset
+
+def chunks(reader, queryset, context=None, chunk_size=CHUNK_SIZE):
+    """Lists of up to ``chunk_size`` rows of ``queryset`` converted by ``reader``."""
+    rows = reader.rows(queryset).order_by('pk').iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield reader.convert(chunk, context)
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+def ndjson(chunks):
+    for chunk in chunks:
+        yield ''.join(_dumps(row) + '\n' for row in chunk).encode()
+
+def csv_rows(chunks, columns):
+    """CSV with a header of ``columns``; nested and expanded values are written as JSON."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for chunk in chunks:
+        writer.writerows(
+            [_dumps(value) if isinstance(value, (dict, list)) else value
+             for value in (row[column] for column in columns)]
+            for row in chunk
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def export(request, reader, queryset, name, format, context=None):
+    """
+    A streaming response of ``queryset`` read through ``reader`` as
+    ``format`` ('ndjson' or 'csv'), starting after the ``after`` primary key
+    and covering at most ``limit`` rows (EXPORT_MAX_ROWS by default).
+    """
+    params = request.query_params
+    after = params.get('after')
+    if after:
+        if not after.isdigit():
+            raise ValidationError({'after': 'Enter a valid id.'})
+        queryset = queryset.filter(pk__gt=after)
+    try:
+        limit = min(max(int(params['limit']), 1), settings.EXPORT_MAX_ROWS)
+    except (KeyError, ValueError):
+        limit = settings.EXPORT_MAX_ROWS
+
+    # Fix the rows this response covers before the first byte is sent
+    bounds = list(queryset.order_by('pk').values_list('pk', flat=True)[limit - 1:limit + 1])
+    next_url = None
+    if bounds:
+        queryset = queryset.filter(pk__lte=bounds[0])
+        if len(bounds) > 1:
+            next_url = replace_query_param(request.build_absolute_uri(), 'after', bounds[0])
+
+    rows = chunks(reader, queryset, context)
+    if format == 'csv':
+        content, content_type = csv_rows(rows, reader.order), 'text/csv; charset=utf-8'
+    else:
+        content, content_type = ndjson(rows), 'application/x-ndjson'
+
+    gzip = _accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    response = StreamingHttpResponse(compress_sequence(content) if gzip else content,
+                                     content_type=content_type)
+    if gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    response.headers['Content-Disposition'] = f'attachment; filename="{name}.{format}"'
+    if next_url:
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
@@ -0,0 +1,187 @@
+"""
+Fast read path for the list and retrieve endpoints.
+
+Serializing a page through a ModelSerializer builds a model instance per
+row and walks every field's get_attribute() and to_representation(). A
+Reader instead fetches exactly the serializer's readable fields with one
+``values_list()`` query (related names such as ``category_name`` become
+joins) and turns each row into a dict with converters compiled once per
+serializer class. Nested many=True serializers are read with one extra
+query. The output matches ``serializer.data`` field for field, which the
+products tests check against the real serializers.
+
+A reader can be limited to some of the serializer's fields (``?fields=``),
+in which case only their columns, joins and nested queries are read, and
+can expand foreign keys listed in the serializer's
+``Meta.expandable_fields`` from an id to the related object
+(``?expand=``), read with one query per expanded relation.
+
+Nested and expanded rows are read from the serializer's ``read_queryset()``
+when it defines one (e.g. to add annotations its fields read), otherwise
+from the model's default manager.
+
+Only plain fields are supported: SerializerMethodField, ``source='*'``
+and nested serializers other than reverse foreign keys raise TypeError
+when the reader is compiled.
+"""
+from collections import defaultdict
+from functools import lru_cache
+
+from django.db.models.fields.files import FileField as ModelFileField
+from rest_framework import serializers
+from rest_framework.settings import api_settings
+
+# DRF representations that are a plain type conversion
+_FAST_CONVERTERS = {
+    serializers.CharField.to_representation: str,
+    serializers.IntegerField.to_representation: int,
+}
+
+def reader_for(serializer_class, fields=None, expand=()):
+    """
+    The compiled Reader for ``serializer_class``, limited to ``fields`` (all
+    when None) and expanding the relations in ``expand``. Unknown names, or
+    no fields at all, raise ValidationError.
+    """
+    return _reader_for(serializer_class, None if fields is None else frozenset(fields), frozenset(expand))
+
+@lru_cache(maxsize=256)
+def _reader_for(serializer_class, fields, expand):
+    return Reader(serializer_class, fields, expand)
+
+def serialize(serializer_class, queryset, context=None):
+    """Same as ``serializer_class(queryset, many=True, context=context).data``."""
+    reader = reader_for(serializer_class)
+    return reader.convert(reader.rows(queryset), context)
+
+def _identity(value):
+    return value
+
+def _related_models(model, source_attrs):
+    """The models joined to read ``source_attrs`` from ``model``."""
+    models = []
+    for name in source_attrs[:-1]:
+        model = model._meta.get_field(name).related_model
+        models.append(model)
+    return models
+
+def _model_field(model, source_attrs):
+    for name in source_attrs[:-1]:
+        model = model._meta.get_field(name).related_model
+    return model._meta.get_field(source_attrs[-1])
+
+class Reader:
+    def __init__(self, serializer_class, fields=None, expand=frozenset()):
+        serializer = serializer_class()
+        self.model = model = serializer.Meta.model
+        self.read_queryset = getattr(serializer_class, 'read_queryset', model._default_manager.all)
+        readable = {name for name, field in serializer.fields.items() if not field.write_only}
+        expandable = getattr(serializer.Meta, 'expandable_fields', {})
+        errors = {}
+        if fields is not None and not fields:
+            errors['fields'] = 'Name at least one field.'
+        elif fields is not None and fields - readable:
+            errors['fields'] = f'Unknown fields: {", ".join(sorted(fields - readable))}.'
+        if expand - set(expandable):
+            errors['expand'] = f'Cannot expand: {", ".join(sorted(expand - set(expandable)))}.'
+        if errors:
+            raise serializers.ValidationError(errors)
+
+        self.paths = ['pk']
+        # (name, row index, converter or file field) for plain fields
+        self.columns = []
+        # (name, reader, parent foreign key) for nested many=True serializers
+        self.nested = []
+        # (name, row index of the foreign key, reader) for expanded relations
+        self.expanded = []
+        self.order = []
+        # Every model the output is read from
+        self.models = {model}
+        for name, field in serializer.fields.items():
+            if field.write_only or (fields is not None and name not in fields):
+                continue
+            self.order.append(name)
+            if name in expand:
+                self.paths.append(field.source_attrs[0])
+                reader = reader_for(expandable[name])
+                self.expanded.append((name, len(self.paths) - 1, reader))
+                self.models |= reader.models
+                continue
+            if isinstance(field, serializers.ListSerializer):
+                relation = model._meta.get_field(field.source)
+                if not relation.one_to_many:
+                    raise TypeError(f'{serializer_class.__name__}.{name} is not a reverse foreign key')
+                reader = reader_for(type(field.child))
+                self.nested.append((name, reader, relation.field.name))
+                self.models |= reader.models
+                continue
+            if isinstance(field, (serializers.SerializerMethodField, serializers.BaseSerializer)) \
+                    or field.source == '*':
+                raise TypeError(f'{serializer_class.__name__}.{name} cannot be read from values()')
+
+            self.paths.append('__'.join(field.source_attrs))
+            self.models.update(_related_models(model, field.source_attrs))
+            index = len(self.paths) - 1
+            if isinstance(field, serializers.FileField):
+                file_field = _model_field(model, field.source_attrs)
+                if not isinstance(file_field, ModelFileField):
+                    raise TypeError(f'{serializer_class.__name__}.{name} is not a model file field')
+                self.columns.append((name, index, (field, file_field)))
+            elif isinstance(field, serializers.PrimaryKeyRelatedField) and field.pk_field is None:
+                self.columns.append((name, index, _identity))
+            else:
+                self.columns.append((name, index, _FAST_CONVERTERS.get(
+                    type(field).to_representation, field.to_representation)))
+
+    def rows(self, queryset):
+        """
+        The ``values_list()`` queryset this reader converts; it can be sliced
+        or paginated. Annotations the queryset is ordered by (e.g. a search
+        rank) are fetched after the reader's columns, for keyset pagination.
+        """
+        ordering = [name.lstrip('-') for name in queryset.query.order_by if isinstance(name, str)]
+        annotations = [name for name in ordering if name in queryset.query.annotations]
+        return queryset.prefetch_related(None).values_list(*self.paths, *annotations)
+
+    def _file_converter(self, field, file_field, context):
+        request = (context or {}).get('request')
+        use_url = getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL)
+
+        def convert(name):
+            if not name:
+                return None
+            if not use_url:
+                return name
+            url = file_field.storage.url(name)
+            return request.build_absolute_uri(url) if request is not None else url
+        return convert
+
+    def convert(self, rows, context=None):
+        """Turn rows from rows() into the serializer's list of dicts."""
+        rows = list(rows)
+        # Per output field: a function of the row
+        getters = {}
+        for name, index, convert in self.columns:
+            if isinstance(convert, tuple):
+                convert = self._file_converter(*convert, context)
+            getters[name] = (lambda row, index=index, convert=convert:
+                             None if row[index] is None else convert(row[index]))
+
+        for name, reader, parent_field in self.nested:
+            grouped = defaultdict(list)
+            nested_rows = list(reader.read_queryset().filter(
+                **{f'{parent_field}__in': [row[0] for row in rows]}
+            ).values_list(parent_field, *reader.paths).order_by('pk'))
+            for parent, data in zip((row[0] for row in nested_rows),
+                                    reader.convert([row[1:] for row in nested_rows], context)):
+                grouped[parent].append(data)
+            getters[name] = lambda row, grouped=grouped: grouped.get(row[0], [])
+
+        for name, index, reader in self.expanded:
+            related = list(reader.rows(reader.read_queryset().filter(
+                pk__in={row[index] for row in rows if row[index] is not None})))
+            by_pk = dict(zip((row[0] for row in related), reader.convert(related, context)))
+            getters[name] = lambda row, index=index, by_pk=by_pk: by_pk.get(row[index])
+
+        plan = [(name, getters[name]) for name in self.order]
+        return [{name: get(row) for name, get in plan} for row in rows]
@@ -0,0 +1,214 @@
+"""
+Bulk sale ingestion for POS batch uploads.
+
+Records are parsed from the request body as a stream (a JSON array or
+newline-delimited JSON), validated in batches and written in chunked
+transactions with bulk inserts, so a terminal can replay thousands of
+buffered sales in one request.
+"""
+import codecs
+import json
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+
+from . import caching, counters, rollups, stock, topk
+from .models import Customer, Product, Sale, SaleItem
+
+CHUNK_SIZE = 500
+READ_SIZE = 64 * 1024
+STATUSES = {value for value, label in Sale._meta.get_field('status').choices}
+# Ids outside the signed 64-bit range of the primary keys cannot even be looked up
+MIN_ID, MAX_ID = -2 ** 63, 2 ** 63 - 1
+
+_decoder = json.JSONDecoder()
+
+def iter_records(stream, read_size=READ_SIZE):
+    """
+    Yield the records of a JSON array or NDJSON body read incrementally from
+    ``stream``. Raises ValueError on malformed input.
+    """
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    buffer, pos, eof = '', 0, False
+    array = None
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        chunk = stream.read(read_size)
+        eof = not chunk
+        buffer = buffer[pos:] + decode(chunk, final=eof)
+        pos = 0
+
+    while True:
+        # Skip whitespace (and commas between array elements)
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or (array and buffer[pos] == ',')):
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            read_more()
+        if pos >= len(buffer):
+            if array:
+                raise ValueError('Unterminated JSON array.')
+            return
+
+        if array is None:
+            array = buffer[pos] == '['
+            if array:
+                pos += 1
+                continue
+        if array and buffer[pos] == ']':
+            return
+
+        while True:
+            try:
+                record, pos = _decoder.raw_decode(buffer, pos)
+                break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                read_more()
+        yield record
+
+def _is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) and MIN_ID <= value <= MAX_ID
+
+def _parse(record):
+    """Return ``(customer_id, status, [(product_id, quantity)], errors)`` for one record."""
+    if not isinstance(record, dict):
+        return None, None, None, {'non_field_errors': ['Expected an object.']}
+    errors = {}
+    customer = record.get('customer')
+    if not _is_id(customer):
+        errors['customer'] = ['A valid customer id is required.']
+    status = record.get('status', 'pending')
+    if status not in STATUSES:
+        errors['status'] = [f'"{status}" is not a valid choice.']
+    lines = []
+    items = record.get('items', [])
+    if not isinstance(items, list):
+        items = [None]
+    for item in items:
+        product = isinstance(item, dict) and item.get('product')
+        quantity = isinstance(item, dict) and item.get('quantity')
+        if not (_is_id(product) and isinstance(quantity, int) and not isinstance(quantity, bool)
+                and quantity >= 1):
+            errors['items'] = ['Each item needs a product id and a positive quantity.']
+            break
+        lines.append((product, quantity))
+    return customer, status, lines, errors
+
+def ingest_sales(records, chunk_size=CHUNK_SIZE):
+    """
+    Write ``records`` (``{"customer", "status", "items": [{"product",
+    "quantity"}]}``) in transactions of ``chunk_size`` sales, yielding one
+    result per record in input order. Records that fail validation are
+    reported and skipped; the rest of their chunk is still written. A parse
+    error is re-raised after the records read before it have been written.
+    """
+    known_customers = set()
+    chunk = []
+    error = None
+    try:
+        for index, record in enumerate(records):
+            chunk.append((index, record))
+            if len(chunk) >= chunk_size:
+                yield from write_chunk(chunk, known_customers)
+                chunk = []
+    except ValueError as exc:
+        error = exc
+    if chunk:
+        yield from write_chunk(chunk, known_customers)
+    if error:
+        raise error
+
+def write_chunk(chunk, known_customers=None, sale_dates=None):
+    """
+    Write ``(key, record)`` pairs in one transaction, yielding a result per
+    record (with the key as ``index``) in input order. ``known_customers``
+    is a set of customer ids already known to exist; it is extended in place.
+    ``sale_dates`` maps keys to the ``sale_date`` of their sale, which is
+    otherwise now.
+    """
+    if known_customers is None:
+        known_customers = set()
+    sale_dates = sale_dates or {}
+    results = {}
+    parsed = []
+    for index, record in chunk:
+        customer_id, status, lines, errors = _parse(record)
+        if errors:
+            results[index] = {'index': index, 'status': 'error', 'errors': errors}
+        else:
+            parsed.append((index, customer_id, status, lines))
+
+    # One lookup each for the chunk's customers and products
+    unknown = {customer_id for _, customer_id, _, _ in parsed} - known_customers
+    if unknown:
+        known_customers.update(Customer.objects.filter(pk__in=unknown).values_list('pk', flat=True))
+    product_ids = {product_id for _, _, _, lines in parsed for product_id, _ in lines}
+
+    with transaction.atomic():
+        # Shards are locked too, so the stock checks below are exact
+        products = stock.lock_products(product_ids, lock_shards=True)
+        available = {pk: product.available_stock for pk, product in products.items()}
+        needed = defaultdict(int)
+        accepted = []
+        for index, customer_id, status, lines in parsed:
+            wanted = defaultdict(int)
+            for product_id, quantity in lines:
+                wanted[product_id] += quantity
+            errors = {}
+            if customer_id not in known_customers:
+                errors['customer'] = [f'Invalid pk "{customer_id}" - object does not exist.']
+            missing = sorted(set(wanted) - set(products))
+            if missing:
+                errors['items'] = [f'Unknown products: {", ".join(map(str, missing))}.']
+            elif any(available[pk] < quantity for pk, quantity in wanted.items()):
+                errors['items'] = ['Insufficient stock.']
+            if errors:
+                results[index] = {'index': index, 'status': 'error', 'errors': errors}
+                continue
+
+            for product_id, quantity in wanted.items():
+                available[product_id] -= quantity
+                needed[product_id] += quantity
+            items = [
+                SaleItem(product=products[product_id], quantity=quantity,
+                         unit_price=products[product_id].price,
+                         total_price=quantity * products[product_id].price)
+                for product_id, quantity in lines
+            ]
+            sale = Sale(customer_id=customer_id, status=status,
+                        total_amount=sum((item.total_price for item in items), Decimal('0')))
+            if index in sale_dates:
+                sale.sale_date = sale_dates[index]
+            accepted.append((index, sale, items))
+
+        if accepted:
+            sales = Sale.objects.bulk_create([sale for _, sale, _ in accepted])
+            all_items = []
+            for _, sale, items in accepted:
+                for item in items:
+                    item.sale = sale
+                all_items.extend(items)
+            SaleItem.objects.bulk_create(all_items)
+            shards = stock.decrement(needed, products)
+
+            rollups.record_sales_created(sales)
+            rollups.record_items_created(all_items)
+            counters.record_sales_created(sales)
+            counters.record_items_created(all_items, shards)
+            topk.record_sales(
+                (sale.sale_date, [(item.product_id, item.quantity, item.total_price)
+                                  for item in items])
+                for _, sale, items in accepted
+            )
+            for model in (Sale, SaleItem, Product):
+                caching.bump_version(model)
+
+    for index, sale, items in accepted:
+        results[index] = {'index': index, 'status': 'created', 'id': sale.pk}
+    for index, _ in chunk:
+        yield results[index]
@@ -0,0 +1,288 @@
+import datetime
+import json
+import random
+import re
+import uuid
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.urls import URLPattern, URLResolver, get_resolver, reverse
+from django.utils import timezone
+from products import autocomplete, routing
+from products.models import Category, Product, Customer, Sale, SaleItem
+
+STATUSES = ['completed'] * 7 + ['pending'] * 2 + ['cancelled']
+WORDS = ['wireless', 'black', 'stainless', 'bottle', 'organic', 'cotton', 'desk', 'lamp',
+         'ワイヤレス', 'イヤホン', '水筒', '限定']
+DAYS = 90
+BATCH_SIZE = 5000
+SCAN_NODES = ('Seq Scan', 'Parallel Seq Scan')
+JOIN_NODES = ('Hash', 'Hash Join', 'Merge Join', 'Nested Loop')
+PASSTHROUGH_NODES = ('Gather', 'Gather Merge', 'Append', 'Merge Append')
+# Tables Django aliases in subqueries and joins: "products_saleitem" U0
+_alias = re.compile(r'"(\w+)" ([A-Z]\d+)\b')
+_parenthesized = re.compile(r'\([^()]*\)')
+# Per URL name, query strings requested on top of the view's filters and search
+EXTRA_PARAMS = {
+    'product_list': lambda ids: [{'category': ids['category']}, {'search': ids['term']}],
+    'product-low-stock': lambda ids: [{'threshold': 5}],
+    'sale-best-sellers': lambda ids: [{'window': '30d', 'metric': 'revenue'}],
+    'sale-timeseries': lambda ids: [{'granularity': 'month', 'product': ids['product']},
+                                    {'category': ids['category']}],
+    'sale-export': lambda ids: [{'from': ids['date']}],
+    'sale-item-export': lambda ids: [{'status': 'completed'}],
+    'autocomplete': lambda ids: [{'q': ids['term']}, {'q': ids['term'], 'type': 'customer'}],
+}
+
+def named_patterns(resolver):
+    """(name, pattern) for every named URL below ``resolver``, without format suffixes."""
+    for pattern in resolver.url_patterns:
+        if isinstance(pattern, URLResolver):
+            yield from named_patterns(pattern)
+        elif isinstance(pattern, URLPattern) and pattern.name \
+                and 'format' not in pattern.pattern.regex.groupindex:
+            yield pattern.name, pattern
+
+def view_model(callback):
+    view = getattr(callback, 'cls', None) or getattr(callback, 'view_class', None)
+    queryset = getattr(view, 'queryset', None)
+    return view, queryset.model if queryset is not None else getattr(view, 'model', None)
+
+def plan_nodes(node, parents=()):
+    yield node, parents
+    for child in node.get('Plans', ()):
+        yield from plan_nodes(child, parents + (node,))
+
+class Command(BaseCommand):
+    help = ('Requests every products view against a seeded dataset, EXPLAINs the queries they run '
+            'and fails if any of them scans a large table')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20_000,
+                            help='Products and customers to seed, with twice as many sales '
+                                 '(0 audits the existing data)')
+        parser.add_argument('--threshold', type=int, default=10_000,
+                            help='Tables with more rows than this must not be scanned')
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            raise CommandError(f'Query plans of {connection.vendor} are not supported')
+        self.threshold = options['threshold']
+        self.verbosity = options['verbosity']
+        # Everything, the seeded rows included, is rolled back at the end
+        with transaction.atomic():
+            if options['rows']:
+                self.seed(options['rows'])
+            self.analyze()
+            failures = self.audit()
+            transaction.set_rollback(True)
+        if failures:
+            raise CommandError(f'{failures} queries scan tables of more than {self.threshold} rows')
+        self.stdout.write(self.style.SUCCESS('No query scans a large table'))
+
+    def seed(self, rows):
+        rng = random.Random(0)
+        tag = uuid.uuid4().hex[:8]
+        categories = Category.objects.bulk_create([
+            Category(name=f'audit {tag} {index}', description='audit') for index in range(max(rows // 1000, 5))
+        ])
+        products = []
+        for start in range(0, rows, BATCH_SIZE):
+            products += Product.objects.bulk_create([
+                Product(name=' '.join(rng.sample(WORDS, 3)) + f' {index}',
+                        description=' '.join(rng.sample(WORDS, 6)), category=rng.choice(categories),
+                        price=Decimal(rng.randint(100, 100_000)) / 100, stock=rng.randint(0, 1000))
+                for index in range(start, min(start + BATCH_SIZE, rows))
+            ])
+        customers = []
+        for start in range(0, rows, BATCH_SIZE):
+            customers += Customer.objects.bulk_create([
+                Customer(name=f'{rng.choice(WORDS)} {index}', email=f'audit-{tag}-{index}@example.com',
+                         address='audit')
+                for index in range(start, min(start + BATCH_SIZE, rows))
+            ])
+        sales = []
+        for start in range(0, rows * 2, BATCH_SIZE):
+            sales += Sale.objects.bulk_create([
+                Sale(customer=rng.choice(customers), status=rng.choice(STATUSES), total_amount=0)
+                for _ in range(start, min(start + BATCH_SIZE, rows * 2))
+            ])
+        # auto_now_add dates every row now, spread them over the last DAYS days
+        now = timezone.now()
+        for day in range(DAYS):
+            date = now - datetime.timedelta(days=day + 1)
+            for model, objects in ((Product, products), (Customer, customers), (Sale, sales)):
+                fields = {'sale_date': date} if model is Sale else {}
+                model.objects.filter(pk__in=[obj.pk for obj in objects[day::DAYS]]).update(
+                    created_at=date, updated_at=date, **fields)
+            for sale in sales[day::DAYS]:
+                # Copied to the items below
+                sale.sale_date = date
+        for start in range(0, len(sales), BATCH_SIZE):
+            items = []
+            for sale in sales[start:start + BATCH_SIZE]:
+                for product in rng.sample(products, rng.randint(1, 3)):
+                    quantity = rng.randint(1, 5)
+                    items.append(SaleItem(sale=sale, product=product, quantity=quantity,
+                                          unit_price=product.price, total_price=quantity * product.price))
+            SaleItem.objects.bulk_create(items)
+        self.stdout.write(f'Seeded {len(products)} products, {len(customers)} customers and {len(sales)} sales')
+
+    def analyze(self):
+        """Bring the planner's statistics (and on PostgreSQL the table sizes) up to date."""
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'p')")
+                self.table_rows = dict(cursor.fetchall())
+            else:
+                self.table_rows = {}
+                for table in connection.introspection.table_names(cursor):
+                    cursor.execute(f'SELECT count(*) FROM {connection.ops.quote_name(table)}')
+                    self.table_rows[table] = cursor.fetchone()[0]
+
+    def ids(self):
+        """Sample values for the query strings."""
+        product = Product.objects.order_by('pk').first()
+        name = product.name.split()[0] if product else 'audit'
+        return {
+            'category': Category.objects.values_list('pk', flat=True).order_by('pk').first(),
+            'product': product.pk if product else None,
+            'term': name[:4],
+            'date': (timezone.localdate() - datetime.timedelta(days=7)).isoformat(),
+        }
+
+    def requests(self):
+        """(name, path, params) of the GET requests to audit."""
+        ids = self.ids()
+        for name, pattern in named_patterns(get_resolver().namespace_dict['products'][1]):
+            # Only ever posted to from the list and form pages
+            if name.endswith('_delete'):
+                continue
+            view, model = view_model(pattern.callback)
+            actions = getattr(pattern.callback, 'actions', None)
+            if 'get' not in actions if actions is not None else not hasattr(view, 'get'):
+                continue
+            kwargs = {}
+            if 'pk' in pattern.pattern.regex.groupindex:
+                pk = model._default_manager.order_by('pk').values_list('pk', flat=True).first()
+                if pk is None:
+                    continue
+                kwargs['pk'] = pk
+            path = reverse(f'products:{name}', kwargs=kwargs)
+            variants = [{}]
+            # Filters and search apply to lists and exports
+            if (actions or {}).get('get') in ('list', 'export'):
+                for field in getattr(view, 'filterset_fields', None) or ():
+                    value = model._default_manager.order_by('pk').values_list(field, flat=True).first()
+                    if value is not None:
+                        variants.append({field: value})
+                if getattr(view, 'search_fields', None):
+                    variants.append({'search': ids['term']})
+            variants += EXTRA_PARAMS.get(name, lambda ids: [])(ids)
+            if name.endswith('-export'):
+                variants = [dict(params, limit=100) for params in variants]
+            for params in variants:
+                yield name, path, params
+
+    def audit(self):
+        user = get_user_model().objects.create_superuser(f'audit-{uuid.uuid4().hex[:8]}', password=None)
+        client = Client()
+        # The seeded rows are only on the primary until the rollback
+        client.cookies[routing.PIN_COOKIE] = '1'
+        client.force_login(user)
+        failures = 0
+        caches = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                              'LOCATION': 'audit_query_plans'}}
+        with override_settings(CACHES=caches, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            # The in-process typeahead answers from memory once built, build it now
+            for index in autocomplete.INDEXES.values():
+                index.refresh(force=True)
+            for name, path, params in self.requests():
+                queries = []
+
+                def capture(execute, sql, sql_params, many, context):
+                    if sql.lstrip().upper().startswith(('SELECT', 'WITH')) and (sql, sql_params) not in queries:
+                        queries.append((sql, sql_params))
+                    return execute(sql, sql_params, many, context)
+
+                with connection.execute_wrapper(capture):
+                    next_url = self.get(client, path, params)
+                    if next_url:
+                        # A deeper page, through the keyset cursor
+                        self.get(client, next_url, {})
+                query = '&'.join(f'{key}={value}' for key, value in params.items())
+                label = f'GET {path}?{query}' if query else f'GET {path}'
+                scans = [scan for sql, sql_params in queries for scan in self.scans(sql, sql_params)]
+                failed = [scan for scan in scans if not scan[2]]
+                failures += len(failed)
+                style = self.style.ERROR if failed else self.style.SUCCESS
+                self.stdout.write(style(f'{label:70} {len(queries):3} queries, {len(failed)} scans'))
+                for table, sql, allowed in scans:
+                    if not allowed:
+                        self.stdout.write(f'    scans {table} ({self.table_rows[table]:.0f} rows): {sql}')
+                    elif self.verbosity > 1:
+                        self.stdout.write(f'    scans {table}, counted, limited or mostly kept: {sql}')
+        return failures
+
+    def get(self, client, path, params):
+        """Request ``path``, returning the ``next`` link of a JSON page."""
+        response = client.get(path, params)
+        if response.streaming:
+            b''.join(response.streaming_content)
+            return None
+        if response.status_code >= 400:
+            raise CommandError(f'GET {path} {params}: {response.status_code} {response.content[:200]!r}')
+        if response.get('Content-Type', '').startswith('application/json'):
+            data = json.loads(response.content or 'null')
+            if isinstance(data, dict) and isinstance(data.get('next'), str):
+                return data['next']
+        return None
+
+    def large(self, table):
+        return self.table_rows.get(table, 0) > self.threshold
+
+    def scans(self, sql, params):
+        """(table, sql, allowed) for each large table the query reads in full."""
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                for node, parents in plan_nodes(plan[0]['Plan']):
+                    if node['Node Type'] not in SCAN_NODES or not self.large(node['Relation Name']):
+                        continue
+                    table = node['Relation Name']
+                    # Parallel workers and the partitions of a table are read like one scan
+                    parents = [parent for parent in parents if parent['Node Type'] not in PASSTHROUGH_NODES]
+                    # A filter keeping most of the table is cheaper to apply to a scan than through an index
+                    if 'Filter' in node and node['Plan Rows'] * 2 > self.table_rows[table]:
+                        yield table, sql, True
+                        continue
+                    yield table, sql, 'Filter' not in node and bool(parents) and (
+                        # The first rows, or the whole table hashed for a join
+                        parents[-1]['Node Type'] in ('Limit', 'Hash')
+                        # or counted or summed as a whole
+                        or all(parent['Node Type'] in JOIN_NODES or parent['Node Type'] == 'Aggregate'
+                               and 'Group Key' not in parent for parent in parents))
+            else:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                details = [row[-1] for row in cursor.fetchall()]
+                # The statement without its subqueries, whose tables are aliased
+                outer = sql
+                while outer != (outer := _parenthesized.sub('', outer)):
+                    pass
+                # Read in full or in the order of the scan itself (rowid), not filtered or sorted
+                unfiltered = ' WHERE ' not in outer and not any('TEMP B-TREE' in detail for detail in details)
+                aliases = dict((alias, table) for table, alias in _alias.findall(sql))
+                for detail in details:
+                    if not detail.startswith('SCAN ') or ' USING ' in detail or 'VIRTUAL TABLE' in detail:
+                        continue
+                    table = detail.split()[1]
+                    if self.large(aliases.get(table, table)):
+                        yield aliases.get(table, table), sql, unfiltered and table not in aliases
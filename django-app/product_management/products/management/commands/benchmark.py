@@ -0,0 +1,1020 @@
+import datetime
+import io
+import itertools
+import json
+import uuid
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import Sum
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from product_management.postgresql_pool.base import Pool, PoolTimeout
+from products import (
+    autocomplete, fastread, ingest, pagination, querycache, routing, search, sessions, stock, transactions,
+    writebehind
+)
+from products.parsers import FastJSONParser, MessagePackParser
+from products.renderers import FastJSONRenderer, MessagePackRenderer
+from products.models import Category, Product, Customer, Sale, SaleItem, PendingSale
+from products.serializers import SaleSerializer
+from products.views import CustomerViewSet, ProductViewSet, SaleItemViewSet, SaleViewSet
+
+BENCHMARK_EMAIL = 'benchmark@example.com'
+INITIAL_STOCK = 1_000_000
+RETRIES = 20
+DERIVED_TABLES = (
+    'products_dailysales', 'products_dailyproductsales', 'products_dailycategorysales',
+    'products_bestsellersummary',
+)
+
+def is_transaction_control(sql):
+    return sql.split(' ', 1)[0] in ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')
+
+class Command(BaseCommand):
+    help = 'Runs a performance benchmark against the configured database'
+
+    scenarios = ['sale_create', 'bulk_ingest', 'hot_sku', 'write_behind', 'serializers', 'query_counts',
+                 'deep_pages', 'projections', 'conditional_get',
+                 'export', 'renderers', 'search', 'autocomplete', 'replicas', 'db_pool',
+                 'request_transactions', 'sessions', 'queryset_cache']
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=self.scenarios)
+        parser.add_argument('--sales', type=int, default=200, help='Number of sales to create')
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent workers')
+        parser.add_argument('--products', type=int, default=3, help='Products shared by all sales')
+        parser.add_argument('--lines', type=int, default=3, help='Line items per sale')
+        parser.add_argument('--shards', type=int, default=8, help='Stock shards for hot_sku')
+        parser.add_argument('--hold-ms', type=float, default=0,
+                            help='Keep each hot_sku sale transaction open this long after its writes')
+        parser.add_argument('--catalog', type=int, default=100_000, help='Products for search and autocomplete')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.category = Category.objects.create(name='benchmark', description='benchmark fixtures')
+        self.products = [
+            Product.objects.create(
+                name=f'benchmark-{index}', description='benchmark', category=self.category,
+                price=Decimal('100.00'), stock=INITIAL_STOCK
+            )
+            for index in range(options['products'])
+        ]
+        self.customer, _ = Customer.objects.get_or_create(
+            email=BENCHMARK_EMAIL, defaults={'name': 'benchmark', 'address': 'benchmark'})
+        try:
+            getattr(self, f'bench_{options["scenario"]}')()
+        finally:
+            self.category.delete()
+            self.customer.delete()
+
+    def sale_payload(self, products=None, customer=None):
+        products = products or self.products
+        return {
+            'customer': (customer or self.customer).pk,
+            'total_amount': '0',
+            'status': 'completed',
+            'items': [
+                {'product': random.choice(products).pk, 'quantity': random.randint(1, 3)}
+                for _ in range(self.options['lines'])
+            ],
+        }
+
+    def sale_serializer(self, products=None, customer=None):
+        payload = self.sale_payload(products, customer)
+        serializer = SaleSerializer(data=payload, context={'items': payload['items']})
+        serializer.is_valid(raise_exception=True)
+        return serializer
+
+    def create_sale(self, products=None, customer=None):
+        return self.sale_serializer(products, customer).save()
+
+    def lost_updates(self):
+        """Count benchmark products whose stock does not match what was sold."""
+        sold = dict(SaleItem.objects.filter(product__category=self.category).values_list(
+            'product_id').order_by().annotate(total=Sum('quantity')))
+        lost = 0
+        for product in Product.objects.with_stock().filter(category=self.category):
+            expected = INITIAL_STOCK - sold.get(product.pk, 0)
+            if product.available_stock != expected:
+                lost += 1
+                self.stdout.write(self.style.ERROR(
+                    f'{product.name}: stock {product.available_stock}, expected {expected}'))
+        return lost
+
+    def run_concurrently(self, work, count):
+        """Run ``work()`` ``count`` times over the worker threads, retrying lock timeouts."""
+        threads = self.options['threads']
+        failures = []
+
+        def worker(iterations):
+            try:
+                for _ in range(iterations):
+                    for attempt in range(RETRIES):
+                        try:
+                            work()
+                            break
+                        except OperationalError as exc:
+                            # SQLite reports lock conflicts instead of waiting
+                            if attempt == RETRIES - 1:
+                                failures.append(exc)
+                            time.sleep(random.uniform(0, 0.01 * (attempt + 1)))
+            finally:
+                connection.close()
+
+        pool = [
+            threading.Thread(target=worker, args=(count // threads + (index < count % threads),))
+            for index in range(threads)
+        ]
+        started = time.perf_counter()
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        return time.perf_counter() - started, failures
+
+    def bench_sale_create(self):
+        lines = self.options['lines']
+        self.create_sale()  # warm up: creates today's rollup and summary rows
+        serializer = self.sale_serializer()
+        with CaptureQueriesContext(connection) as queries:
+            serializer.save()
+        statements = [query['sql'] for query in queries if not is_transaction_control(query['sql'])]
+        derived = [sql for sql in statements if any(table in sql for table in DERIVED_TABLES)]
+        self.stdout.write(
+            f'Statements per {lines}-line sale: {len(statements) - len(derived)} on sales and '
+            f'products (the per-row path issued 2N+2 = {2 * lines + 2}), '
+            f'plus {len(derived)} maintaining rollups and best-seller summaries'
+        )
+
+        elapsed, failures = self.run_concurrently(self.create_sale, self.options['sales'])
+        lost = self.lost_updates()
+        created = self.options['sales'] - len(failures)
+        self.stdout.write(
+            f'{created} sales on {len(self.products)} hot products with '
+            f'{self.options["threads"]} threads in {elapsed:.2f}s '
+            f'({created / elapsed:.1f} sales/s), {len(failures)} failed'
+        )
+        if lost:
+            self.stdout.write(self.style.ERROR(f'Lost stock updates on {lost} products'))
+        else:
+            self.stdout.write(self.style.SUCCESS('No lost stock updates'))
+
+    def bench_bulk_ingest(self):
+        count = self.options['sales']
+        client = Client()
+
+        started = time.perf_counter()
+        for _ in range(count):
+            response = client.post('/api/sales/', json.dumps(self.sale_payload()),
+                                   content_type='application/json')
+            assert response.status_code == 200, response.content
+        single = time.perf_counter() - started
+
+        body = '\n'.join(json.dumps(self.sale_payload()) for _ in range(count))
+        started = time.perf_counter()
+        response = client.post('/api/sales/bulk/', body, content_type='application/x-ndjson')
+        bulk = time.perf_counter() - started
+        assert response.status_code == 200 and response.json()['created'] == count, response.content
+
+        self.stdout.write(f'/api/sales/:      {count} sales in {single:.2f}s ({count / single:.1f} sales/s)')
+        self.stdout.write(f'/api/sales/bulk/: {count} sales in {bulk:.2f}s ({count / bulk:.1f} sales/s)')
+        self.stdout.write(self.style.SUCCESS(f'Bulk speedup: {single / bulk:.1f}x'))
+
+    def bench_hot_sku(self):
+        count, threads = self.options['sales'], self.options['threads']
+        hot = self.products[:1]
+        # A customer per worker, so that the sales only share the product's rows
+        customers = [
+            Customer.objects.get_or_create(email=f'hot-{index}-{BENCHMARK_EMAIL}', defaults={
+                'name': 'benchmark', 'address': 'benchmark'})[0]
+            for index in range(threads)
+        ]
+        workers, local = itertools.count(), threading.local()
+
+        def sale():
+            if not hasattr(local, 'customer'):
+                local.customer = customers[next(workers) % threads]
+            with transaction.atomic():
+                self.create_sale(hot, local.customer)
+                # Row locks are held until commit, as in a request that does more work
+                time.sleep(self.options['hold_ms'] / 1000)
+
+        self.create_sale(hot)  # warm up
+        rates = {}
+        try:
+            for shards in (0, self.options['shards']):
+                stock.shard(hot[0].pk, shards)
+                elapsed, failures = self.run_concurrently(sale, count)
+                created = count - len(failures)
+                rates[shards] = created / elapsed
+                self.stdout.write(
+                    f'{shards or "no"} shards: {created} sales of one product with {threads} '
+                    f'threads in {elapsed:.2f}s ({rates[shards]:.1f} sales/s), {len(failures)} failed'
+                )
+
+            lost = self.lost_updates()
+            if lost:
+                self.stdout.write(self.style.ERROR(f'Lost stock updates on {lost} products'))
+            else:
+                self.stdout.write(self.style.SUCCESS(
+                    f'No lost stock updates; sharded speedup {rates[self.options["shards"]] / rates[0]:.2f}x'))
+        finally:
+            Customer.objects.filter(pk__in=[customer.pk for customer in customers]).delete()
+
+    def post_sales(self, count):
+        """POST ``count`` sales to /api/sales/ over the worker threads; return the latencies."""
+        latencies = []
+
+        def post():
+            payload = self.sale_payload()
+            started = time.perf_counter()
+            response = Client().post('/api/sales/', json.dumps(payload),
+                                     content_type='application/json')
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code in (200, 202), response.content
+
+        elapsed, failures = self.run_concurrently(post, count)
+        return elapsed, failures, latencies
+
+    def report_latencies(self, label, count, elapsed, failures, latencies):
+        percentiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f'{label}: {count - len(failures)} sales in {elapsed:.2f}s '
+            f'({(count - len(failures)) / elapsed:.1f} sales/s), '
+            f'p50 {percentiles[49] * 1000:.1f}ms, p99 {percentiles[98] * 1000:.1f}ms, '
+            f'{len(failures)} failed'
+        )
+
+    def bench_write_behind(self):
+        count = self.options['sales']
+        self.create_sale()  # warm up
+        try:
+            self.report_latencies('synchronous ', count, *self.post_sales(count))
+            with override_settings(SALES_WRITE_BEHIND=True):
+                self.report_latencies('write-behind', count, *self.post_sales(count))
+
+            started = time.perf_counter()
+            while writebehind.drain():
+                pass
+            drained = time.perf_counter() - started
+            queued = PendingSale.objects.filter(payload__customer=self.customer.pk)
+            created = queued.filter(status='created').count()
+            self.stdout.write(
+                f'queue drained: {created} sales written in {drained:.2f}s '
+                f'({created / drained:.1f} sales/s in group commits of {writebehind.BATCH_SIZE})'
+            )
+            if created != queued.count():
+                self.stdout.write(self.style.ERROR(f'{queued.count() - created} queued sales failed'))
+            elif self.lost_updates():
+                self.stdout.write(self.style.ERROR('Lost stock updates'))
+            else:
+                self.stdout.write(self.style.SUCCESS('All queued sales written, no lost stock updates'))
+        finally:
+            PendingSale.objects.filter(payload__customer=self.customer.pk).delete()
+
+    def bench_serializers(self):
+        list(ingest.ingest_sales(self.sale_payload() for _ in range(self.options['sales'])))
+        context = {'request': Request(APIRequestFactory().get('/api/'))}
+        renderer = JSONRenderer()
+        mismatches = 0
+        for viewset in (ProductViewSet, CustomerViewSet, SaleViewSet, SaleItemViewSet):
+            serializer_class = viewset.serializer_class
+            queryset = viewset.queryset.order_by('pk')
+
+            started = time.perf_counter()
+            expected = renderer.render(serializer_class(queryset, many=True, context=context).data)
+            slow = time.perf_counter() - started
+            started = time.perf_counter()
+            actual = renderer.render(fastread.serialize(serializer_class, queryset, context))
+            fast = time.perf_counter() - started
+
+            self.stdout.write(
+                f'{serializer_class.__name__}: {queryset.count()} rows, serializer {slow * 1000:.1f}ms, '
+                f'fast read {fast * 1000:.1f}ms ({slow / fast:.1f}x)'
+            )
+            if actual != expected:
+                mismatches += 1
+                self.stdout.write(self.style.ERROR(f'{serializer_class.__name__}: output differs'))
+        if mismatches:
+            self.stdout.write(self.style.ERROR(f'{mismatches} serializers differ'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Fast read output is byte-identical'))
+
+    def endpoint_queries(self):
+        """Queries issued by each sales, product and customer endpoint."""
+        client = Client()
+        sale = Sale.objects.filter(customer=self.customer).latest('pk')
+        product = self.products[0]
+        payload = json.dumps(self.sale_payload())
+        requests = {
+            'GET /api/products/': ('get', f'/api/products/?category={self.category.pk}'),
+            'GET /api/products/<id>/': ('get', f'/api/products/{product.pk}/'),
+            'GET /api/products/low_stock/': ('get', '/api/products/low_stock/'),
+            'GET /api/categories/<id>/products/': ('get', f'/api/categories/{self.category.pk}/products/'),
+            'GET /api/customers/<id>/purchase_history/':
+                ('get', f'/api/customers/{self.customer.pk}/purchase_history/'),
+            'GET /api/sales/': ('get', f'/api/sales/?customer={self.customer.pk}'),
+            'GET /api/sales/<id>/': ('get', f'/api/sales/{sale.pk}/'),
+            'GET /api/sale-items/': ('get', f'/api/sale-items/?sale={sale.pk}'),
+            'POST /api/sales/': ('post', '/api/sales/', payload),
+            'PATCH /api/sales/<id>/': ('patch', f'/api/sales/{sale.pk}/', json.dumps({'status': 'completed'})),
+        }
+        counts = {}
+        for label, (method, url, *body) in requests.items():
+            with CaptureQueriesContext(connection) as queries:
+                response = getattr(client, method)(url, *body, content_type='application/json')
+            assert response.status_code < 300, (label, response.content)
+            counts[label] = len([query for query in queries if not is_transaction_control(query['sql'])])
+        with CaptureQueriesContext(connection) as queries:
+            SaleViewSet.build_dashboard_stats()
+        counts['dashboard_stats (uncached)'] = len(queries)
+        return counts
+
+    def bench_query_counts(self):
+        """Query counts must not depend on how many rows or nested items an endpoint returns."""
+        self.options['lines'] = 1
+        list(ingest.ingest_sales([self.sale_payload()]))
+        small = self.endpoint_queries()
+
+        self.products += [
+            Product.objects.create(
+                name=f'benchmark-extra-{index}', description='benchmark', category=self.category,
+                price=Decimal('10.00'), stock=INITIAL_STOCK
+            )
+            for index in range(10)
+        ]
+        self.options['lines'] = 10
+        list(ingest.ingest_sales(self.sale_payload() for _ in range(20)))
+        large = self.endpoint_queries()
+
+        changed = 0
+        for label, count in small.items():
+            self.stdout.write(f'{label:45} {count:3} queries, {large[label]:3} with more rows')
+            if large[label] != count:
+                changed += 1
+                self.stdout.write(self.style.ERROR(f'{label}: query count grows with the rows returned'))
+        if changed:
+            self.stdout.write(self.style.ERROR(f'{changed} endpoints have N+1 queries'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Query counts are constant'))
+
+    def bench_deep_pages(self):
+        count = self.options['sales']
+        list(ingest.ingest_sales(self.sale_payload() for _ in range(count)))
+        reader = fastread.reader_for(SaleSerializer)
+        sales = Sale.objects.filter(customer=self.customer).order_by('pk')
+        size = 10
+        last_page = max(count // size, 2)
+        boundary = sales.values_list('pk', flat=True)[(last_page - 1) * size - 1]
+        factory = APIRequestFactory()
+
+        def best_of(paginator_class, query):
+            timings = []
+            for _ in range(5):
+                paginator = paginator_class()
+                paginator.page_size = size
+                request = Request(factory.get(f'/api/sales/?{query}'))
+                started = time.perf_counter()
+                reader.convert(paginator.paginate_queryset(reader.rows(sales), request), {})
+                timings.append(time.perf_counter() - started)
+            return min(timings) * 1000
+
+        cursor = pagination.encode_cursor([boundary])
+        rows = [
+            ('page number, page 1', best_of(PageNumberPagination, 'page=1')),
+            (f'page number, page {last_page}', best_of(PageNumberPagination, f'page={last_page}')),
+            ('keyset, page 1', best_of(pagination.KeysetPagination, 'count=false')),
+            (f'keyset, page {last_page}', best_of(pagination.KeysetPagination, f'count=false&cursor={cursor}')),
+        ]
+        for label, elapsed in rows:
+            self.stdout.write(f'{label:30} {elapsed:8.2f}ms')
+
+    def bench_projections(self):
+        list(ingest.ingest_sales(self.sale_payload() for _ in range(self.options['sales'])))
+        client = Client()
+        page = 'page_size=100&count=false'
+        projections = [
+            ('/api/products/', ''),
+            ('/api/products/', 'fields=id,name,price,stock'),
+            ('/api/sales/', ''),
+            ('/api/sales/', 'fields=id,customer,sale_date,total_amount,status'),
+            ('/api/sales/', 'fields=id,customer,total_amount&expand=customer'),
+            ('/api/sale-items/', ''),
+            ('/api/sale-items/', 'fields=id,product,quantity'),
+        ]
+        for url, query in projections:
+            timings = []
+            for _ in range(5):
+                started = time.perf_counter()
+                response = client.get(f'{url}?{page}&{query}')
+                timings.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.content
+            self.stdout.write(
+                f'{url + ("?" + query if query else " (all fields)"):70} {len(response.content):8} bytes '
+                f'{statistics.median(timings) * 1000:7.1f}ms'
+            )
+
+    @override_settings(CONDITIONAL_GET=True)
+    def bench_conditional_get(self):
+        list(ingest.ingest_sales(self.sale_payload() for _ in range(self.options['sales'])))
+        sales = Sale.objects.filter(customer=self.customer)
+
+        def delete_product():
+            Product.objects.create(name='benchmark-deleted', description='benchmark',
+                                   category=self.category, price=Decimal('1.00')).delete()
+
+        def delete_category():
+            Category.objects.create(name='benchmark-deleted').delete()
+
+        client = Client()
+        stale = 0
+        endpoints = [
+            ('/api/products/?page_size=100', delete_product),
+            ('/api/categories/?page_size=100', delete_category),
+            ('/api/sales/?page_size=100&expand=customer', lambda: sales.first().delete()),
+            ('/api/sales/dashboard_stats/', lambda: sales.first().delete()),
+        ]
+        for url, delete in endpoints:
+            response = client.get(url)
+            etag, size = response['ETag'], len(response.content)
+            timings = {200: [], 304: []}
+            for _ in range(5):
+                for headers in ({}, {'HTTP_IF_NONE_MATCH': etag}):
+                    started = time.perf_counter()
+                    response = client.get(url, **headers)
+                    timings[response.status_code].append(time.perf_counter() - started)
+            self.stdout.write(
+                f'{url:45} 200: {statistics.median(timings[200]) * 1000:7.1f}ms '
+                f'{size} bytes, 304: {statistics.median(timings[304]) * 1000:7.1f}ms'
+            )
+
+            # Deleting a row the response reads must change its validator
+            delete()
+            if client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 304:
+                stale += 1
+                self.stdout.write(self.style.ERROR(f'{url}: 304 after a delete'))
+        if not stale:
+            self.stdout.write(self.style.SUCCESS('Every validator changed after a delete'))
+
+    def bench_export(self):
+        list(ingest.ingest_sales(self.sale_payload() for _ in range(self.options['sales'])))
+        client = Client()
+
+        def follow(url):
+            """Export ``url`` following its next links; return (lines, bytes, responses)."""
+            lines = size = responses = 0
+            while url:
+                response = client.get(url)
+                assert response.status_code == 200, response.content
+                for chunk in response.streaming_content:
+                    lines += chunk.count(b'\n')
+                    size += len(chunk)
+                responses += 1
+                link = response.get('Link')
+                url = link and link[1:link.index('>')]
+            return lines, size, responses
+
+        customer = f'customer={self.customer.pk}'
+        for url in [f'/api/sales/export/?{customer}', f'/api/sales/export/?{customer}&format=csv',
+                    '/api/sale-items/export/?format=csv', f'/api/sales/export/?{customer}&limit=100']:
+            started = time.perf_counter()
+            lines, size, responses = follow(url)
+            elapsed = time.perf_counter() - started
+            # Traced separately, tracemalloc slows everything down
+            tracemalloc.start()
+            follow(url)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.stdout.write(
+                f'{url:50} {lines:8} lines {size / 2 ** 20:6.1f} MiB in {responses:3} responses '
+                f'{lines / elapsed:8.0f} lines/s, peak memory {peak / 2 ** 20:5.1f} MiB'
+            )
+
+    def bench_renderers(self):
+        list(ingest.ingest_sales(self.sale_payload() for _ in range(self.options['sales'])))
+        context = {'request': Request(APIRequestFactory().get('/api/'))}
+        data = fastread.serialize(SaleSerializer, Sale.objects.filter(customer=self.customer), context)
+        json_renderer, fast_renderer, msgpack_renderer = JSONRenderer(), FastJSONRenderer(), MessagePackRenderer()
+        json_parser, fast_parser, msgpack_parser = JSONParser(), FastJSONParser(), MessagePackParser()
+        encoded = {'json': json_renderer.render(data), 'msgpack': msgpack_renderer.render(data)}
+        rows = [
+            ('encode', 'JSONRenderer', lambda: json_renderer.render(data)),
+            ('encode', 'FastJSONRenderer', lambda: fast_renderer.render(data)),
+            ('encode', 'MessagePackRenderer', lambda: msgpack_renderer.render(data)),
+            ('decode', 'JSONParser', lambda: json_parser.parse(io.BytesIO(encoded['json']))),
+            ('decode', 'FastJSONParser', lambda: fast_parser.parse(io.BytesIO(encoded['json']))),
+            ('decode', 'MessagePackParser', lambda: msgpack_parser.parse(io.BytesIO(encoded['msgpack']))),
+        ]
+        self.stdout.write(f'{len(data)} sales: {len(encoded["json"])} bytes as JSON, '
+                          f'{len(encoded["msgpack"])} bytes as MessagePack')
+        for direction, name, run in rows:
+            timings = []
+            for _ in range(20):
+                started = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - started)
+            size = len(encoded['msgpack' if 'MessagePack' in name else 'json'])
+            self.stdout.write(f'{direction} {name:20} {min(timings) * 1000:8.2f}ms '
+                              f'{size / min(timings) / 2 ** 20:8.1f} MiB/s')
+
+    def create_catalog(self):
+        """``--catalog`` products with names drawn from a small Japanese and English vocabulary."""
+        words = ['ワイヤレス', 'イヤホン', '電動', '歯ブラシ', 'ステンレス', '水筒', 'wireless', 'black',
+                 'stainless', 'bottle', 'organic', 'cotton', 'LED', 'desk', 'lamp', '限定', 'pro', 'mini']
+        rng = random.Random(0)
+        catalog = []
+        started = time.perf_counter()
+        for start in range(0, self.options['catalog'], 10_000):
+            catalog += Product.objects.bulk_create([
+                Product(name=' '.join(rng.sample(words, 3)) + f' {index}',
+                        description=' '.join(rng.sample(words, 6)), category=self.category,
+                        price=Decimal('100.00'))
+                for index in range(start, min(start + 10_000, self.options['catalog']))
+            ])
+        # As if loaded earlier, not within the typeahead's refresh overlap
+        Product.objects.filter(category=self.category).update(updated_at=timezone.now() - datetime.timedelta(days=1))
+        self.stdout.write(f'{len(catalog)} products created in {time.perf_counter() - started:.1f}s')
+        return catalog
+
+    def delete_catalog(self, catalog):
+        pks = [product.pk for product in catalog]
+        for start in range(0, len(pks), 10_000):
+            Product.objects.filter(pk__in=pks[start:start + 10_000]).delete()
+
+    def bench_search(self):
+        catalog = self.create_catalog()
+
+        def best_of(queryset):
+            timings = []
+            for _ in range(3):
+                started = time.perf_counter()
+                pks = list(queryset.values_list('pk', flat=True))
+                timings.append(time.perf_counter() - started)
+            return pks, min(timings) * 1000
+
+        mismatches = 0
+        try:
+            for text in ['ワイヤレス', '歯ブラシ 限定', 'stainless bottle', 'LED lamp 4242', 'pro', '電動', '4242']:
+                fields = search.search_fields(Product)
+                scan = Product.objects.order_by('pk')
+                for word in search.terms(text):
+                    scan = scan.filter(search._contains(fields, word))
+                expected, scan_ms = best_of(scan)
+                found, search_ms = best_of(search.search(Product.objects.all(), text))
+                if set(found) != set(expected):
+                    mismatches += 1
+                    self.stdout.write(self.style.ERROR(f'{text}: search and icontains disagree'))
+                self.stdout.write(f'{text:20} {len(found):8} matches  icontains {scan_ms:9.1f}ms  '
+                                  f'search {search_ms:9.1f}ms')
+        finally:
+            self.delete_catalog(catalog)
+        if mismatches:
+            self.stdout.write(self.style.ERROR(f'{mismatches} searches differ from icontains'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Search matches the same rows as icontains'))
+
+    def bench_autocomplete(self):
+        catalog = self.create_catalog()
+        index = autocomplete.TypeaheadIndex(Product)
+        failures = 0
+        try:
+            started = time.perf_counter()
+            index.refresh(force=True)
+            stats = index.stats()
+            self.stdout.write(
+                f'index built in {time.perf_counter() - started:.2f}s: {stats["entries"]} entries, '
+                f'{stats["ngrams"]} n-grams, {stats["bytes"] / 2 ** 20:.1f} MiB '
+                f'({stats["bytes"] / max(stats["entries"], 1):.0f} bytes per entry)'
+            )
+
+            for text in ['ワ', 'わいやれす', 'ﾜｲﾔﾚｽ ｲﾔﾎﾝ', 'stain', 'desk lamp', 'LED 4242', '42', '歯ブラシ 限定', 'zzz']:
+                timings = []
+                for _ in range(200):
+                    started = time.perf_counter()
+                    results = index.lookup(text)
+                    timings.append(time.perf_counter() - started)
+                timings.sort()
+                terms = autocomplete.normalize(text).split()
+                wrong = [row['name'] for row in results
+                         if not all(term in autocomplete.normalize(row['name']) for term in terms)]
+                scan = Product.objects.all()
+                for term in text.split():
+                    scan = scan.filter(name__icontains=term)
+                # icontains does not fold kana or width, it only tells whether a match exists
+                if wrong or (not results and scan.exists()):
+                    failures += 1
+                    self.stdout.write(self.style.ERROR(f'{text}: wrong matches {wrong[:3]}'))
+                self.stdout.write(f'{text:20} {len(results):3} results  p50 {timings[100] * 1e6:7.1f}us  '
+                                  f'p99 {timings[198] * 1e6:7.1f}us')
+
+            # Renames reach the index through updated_at, deletes through the row count
+            renamed, deleted = catalog[:100], catalog[100:200]
+            for product in renamed:
+                product.name = f'改名 {product.pk}'
+                product.save(update_fields=['name', 'updated_at'])
+            Product.objects.filter(pk__in=[product.pk for product in deleted]).delete()
+            started = time.perf_counter()
+            index.refresh(force=True)
+            elapsed = time.perf_counter() - started
+            found = {row['id'] for row in index.lookup('改名', autocomplete.MAX_LIMIT)}
+            missing = {product.pk for product in renamed[:autocomplete.MAX_LIMIT]} - found
+            stale = [product.pk for product in deleted if product.pk in index.slots]
+            if missing or stale:
+                failures += 1
+                self.stdout.write(self.style.ERROR(
+                    f'after refresh: {len(missing)} renames missing, {len(stale)} deleted rows left'))
+            self.stdout.write(f'incremental refresh of 100 renames and 100 deletes: {elapsed * 1000:.1f}ms')
+        finally:
+            self.delete_catalog(catalog[200:] + catalog[:100])
+        if failures:
+            self.stdout.write(self.style.ERROR(f'{failures} typeahead checks failed'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Typeahead matches are correct and refreshed incrementally'))
+
+    def databases_read(self, request):
+        """Aliases the queries of ``request()`` ran on, and its response."""
+        used = set()
+
+        def record(alias):
+            def wrapper(execute, sql, params, many, context):
+                if not is_transaction_control(sql):
+                    used.add(alias)
+                return execute(sql, params, many, context)
+            return wrapper
+
+        wrappers = [connections[alias].execute_wrapper(record(alias)) for alias in connections]
+        for wrapper in wrappers:
+            wrapper.__enter__()
+        try:
+            response = request()
+        finally:
+            for wrapper in reversed(wrappers):
+                wrapper.__exit__(None, None, None)
+        return used, response
+
+    def bench_replicas(self):
+        replicas = routing.replicas()
+        if not replicas:
+            self.stdout.write(self.style.WARNING('Set DATABASE_REPLICA_HOSTS to route reads to replicas'))
+            return
+        list(ingest.ingest_sales(self.sale_payload() for _ in range(self.options['sales'])))
+        products = '/api/products/?page_size=100'
+        writer = Client()
+
+        def get(client, url):
+            return lambda: client.get(url)
+
+        def post(client):
+            return lambda: client.post('/api/sales/', self.sale_payload(), content_type='application/json')
+
+        # (label, request, expected database, settings); a lag of 0 treats the
+        # writes made above as replicated
+        replicated = {'DATABASE_REPLICA_LAG': 0}
+        cases = [
+            ('GET, nothing written recently', get(Client(), products), 'replica', replicated),
+            ('GET of a primary-only view', get(Client(), '/api/sale-queue/'), 'default', replicated),
+            ('GET with an ETag, products just written', get(Client(), products), 'default',
+             {'CONDITIONAL_GET': True}),
+            ('POST', post(writer), 'default', {}),
+            ('GET after the POST, same client', get(writer, products), 'default', replicated),
+        ]
+        wrong = 0
+        for label, request, expected, overrides in cases:
+            with override_settings(**overrides):
+                started = time.perf_counter()
+                used, response = self.databases_read(request)
+                elapsed = time.perf_counter() - started
+            routed = 'replica' if used and all(alias in replicas for alias in used) else (
+                'default' if used == {'default'} else ', '.join(sorted(used)) or 'nothing')
+            self.stdout.write(f'{label:40} {response.status_code} {routed:10} {elapsed * 1000:7.1f}ms')
+            if routed != expected:
+                wrong += 1
+                self.stdout.write(self.style.ERROR(f'  expected {expected}'))
+        if routing.PIN_COOKIE not in writer.cookies:
+            wrong += 1
+            self.stdout.write(self.style.ERROR('The POST did not pin its client to the primary'))
+        if not wrong:
+            self.stdout.write(self.style.SUCCESS('Reads were routed as expected'))
+
+    def bench_db_pool(self):
+        if connection.vendor != 'postgresql':
+            self.stdout.write(self.style.WARNING('The connection pool is for PostgreSQL'))
+            return
+        params = connection.get_connection_params()
+
+        def connect():
+            return connection.Database.connect(**params)
+
+        def select_one(conn):
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+
+        pool = Pool(max_size=2, timeout=0.2, max_lifetime=60, max_idle=60, check_after=1)
+        timings = {'new connection': [], 'pooled connection': []}
+        for _ in range(50):
+            started = time.perf_counter()
+            conn = connect()
+            select_one(conn)
+            conn.close()
+            timings['new connection'].append(time.perf_counter() - started)
+            started = time.perf_counter()
+            conn = pool.borrow(connect)
+            select_one(conn)
+            pool.give_back(conn)
+            timings['pooled connection'].append(time.perf_counter() - started)
+        for label, values in timings.items():
+            self.stdout.write(f'{label:18} + SELECT 1: p50 {statistics.median(values) * 1000:6.2f}ms')
+
+        failures = []
+        held = [pool.borrow(connect) for _ in range(pool.max_size)]
+        started = time.perf_counter()
+        try:
+            pool.borrow(connect)
+            failures.append('borrowed a connection from an exhausted pool')
+        except PoolTimeout:
+            self.stdout.write(f'exhausted pool: PoolTimeout after {time.perf_counter() - started:.2f}s')
+        waiter = {}
+        thread = threading.Thread(target=lambda: waiter.update(connection=pool.borrow(connect)))
+        thread.start()
+        time.sleep(pool.timeout / 4)
+        pool.give_back(held.pop())
+        thread.join()
+        if 'connection' not in waiter:
+            failures.append('a waiting thread did not get the connection given back')
+        for conn in held + list(waiter.values()):
+            pool.give_back(conn)
+
+        # A connection killed while idle is replaced when borrowed
+        pool.check_after = 0
+        conn = pool.borrow(connect)
+        backend_pid = conn.get_backend_pid()
+        pool.give_back(conn)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s)', [backend_pid])
+        conn = pool.borrow(connect)
+        select_one(conn)
+        pool.give_back(conn)
+
+        # Connections past their lifetime are closed instead of reused
+        connects = pool.stats()['connects']
+        pool.max_lifetime = 0
+        pool.give_back(pool.borrow(connect))
+        stats = pool.stats()
+        pool.close_idle()
+        self.stdout.write(f'pool stats: {stats}')
+        for name, expected in (('timeouts', 1), ('waits', 2), ('failed_checks', 1), ('in_use', 0)):
+            if stats[name] != expected:
+                failures.append(f'{name} is {stats[name]}, expected {expected}')
+        if stats['connects'] != connects + 1 or not stats['recycled']:
+            failures.append('expired connections were reused')
+
+        if hasattr(connection, 'pool'):
+            # Requests from more threads than the pool holds share its connections.
+            # The test client keeps connections open between requests; the
+            # request handler closes them, returning them to the pool
+            def request():
+                Client().get('/api/products/?page_size=10')
+                connection.close()
+
+            elapsed, errors = self.run_concurrently(request, self.options['sales'])
+            stats = connection.pool.stats()
+            self.stdout.write(f'{self.options["threads"]} threads, {self.options["sales"]} requests in '
+                              f'{elapsed:.2f}s, {len(errors)} failed: {stats}')
+            if stats['size'] > stats['max_size']:
+                failures.append(f'the DATABASE_POOL pool holds {stats["size"]} connections')
+
+        for failure in failures:
+            self.stdout.write(self.style.ERROR(failure))
+        if not failures:
+            self.stdout.write(self.style.SUCCESS('The pool bounds, checks and recycles its connections'))
+
+    def round_trips(self, request):
+        """
+        Statements and transactions ``request()`` ran on the default database,
+        and whether its transactions were read-only.
+        """
+        statements, blocks, read_only_blocks = 0, set(), set()
+
+        def record(execute, sql, params, many, context):
+            nonlocal statements
+            statements += 1
+            if connection.in_atomic_block:
+                block = id(connection.atomic_blocks[0])
+                blocks.add(block)
+                if sql.startswith('SET TRANSACTION') and sql.endswith('READ ONLY'):
+                    read_only_blocks.add(block)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            response = request()
+        read_only = {block in read_only_blocks for block in blocks} if connection.vendor == 'postgresql' else set()
+        return statements, len(blocks), read_only, response
+
+    def bench_request_transactions(self):
+        if not any(settings_dict['ATOMIC_REQUESTS'] for settings_dict in connections.settings.values()):
+            self.stdout.write(self.style.WARNING('No database has ATOMIC_REQUESTS; run against PostgreSQL'))
+            return
+        list(ingest.ingest_sales(self.sale_payload() for _ in range(self.options['sales'])))
+        user = get_user_model().objects.create_user(f'benchmark-{uuid.uuid4().hex[:8]}')
+        client = Client()
+        client.force_login(user)
+        product = self.products[0].pk
+        requests = [
+            (f'GET {url}', lambda url=url: client.get(url)) for url in (
+                '/api/products/?page_size=100', f'/api/products/{product}/',
+                '/api/sales/?page_size=100&expand=customer', '/api/sales/timeseries/', '/products/',
+            )
+        ] + [('POST /api/sales/', lambda: client.post(
+            '/api/sales/', self.sale_payload(), content_type='application/json'))]
+
+        failures = []
+        try:
+            for label, request in requests:
+                for mode in transactions.MODES:
+                    with override_settings(SAFE_REQUEST_TRANSACTION=mode):
+                        request()
+                        timings = []
+                        for _ in range(10):
+                            started = time.perf_counter()
+                            statements, transaction_count, read_only, response = self.round_trips(request)
+                            timings.append(time.perf_counter() - started)
+                    self.stdout.write(
+                        f'{label:52} {mode:10} {response.status_code} {statements:3} statements '
+                        f'{transaction_count} transactions {statements + 2 * transaction_count:3} round trips '
+                        f'p50 {statistics.median(timings) * 1000:6.1f}ms')
+                    if label.startswith('POST'):
+                        # Commit hooks may run transactions of their own
+                        if not transaction_count:
+                            failures.append(f'{label} ({mode}): not in a transaction')
+                    elif transaction_count != (mode != 'autocommit'):
+                        failures.append(f'{label} ({mode}): {transaction_count} transactions')
+                    if read_only and read_only != {mode == 'read_only' and label.startswith('GET')}:
+                        failures.append(f'{label} ({mode}): read-only was {read_only}')
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SHOW default_transaction_read_only')
+                    if cursor.fetchone()[0] == 'on':
+                        failures.append('The session was left read-only')
+        finally:
+            user.delete()
+
+        for failure in failures:
+            self.stdout.write(self.style.ERROR(failure))
+        if not failures:
+            self.stdout.write(self.style.SUCCESS('Safe requests ran in their mode, writes in one transaction'))
+
+    def session_queries(self, request):
+        """Reads and writes of the session table made by ``request()``."""
+        counts = {'reads': 0, 'writes': 0}
+
+        def record(execute, sql, params, many, context):
+            if Session._meta.db_table in sql:
+                counts['reads' if sql.startswith('SELECT') else 'writes'] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            request()
+        return counts
+
+    def bench_sessions(self):
+        users = [get_user_model().objects.create_user(f'benchmark-{uuid.uuid4().hex[:8]}') for _ in range(5)]
+        form = {'name': 'benchmark-form', 'description': 'benchmark', 'category': self.category.pk,
+                'price': '10.00', 'stock': 1}
+        page_views = [
+            lambda client: client.get('/products/'),
+            lambda client: client.get('/products/create/'),
+            lambda client: client.post('/products/create/', form, follow=True),
+            lambda client: client.get('/categories/'),
+            lambda client: client.get('/'),
+        ]
+        configurations = [
+            ('database sessions, session messages', {
+                'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+                'MESSAGE_STORAGE': 'django.contrib.messages.storage.session.SessionStorage',
+            }),
+            ('products.sessions, cookie messages', {}),
+        ]
+        # The redirected POST counts as two page views
+        views = (len(page_views) + 1) * len(users) * 10
+        failures = []
+        try:
+            for label, overrides in configurations:
+                with override_settings(**overrides):
+                    sessions.CACHE.clear()
+                    clients = []
+                    for user in users:
+                        clients.append(Client())
+                        clients[-1].force_login(user)
+                    totals = {'reads': 0, 'writes': 0}
+                    started = time.perf_counter()
+                    for _ in range(10):
+                        for client in clients:
+                            for view in page_views:
+                                for key, value in self.session_queries(lambda: view(client)).items():
+                                    totals[key] += value
+                    elapsed = time.perf_counter() - started
+                    response = clients[0].post('/products/create/', form, follow=True)
+                    if b'Product created successfully.' not in response.content:
+                        failures.append(f'{label}: the success message was not shown')
+                self.stdout.write(
+                    f'{label:38} {totals["writes"] / views:5.2f} writes and {totals["reads"] / views:5.2f} '
+                    f'reads of sessions per page view, {elapsed / views * 1000:6.1f}ms per page view')
+
+            # Expiry updates of sessions in use are batched
+            with override_settings(SESSION_TOUCH_INTERVAL=0):
+                sessions.flush_touches()
+                sessions.CACHE.clear()
+                for client in clients:
+                    client.get('/products/')
+                counts = self.session_queries(sessions.flush_touches)
+            self.stdout.write(f'{len(clients)} sessions in use: expiry pushed back with {counts["writes"]} UPDATE')
+            if counts['writes'] != 1:
+                failures.append(f'{counts["writes"]} statements to push back the expiry of {len(clients)} sessions')
+
+            expired = timezone.now() - datetime.timedelta(days=1)
+            Session.objects.bulk_create(
+                Session(session_key=f'benchmark{index:023}', session_data='', expire_date=expired)
+                for index in range(self.options['sales'] * 10)
+            )
+            started = time.perf_counter()
+            deleted = sessions.SessionStore.clear_expired()
+            self.stdout.write(f'purged {deleted} expired sessions in {time.perf_counter() - started:.2f}s')
+            if Session.objects.filter(expire_date__lt=timezone.now()).exists():
+                failures.append('expired sessions were left')
+        finally:
+            for user in users:
+                user.delete()
+            Product.objects.filter(name='benchmark-form').delete()
+
+        for failure in failures:
+            self.stdout.write(self.style.ERROR(failure))
+        if not failures:
+            self.stdout.write(self.style.SUCCESS('Sessions and messages work with the cached backend'))
+
+    @override_settings(QUERYSET_CACHE=True)
+    def bench_queryset_cache(self):
+        product = self.products[0]
+        # The two tiers
+        queryset = self.category.products.with_stock().order_by('pk')
+        timings = {'miss': [], 'shared': [], 'local': []}
+        for _ in range(20):
+            Product.objects.filter(pk=product.pk).update(name=product.name)
+            for tier in timings:
+                if tier == 'shared':
+                    querycache.LOCAL.clear()
+                started = time.perf_counter()
+                list(queryset.cached())
+                timings[tier].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        for _ in range(20):
+            list(queryset.all())
+        uncached = (time.perf_counter() - started) / 20
+        self.stdout.write(
+            f'category products, uncached {uncached * 1000:6.2f}ms, ' + ', '.join(
+                f'{tier} {statistics.median(values) * 1000:6.2f}ms' for tier, values in timings.items()))
+
+        # The endpoints
+        user = get_user_model().objects.create_user(f'benchmark-{uuid.uuid4().hex[:8]}')
+        try:
+            client = Client()
+            client.force_login(user)
+            urls = ['/api/categories/?page_size=100', f'/api/products/{product.pk}/',
+                    f'/api/categories/{self.category.pk}/products/', '/products/create/']
+            for url in urls:
+                results = []
+                for enabled in (False, True):
+                    with override_settings(QUERYSET_CACHE=enabled):
+                        before = querycache.stats()
+                        timings = []
+                        queries = 0
+                        for _ in range(20):
+                            with CaptureQueriesContext(connection) as captured:
+                                started = time.perf_counter()
+                                response = client.get(url)
+                                timings.append(time.perf_counter() - started)
+                            assert response.status_code == 200, response.content
+                            queries += len(captured)
+                        after = querycache.stats()
+                        hits = sum(after[name] - before[name] for name in ('local_hits', 'shared_hits'))
+                        lookups = hits + after['misses'] - before['misses']
+                    results.append(f'{statistics.median(timings) * 1000:6.1f}ms {queries / 20:4.1f} queries'
+                                   + (f' {hits}/{lookups} hits' if enabled else ''))
+                self.stdout.write(f'{url:40} uncached {results[0]}, cached {results[1]}')
+        finally:
+            user.delete()
+        self.stdout.write(json.dumps(querycache.stats()))
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from products.models import Category, Product, Customer, Sale, SaleItem
+from products import topk
 from decimal import Decimal
 import random
 from datetime import timedelta
@@ -217,6 +218,7 @@ class Command(BaseCommand):
                 
                 # Add 1-5 random products to each sale
                 total_amount = Decimal('0')
+                lines = []
                 for _ in range(random.randint(1, 5)):
                     product = random.choice(created_products)
                     quantity = random.randint(1, 3)
@@ -230,9 +232,11 @@ class Command(BaseCommand):
                     )
                     
                     total_amount += product.price * quantity
+                    lines.append((product.id, quantity, product.price * quantity))
                 
                 sale.total_amount = total_amount
                 sale.save()
+                topk.record_sale(sale.sale_date, lines)
                 status_jp = status_map[status]
                 self.stdout.write(self.style.SUCCESS(
                     f'売上データを作成しました - 顧客: {customer.name}, 状態: {status_jp}, 合計: ¥{total_amount:,.0f}'
@@ -0,0 +1,297 @@
+import datetime
+import io
+import itertools
+import math
+import random
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from products import caching, counters, partitioning, rollups, topk
+from products.models import Category, Product, Customer, Sale, SaleItem, DailySales
+
+# Generated rows are recognized by these, so a rerun only adds what is missing
+MARKER = 'generate_dataset'
+EMAIL_DOMAIN = 'dataset.example'
+# Sales are generated and committed in chunks of this many, each from its own
+# seed, so a run that stopped part way resumes after its last whole chunk
+CHUNK = 10_000
+BATCH_SIZE = 5000
+# Zipf exponents of product and customer popularity
+PRODUCT_SKEW = 1.1
+CUSTOMER_SKEW = 0.5
+STATUSES = {'completed': 90, 'cancelled': 7, 'pending': 3}
+# Relative weights of 1, 2, ... lines per sale and 1, 2, ... units per line
+LINE_WEIGHTS = [50, 25, 12, 7, 4, 2]
+QUANTITY_WEIGHTS = [70, 18, 7, 3, 2]
+# Sales per hour of the day
+HOUR_WEIGHTS = [2, 1, 1, 1, 1, 2, 3, 5, 6, 7, 8, 9, 10, 9, 8, 8, 9, 10, 12, 14, 14, 12, 8, 4]
+# Monday first
+WEEKDAY_WEIGHTS = [0.9, 0.9, 0.95, 1.0, 1.1, 1.35, 1.3]
+CATEGORY_WORDS = ['電化製品', '衣類', '食品', '家具', '書籍', 'スポーツ', '玩具', '化粧品', '文房具', '日用品',
+                  'キッチン', 'ペット用品', '園芸', '自動車用品', '楽器']
+PRODUCT_WORDS = ['ワイヤレス', '限定', 'プレミアム', 'コンパクト', '大容量', 'オーガニック', 'ステンレス',
+                 'wireless', 'black', 'organic', 'cotton', 'deluxe', 'mini', 'pro']
+PRODUCT_NOUNS = ['イヤホン', '水筒', 'テレビ', 'ジャケット', 'デスク', 'ランプ', 'ノート', 'コーヒー',
+                 'bottle', 'lamp', 'desk', 'backpack', 'kettle', 'speaker']
+FAMILY_NAMES = ['佐藤', '鈴木', '高橋', '田中', '伊藤', '渡辺', '山本', '中村', '小林', '加藤', '吉田', '山田']
+GIVEN_NAMES = ['太郎', '花子', '健', '美咲', '翔', '陽菜', '大輔', 'さくら', '拓海', '結衣', '蓮', '葵']
+
+def zipf_weights(count, exponent):
+    """Cumulative weights of ranks 1 to ``count`` under a Zipf distribution."""
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+def popularity(rng, population, exponent):
+    """``(population, cum_weights)`` with Zipf popularity over a random ranking of ``population``."""
+    ranked = list(population)
+    rng.shuffle(ranked)
+    return ranked, zipf_weights(len(ranked), exponent)
+
+@contextmanager
+def explicit_dates(model):
+    """Let bulk_create() keep the dates set on ``model`` instances instead of stamping them now."""
+    fields = [field for field in model._meta.concrete_fields
+              if isinstance(field, models.DateField) and (field.auto_now or field.auto_now_add)]
+    flags = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, flags):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+class Command(BaseCommand):
+    help = ('Generates a reproducible synthetic dataset with skewed product popularity and seasonal '
+            'sales; reruns with the same options add only what is missing')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=15, help='Categories to generate')
+        parser.add_argument('--products', type=int, default=2000, help='Products to generate')
+        parser.add_argument('--customers', type=int, default=50_000, help='Customers to generate')
+        parser.add_argument('--sales', type=int, default=1_000_000, help='Sales to generate')
+        parser.add_argument('--days', type=int, default=365, help='Days the sales are spread over')
+        parser.add_argument('--end', type=datetime.date.fromisoformat, default=None,
+                            help='Last day of sales, YYYY-MM-DD (default today)')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of every random choice')
+
+    def handle(self, *args, **options):
+        for name in ('categories', 'products', 'customers', 'days'):
+            if options[name] < 1:
+                raise CommandError(f'--{name} must be positive')
+        if options['sales'] < 0:
+            raise CommandError('--sales cannot be negative')
+        self.options = options
+        self.seed = options['seed']
+        started = time.perf_counter()
+
+        categories = self.generate_categories(options['categories'])
+        products = self.generate_products(options['products'], categories)
+        customers = self.generate_customers(options['customers'])
+        self.generate_sales(options['sales'], products, customers)
+        self.refresh_derived()
+        self.stdout.write(self.style.SUCCESS(
+            f'Dataset of {len(categories)} categories, {len(products)} products, {len(customers)} customers '
+            f'and {options["sales"]} sales ready in {time.perf_counter() - started:.1f}s'))
+
+    def rng(self, *names):
+        return random.Random(':'.join(map(str, (self.seed, *names))))
+
+    def create_missing(self, model, existing, count, build):
+        """
+        Primary keys of the first ``count`` generated rows of ``model``,
+        creating those missing with ``build(rng, index)``.
+        """
+        existing = list(existing.order_by('pk').values_list('pk', flat=True)[:count])
+        rng = self.rng(model._meta.model_name)
+        # Every row's values are drawn, so the rows created do not depend on those that exist
+        rows = [build(rng, index) for index in range(count)][len(existing):]
+        for start in range(0, len(rows), BATCH_SIZE):
+            existing += [row.pk for row in model.objects.bulk_create(rows[start:start + BATCH_SIZE])]
+        if rows:
+            self.stdout.write(f'Created {len(rows)} {str(model._meta.verbose_name_plural).lower()}')
+        return existing
+
+    def generate_categories(self, count):
+        def build(rng, index):
+            name = CATEGORY_WORDS[index % len(CATEGORY_WORDS)]
+            return Category(name=name if index < len(CATEGORY_WORDS) else f'{name} {index + 1}',
+                            description=MARKER)
+        return self.create_missing(Category, Category.objects.filter(description=MARKER), count, build)
+
+    def generate_products(self, count, categories):
+        rng = self.rng('categories')
+        ranked, weights = popularity(rng, categories, 0.8)
+
+        def build(rng, index):
+            price = max(100, round(rng.lognormvariate(8, 1.1), -1))
+            return Product(
+                name=f'{rng.choice(PRODUCT_WORDS)} {rng.choice(PRODUCT_NOUNS)} {index + 1}',
+                description=' '.join(rng.sample(PRODUCT_WORDS + PRODUCT_NOUNS, 6)),
+                category_id=rng.choices(ranked, cum_weights=weights)[0],
+                price=Decimal(price), stock=rng.randint(0, 1000),
+            )
+        pks = self.create_missing(Product, Product.objects.filter(category__description=MARKER), count, build)
+        prices = dict(Product.objects.filter(pk__in=pks).values_list('pk', 'price'))
+        return [(pk, prices[pk]) for pk in pks]
+
+    def generate_customers(self, count):
+        def build(rng, index):
+            return Customer(name=f'{rng.choice(FAMILY_NAMES)} {rng.choice(GIVEN_NAMES)}',
+                            email=f'customer{index + 1}@{EMAIL_DOMAIN}',
+                            phone=f'0{rng.randint(10, 99)}-{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}',
+                            address=f'{rng.randint(1, 47)}-{rng.randint(1, 30)}-{rng.randint(1, 20)}')
+        return self.create_missing(
+            Customer, Customer.objects.filter(email__endswith=f'@{EMAIL_DOMAIN}'), count, build)
+
+    def sale_days(self):
+        """``(midnight of each day, cum_weights)`` with weekly and yearly seasonality and growth."""
+        days = self.options['days']
+        end = self.options['end'] or timezone.localdate()
+        tz = timezone.get_current_timezone()
+        starts, weights = [], []
+        for offset in range(days):
+            day = end - datetime.timedelta(days=days - 1 - offset)
+            starts.append(datetime.datetime.combine(day, datetime.time(), tzinfo=tz))
+            yearly = 1 + 0.25 * math.cos(2 * math.pi * (day.timetuple().tm_yday - 350) / 365)
+            growth = 0.7 + 0.6 * offset / days
+            weights.append(WEEKDAY_WEIGHTS[day.weekday()] * yearly * growth)
+        return starts, list(itertools.accumulate(weights))
+
+    def sales_chunk(self, index, products, customers, days):
+        """
+        ``(sales, items)`` of chunk ``index``: ``(customer, date, total, status)``
+        and ``(sale, product, quantity, unit price, total)`` rows, items
+        pointing at their sale's position in the chunk.
+        """
+        rng = self.rng('sales', index)
+        products, product_weights = popularity(self.rng('products'), products, PRODUCT_SKEW)
+        customers, customer_weights = popularity(self.rng('customers'), customers, CUSTOMER_SKEW)
+        day_starts, day_weights = days
+        statuses = list(STATUSES)
+        sale_customers = rng.choices(customers, cum_weights=customer_weights, k=CHUNK)
+        sale_days = rng.choices(day_starts, cum_weights=day_weights, k=CHUNK)
+        sale_hours = rng.choices(range(24), weights=HOUR_WEIGHTS, k=CHUNK)
+        sale_statuses = rng.choices(statuses, weights=STATUSES.values(), k=CHUNK)
+        line_counts = rng.choices(range(1, len(LINE_WEIGHTS) + 1), weights=LINE_WEIGHTS, k=CHUNK)
+        line_count = sum(line_counts)
+        line_products = iter(rng.choices(products, cum_weights=product_weights, k=line_count))
+        quantities = iter(rng.choices(range(1, len(QUANTITY_WEIGHTS) + 1), weights=QUANTITY_WEIGHTS,
+                                      k=line_count))
+
+        sales, lines = [], []
+        for position in range(CHUNK):
+            total = Decimal('0')
+            sale_lines = []
+            for _ in range(line_counts[position]):
+                (product, price), quantity = next(line_products), next(quantities)
+                sale_lines.append((product, quantity, price, price * quantity))
+                total += price * quantity
+            date = sale_days[position] + datetime.timedelta(
+                seconds=sale_hours[position] * 3600 + rng.randrange(3600))
+            sales.append((sale_customers[position], date, total, sale_statuses[position]))
+            lines.append(sale_lines)
+        # Keys in date order, as for sales taken as they come
+        order = sorted(range(CHUNK), key=lambda position: sales[position][1])
+        items = [(position, *line) for position, old in enumerate(order) for line in lines[old]]
+        return [sales[old] for old in order], items
+
+    def generate_sales(self, count, products, customers):
+        generated = Sale.objects.filter(customer__email__endswith=f'@{EMAIL_DOMAIN}')
+        done = generated.count()
+        if done >= count:
+            return
+        days = self.sale_days()
+        if partitioning.is_partitioned(connection, Sale):
+            with transaction.atomic():
+                partitioning.create_partitions(connection, since=days[0][0])
+        write = self.copy_sales if connection.vendor == 'postgresql' else self.bulk_create_sales
+
+        started, resumed = time.perf_counter(), done
+        if done:
+            self.stdout.write(f'Resuming after {done} sales')
+        for index in range(done // CHUNK, math.ceil(count / CHUNK)):
+            sales, items = self.sales_chunk(index, products, customers, days)
+            # The start of the chunk may have been written by an earlier run
+            first, last = done - index * CHUNK, min(CHUNK, count - index * CHUNK)
+            sales = sales[first:last]
+            items = [(position - first, *item) for position, *item in items if first <= position < last]
+            with transaction.atomic():
+                write(sales, items)
+                caching.bump_version(Sale)
+                caching.bump_version(SaleItem)
+            done += len(sales)
+            if index % 10 == 9 or done == count:
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f'{done}/{count} sales, {(done - resumed) / elapsed:,.0f} sales/s')
+
+    def reserve_ids(self, model, count):
+        """``count`` primary keys for ``model`` rows inserted with explicit keys."""
+        table = model._meta.db_table
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                               [table, model._meta.pk.column, count])
+                return [row[0] for row in cursor.fetchall()]
+            cursor.execute(f'SELECT coalesce(max({connection.ops.quote_name(model._meta.pk.column)}), 0) '
+                           f'FROM {connection.ops.quote_name(table)}')
+            start = cursor.fetchone()[0] + 1
+        return range(start, start + count)
+
+    def bulk_create_sales(self, sales, items):
+        sale_ids = self.reserve_ids(Sale, len(sales))
+        objects = [
+            Sale(pk=pk, customer_id=customer, sale_date=date, total_amount=total, status=status,
+                 created_at=date, updated_at=date)
+            for pk, (customer, date, total, status) in zip(sale_ids, sales)
+        ]
+        with explicit_dates(Sale):
+            Sale.objects.bulk_create(objects, batch_size=BATCH_SIZE)
+        # Explicit keys, as bulk_create() does not return them on every SQLite
+        SaleItem.objects.bulk_create([
+            SaleItem(pk=pk, sale=objects[position], product_id=product, quantity=quantity, unit_price=price,
+                     total_price=total)
+            for pk, (position, product, quantity, price, total) in zip(
+                self.reserve_ids(SaleItem, len(items)), items)
+        ], batch_size=BATCH_SIZE)
+
+    def copy(self, model, columns, rows):
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(map(str, row)))
+            buffer.write('\n')
+        buffer.seek(0)
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY {quote(model._meta.db_table)} ({", ".join(map(quote, columns))}) FROM STDIN', buffer)
+
+    def copy_sales(self, sales, items):
+        sale_ids = self.reserve_ids(Sale, len(sales))
+        self.copy(Sale, ['id', 'customer_id', 'sale_date', 'total_amount', 'status', 'created_at', 'updated_at'], (
+            (pk, customer, date.isoformat(), total, status, date.isoformat(), date.isoformat())
+            for pk, (customer, date, total, status) in zip(sale_ids, sales)
+        ))
+        self.copy(SaleItem, ['id', 'sale_id', 'product_id', 'quantity', 'unit_price', 'total_price', 'sale_date'], (
+            (pk, sale_ids[position], product, quantity, price, total, sales[position][1].isoformat())
+            for pk, (position, product, quantity, price, total) in zip(
+                self.reserve_ids(SaleItem, len(items)), items)
+        ))
+
+    def refresh_derived(self):
+        """Bring the counters, best seller summaries and rollups in line with the sales."""
+        # The rollups are rebuilt last, so they only count every sale once all are done
+        if DailySales.objects.aggregate(total=Sum('sales_count'))['total'] == Sale.objects.count():
+            return
+        started = time.perf_counter()
+        with transaction.atomic():
+            counters.recount()
+        topk.rebuild()
+        rollups.rebuild_rollups()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.stdout.write(f'Recounted counters and rebuilt rollups in {time.perf_counter() - started:.1f}s')
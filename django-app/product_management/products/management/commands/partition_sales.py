@@ -0,0 +1,78 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from products import partitioning
+from products.models import Sale, SaleItem
+
+class Command(BaseCommand):
+    help = 'Creates the monthly partitions of the sales tables ahead of time (PostgreSQL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=partitioning.MONTHS_AHEAD,
+                            help='Months after the current one to create partitions for')
+        parser.add_argument('--convert', action='store_true',
+                            help='Partition the tables first if they are not (blocks writes while copying)')
+        parser.add_argument('--check', action='store_true',
+                            help='Check that queries on a date range only read its partitions')
+
+    def handle(self, *args, **options):
+        if not partitioning.enabled(connection):
+            self.stdout.write(self.style.WARNING(
+                f'Sales tables are only partitioned on PostgreSQL, not {connection.vendor}'))
+            return
+        if not 0 <= options['ahead'] <= 120:
+            raise CommandError('--ahead must be between 0 and 120')
+
+        if not partitioning.is_partitioned(connection, Sale):
+            if not options['convert']:
+                self.stdout.write(self.style.WARNING(
+                    'The sales tables are not partitioned; convert them once with --convert'))
+                return
+            with connection.schema_editor() as schema_editor:
+                converted = partitioning.partition(schema_editor)
+            self.stdout.write(self.style.SUCCESS(
+                'Partitioned the sales tables' if converted else 'The sales tables were partitioned meanwhile'))
+
+        with transaction.atomic():
+            created, skipped = partitioning.create_partitions(connection, ahead=options['ahead'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {len(created)} partitions' + (f': {", ".join(created)}' if created else '')))
+        for name in skipped:
+            self.stdout.write(self.style.WARNING(
+                f'{name} not created, rows for its month are in the default partition'))
+
+        if options['check']:
+            self.check_pruning()
+
+    def check_pruning(self):
+        now = timezone.now()
+        month = partitioning.month_start(now)
+        ranges = [
+            ('last 30 days', now - timedelta(days=30), None),
+            ('today', now - timedelta(days=1), now),
+            ('previous month', partitioning.month_start(month - timedelta(days=1)), month),
+        ]
+        failures = 0
+        for label, low, high in ranges:
+            bounds = {'sale_date__gte': low, **({'sale_date__lt': high} if high else {})}
+            for description, queryset in (
+                    ('sales', Sale.objects.filter(**bounds)),
+                    ('completed sales', Sale.objects.filter(status='completed', **bounds)),
+                    ('sale items', SaleItem.objects.filter(**bounds))):
+                table = queryset.model._meta.db_table
+                months = partitioning.partitions(connection, table)
+                allowed = {name for name, (start, end) in months.items()
+                           if end > low and (high is None or start < high)}
+                scanned = partitioning.scanned_partitions(queryset)
+                extra = scanned - allowed - {f'{table}_default'}
+                self.stdout.write(
+                    f'{description}, {label}: {len(scanned & set(months))} of '
+                    f'{len(months)} monthly partitions')
+                if extra:
+                    failures += 1
+                    self.stdout.write(self.style.ERROR(f'  also reads {", ".join(sorted(extra))}'))
+        if failures:
+            raise CommandError(f'{failures} queries are not pruned to their partitions')
+        self.stdout.write(self.style.SUCCESS('Date range queries only read their partitions'))
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections
+from products import writebehind
+
+class Command(BaseCommand):
+    help = 'Writes the sales queued by the write-behind API in group commits'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=writebehind.BATCH_SIZE,
+                            help='Sales written per transaction')
+        parser.add_argument('--interval', type=float, default=0.5,
+                            help='Seconds to wait when the queue is empty')
+        parser.add_argument('--retention-days', type=int, default=7,
+                            help='Days to keep processed entries for status queries')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        purged_at = None
+        while True:
+            try:
+                processed = writebehind.drain(options['batch_size'])
+            except OperationalError as exc:
+                # The batch stays queued; reconnect and retry after the interval
+                self.stderr.write(f'Could not process the queue: {exc}')
+                close_old_connections()
+                time.sleep(options['interval'])
+                continue
+            if processed:
+                self.stdout.write(f'Processed {processed} queued sales')
+                continue
+            if purged_at is None or time.monotonic() - purged_at > 3600:
+                purged = writebehind.purge(options['retention_days'])
+                if purged:
+                    self.stdout.write(f'Purged {purged} processed entries')
+                purged_at = time.monotonic()
+            if options['once']:
+                return
+            time.sleep(options['interval'])
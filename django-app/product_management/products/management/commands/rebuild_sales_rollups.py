@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from products.models import DailySales, DailyProductSales, DailyCategorySales
+from products.rollups import rebuild_rollups
+
+class Command(BaseCommand):
+    help = 'Recomputes the daily sales rollup tables from the raw sales data'
+
+    def handle(self, *args, **options):
+        rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt sales rollups: {DailySales.objects.count()} daily, '
+            f'{DailyProductSales.objects.count()} product, '
+            f'{DailyCategorySales.objects.count()} category rows'
+        ))
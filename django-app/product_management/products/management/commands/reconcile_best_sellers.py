@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from products import topk
+
+class Command(BaseCommand):
+    help = 'Checks the streaming best-seller summaries against exact SQL totals'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=10,
+                            help='Number of best sellers to compare per window')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Replace the summaries with exact counts from SaleItem')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            topk.rebuild()
+            self.stdout.write(self.style.SUCCESS('Best-seller summaries rebuilt from SaleItem'))
+
+        top = options['top']
+        violations = 0
+        for window in topk.WINDOWS:
+            for metric in topk.METRICS:
+                exact = topk.exact_totals(window, metric)
+                summary = topk.window_summary(window, metric)
+
+                # Every true total must lie inside the summary's error bounds
+                for product_id, total in exact.items():
+                    if product_id in summary.counters:
+                        count, error = summary.counters[product_id]
+                        in_bounds = count - error <= total <= count
+                    else:
+                        in_bounds = total <= summary.min_count()
+                    if not in_bounds:
+                        violations += 1
+                        self.stdout.write(self.style.ERROR(
+                            f'{window}/{metric}: product {product_id} sold {total}, '
+                            f'summary estimate {summary.estimate(product_id)}'
+                        ))
+
+                expected = sorted(exact, key=exact.get, reverse=True)[:top]
+                found = [key for key, count, error in summary.top(top)]
+                overlap = len(set(expected) & set(found))
+                self.stdout.write(
+                    f'{window}/{metric}: top-{top} overlap {overlap}/{len(expected)}, '
+                    f'max error {summary.min_count()} of {summary.total}'
+                )
+
+        if violations:
+            raise CommandError(
+                f'{violations} totals outside the summary error bounds; '
+                'run with --rebuild to resynchronise')
+        self.stdout.write(self.style.SUCCESS('Best-seller summaries are within their error bounds'))
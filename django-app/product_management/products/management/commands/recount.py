@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from products.counters import recount
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored sales and product counters from the raw tables'
+
+    def handle(self, *args, **options):
+        corrected = recount()
+        self.stdout.write(self.style.SUCCESS(
+            f"Recounted: corrected {corrected['categories']} categories, "
+            f"{corrected['customers']} customers, {corrected['products']} products"
+        ))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from products import stock
+from products.models import Product
+
+class Command(BaseCommand):
+    help = "Splits hot products' stock across counter rows so concurrent sales do not queue on one row"
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='+', type=int)
+        parser.add_argument('--shards', type=int, default=8,
+                            help='Number of stock shards (0 moves the stock back into the product row)')
+
+    def handle(self, *args, **options):
+        if not 0 <= options['shards'] <= 1000:
+            raise CommandError('--shards must be between 0 and 1000')
+        for product_id in options['product_ids']:
+            try:
+                product = stock.shard(product_id, options['shards'])
+            except Product.DoesNotExist:
+                raise CommandError(f'Product {product_id} does not exist')
+            self.stdout.write(self.style.SUCCESS(
+                f'{product.name}: {product.available_stock} in stock over '
+                f'{product.stock_shard_count or "no"} shards'
+            ))
@@ -0,0 +1,54 @@
+# Generated by Django 4.2 on 2026-10-18 08:46
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+def seed_summaries(apps, schema_editor):
+    from products.topk import rebuild
+
+    rebuild(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0002_sales_rollups"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BestSellerSummary",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("metric", models.CharField(max_length=20)),
+                ("period", models.CharField(max_length=10)),
+                (
+                    "total",
+                    models.DecimalField(
+                        decimal_places=2, default=Decimal("0"), max_digits=16
+                    ),
+                ),
+                ("counters", models.JSONField(default=dict)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "verbose_name_plural": "Best seller summaries",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="bestsellersummary",
+            constraint=models.UniqueConstraint(
+                fields=("metric", "period"), name="best_seller_summary_uniq"
+            ),
+        ),
+        migrations.RunPython(seed_summaries, migrations.RunPython.noop),
+    ]
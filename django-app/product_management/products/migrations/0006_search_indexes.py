@@ -0,0 +1,21 @@
+from django.db import migrations
+
+from products import search
+
+def install(apps, schema_editor):
+    search.install([apps.get_model('products', 'Product'), apps.get_model('products', 'Customer')],
+                   schema_editor)
+
+def uninstall(apps, schema_editor):
+    search.uninstall([apps.get_model('products', 'Product'), apps.get_model('products', 'Customer')],
+                     schema_editor)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0005_pending_sales"),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 4.2 on 2026-10-18 09:53
+
+from django.db import migrations, models
+
+import products.operations
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    atomic = False
+
+    dependencies = [
+        ("products", "0007_updated_at_indexes"),
+    ]
+
+    operations = [
+        products.operations.AddIndexConcurrently(
+            model_name="category",
+            index=models.Index(fields=["name", "id"], name="category_name_idx"),
+        ),
+        products.operations.AddIndexConcurrently(
+            model_name="customer",
+            index=models.Index(fields=["created_at"], name="customer_created_at_idx"),
+        ),
+        products.operations.AddIndexConcurrently(
+            model_name="product",
+            index=models.Index(fields=["name", "id"], name="product_name_idx"),
+        ),
+        products.operations.AddIndexConcurrently(
+            model_name="product",
+            index=models.Index(
+                fields=["category", "name", "id"], name="product_category_name_idx"
+            ),
+        ),
+        products.operations.AddIndexConcurrently(
+            model_name="product",
+            index=models.Index(
+                condition=models.Q(("stock_shard_count", 0)),
+                fields=["stock"],
+                name="product_unsharded_stock_idx",
+            ),
+        ),
+        products.operations.AddIndexConcurrently(
+            model_name="product",
+            index=models.Index(
+                condition=models.Q(("stock_shard_count__gt", 0)),
+                fields=["id"],
+                name="product_sharded_idx",
+            ),
+        ),
+        products.operations.AddIndexConcurrently(
+            model_name="sale",
+            index=models.Index(
+                fields=["status", "sale_date"], name="sale_status_date_idx"
+            ),
+        ),
+        products.operations.AddIndexConcurrently(
+            model_name="sale",
+            index=models.Index(fields=["status", "id"], name="sale_status_id_idx"),
+        ),
+        products.operations.AddIndexConcurrently(
+            model_name="sale",
+            index=models.Index(fields=["-sale_date"], name="sale_date_idx"),
+        ),
+        products.operations.AddIndexConcurrently(
+            model_name="sale",
+            index=models.Index(
+                condition=models.Q(("status", "completed")),
+                fields=["-created_at"],
+                name="sale_completed_created_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 4.2 on 2026-10-18 10:03
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+def backfill_counters(apps, schema_editor):
+    from products.counters import recount
+
+    recount(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0008_access_pattern_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="category",
+            name="products_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="customer",
+            name="total_purchases",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="customer",
+            name="total_spent",
+            field=models.DecimalField(
+                decimal_places=2, default=Decimal("0"), max_digits=14
+            ),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="revenue",
+            field=models.DecimalField(
+                decimal_places=2, default=Decimal("0"), max_digits=14
+            ),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="units_sold",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="stockshard",
+            name="revenue",
+            field=models.DecimalField(
+                decimal_places=2, default=Decimal("0"), max_digits=14
+            ),
+        ),
+        migrations.AddField(
+            model_name="stockshard",
+            name="units_sold",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2 on 2026-10-18 10:41
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+import products.models
+
+
+def copy_sale_dates(apps, schema_editor):
+    Sale = apps.get_model('products', 'Sale')
+    SaleItem = apps.get_model('products', 'SaleItem')
+    SaleItem.objects.update(sale_date=Subquery(
+        Sale.objects.filter(pk=OuterRef('sale_id')).values('sale_date')[:1]))
+
+
+def partition_sales(apps, schema_editor):
+    from products import partitioning
+
+    if settings.SALES_PARTITIONING and partitioning.enabled(schema_editor.connection):
+        partitioning.partition(schema_editor, apps)
+
+
+def unpartition_sales(apps, schema_editor):
+    from products import partitioning
+
+    if partitioning.is_partitioned(schema_editor.connection, apps.get_model('products', 'Sale')):
+        partitioning.unpartition(schema_editor, apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0009_stored_counters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="saleitem",
+            name="sale_date",
+            field=products.models.SaleDateField(null=True),
+        ),
+        migrations.RunPython(copy_sale_dates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="saleitem",
+            name="sale_date",
+            field=products.models.SaleDateField(),
+        ),
+        migrations.RunPython(partition_sales, unpartition_sales),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2 on 2026-10-18 11:23
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0010_sale_partitioning"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="sale",
+            name="sale_date",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now, editable=False
+            ),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2 on 2026-10-18 11:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0011_sale_date_default"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="dailycategorysales",
+            name="daily_category_sales_uniq",
+        ),
+        migrations.RemoveConstraint(
+            model_name="dailyproductsales",
+            name="daily_product_sales_uniq",
+        ),
+        migrations.RemoveConstraint(
+            model_name="dailysales",
+            name="daily_sales_date_status_uniq",
+        ),
+        migrations.AddField(
+            model_name="dailycategorysales",
+            name="shard",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="dailyproductsales",
+            name="shard",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="dailysales",
+            name="shard",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name="dailycategorysales",
+            constraint=models.UniqueConstraint(
+                fields=("category", "date", "status", "shard"),
+                name="daily_category_sales_uniq",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="dailyproductsales",
+            constraint=models.UniqueConstraint(
+                fields=("product", "date", "status", "shard"),
+                name="daily_product_sales_uniq",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="dailysales",
+            constraint=models.UniqueConstraint(
+                fields=("date", "status", "shard"), name="daily_sales_date_status_uniq"
+            ),
+        ),
+    ]
@@ -1,21 +1,87 @@
 from django.db import models
 from django.core.validators import MinValueValidator
+from django.db.models.functions import Coalesce
 from decimal import Decimal
+from django.utils import timezone
 
-class Category(models.Model):
+from .querycache import CachedQuerySet
+
+class CounterFieldsMixin:
+    """
+    Leaves ``counter_fields`` out of saves of existing rows. products.counters
+    keeps them up to date with F() updates, which saving an instance loaded
+    before those would otherwise undo.
+    """
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None \
+                and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.counter_fields
+            ]
+        super().save(*args, **kwargs)
+
+class Category(CounterFieldsMixin, models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
+    # Maintained by products.counters
+    products_count = models.IntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    counter_fields = ('products_count',)
+
+    objects = CachedQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = 'Categories'
         ordering = ['name']
+        indexes = [
+            models.Index(fields=['name', 'id'], name='category_name_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
-class Product(models.Model):
+def _plus_shards(column, shard_column, output_field):
+    """``column`` of a product plus ``shard_column`` summed over its stock shards, if any."""
+    shard_total = StockShard.objects.filter(product=models.OuterRef('pk')).values(
+        'product').annotate(total=models.Sum(shard_column)).values('total')
+    return models.Case(
+        models.When(stock_shard_count=0, then=models.F(column)),
+        default=models.F(column) + Coalesce(models.Subquery(shard_total), 0, output_field=output_field),
+        output_field=output_field,
+    )
+
+class ProductQuerySet(CachedQuerySet):
+    def with_stock(self):
+        """
+        Annotate ``available_stock``, the stock summed over any stock shards,
+        and ``total_units_sold`` and ``total_revenue``, the sales counters
+        summed the same way.
+        """
+        return self.annotate(
+            available_stock=_plus_shards('stock', 'quantity', models.IntegerField()),
+            total_units_sold=_plus_shards('units_sold', 'units_sold', models.IntegerField()),
+            total_revenue=_plus_shards(
+                'revenue', 'revenue', models.DecimalField(max_digits=14, decimal_places=2)),
+        )
+
+    def low_stock(self, threshold):
+        """
+        ``with_stock()`` limited to products with at most ``threshold`` units.
+        Unsharded products are matched on ``stock``, so that only the few
+        sharded products need ``available_stock`` computed; partial indexes
+        serve both halves.
+        """
+        return self.with_stock().filter(
+            models.Q(stock_shard_count=0, stock__lte=threshold)
+            | models.Q(stock_shard_count__gt=0, available_stock__lte=threshold)
+        )
+
+class Product(CounterFieldsMixin, models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField()
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
@@ -25,30 +91,131 @@ class Product(models.Model):
         validators=[MinValueValidator(Decimal('0.01'))]
     )
     stock = models.PositiveIntegerField(default=0)
+    # Number of StockShard rows holding this product's stock (0: kept in ``stock``)
+    stock_shard_count = models.PositiveSmallIntegerField(default=0)
     image = models.ImageField(upload_to='products/', blank=True, null=True)
+    # Units and revenue of the sales that were not cancelled, maintained by
+    # products.counters; those of a sharded product are partly on its shards
+    units_sold = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0'))
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ProductQuerySet.as_manager()
+
+    counter_fields = ('units_sold', 'revenue')
+
     class Meta:
         ordering = ['name']
+        indexes = [
+            models.Index(fields=['updated_at'], name='product_updated_at_idx'),
+            models.Index(fields=['name', 'id'], name='product_name_idx'),
+            models.Index(fields=['category', 'name', 'id'], name='product_category_name_idx'),
+            models.Index(fields=['stock'], condition=models.Q(stock_shard_count=0),
+                         name='product_unsharded_stock_idx'),
+            models.Index(fields=['id'], condition=models.Q(stock_shard_count__gt=0),
+                         name='product_sharded_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
-class Customer(models.Model):
+    @property
+    def available_stock(self):
+        """Units in stock, including the stock shards of a sharded product."""
+        if not hasattr(self, '_available_stock'):
+            shard_stock = 0
+            if self.stock_shard_count:
+                shard_stock = self.stock_shards.aggregate(
+                    total=models.Sum('quantity'))['total'] or 0
+            self._available_stock = self.stock + shard_stock
+        return self._available_stock
+
+    @available_stock.setter
+    def available_stock(self, value):
+        self._available_stock = value
+
+    def _load_sales_totals(self):
+        units, revenue = self.units_sold, self.revenue
+        if self.stock_shard_count:
+            shards = self.stock_shards.aggregate(
+                units=models.Sum('units_sold'), revenue=models.Sum('revenue'))
+            units += shards['units'] or 0
+            revenue += shards['revenue'] or 0
+        self._total_units_sold, self._total_revenue = units, revenue
+
+    @property
+    def total_units_sold(self):
+        """Units sold, including those counted on the stock shards of a sharded product."""
+        if not hasattr(self, '_total_units_sold'):
+            self._load_sales_totals()
+        return self._total_units_sold
+
+    @total_units_sold.setter
+    def total_units_sold(self, value):
+        self._total_units_sold = value
+
+    @property
+    def total_revenue(self):
+        """Revenue, including that counted on the stock shards of a sharded product."""
+        if not hasattr(self, '_total_revenue'):
+            self._load_sales_totals()
+        return self._total_revenue
+
+    @total_revenue.setter
+    def total_revenue(self, value):
+        self._total_revenue = value
+
+class StockShard(models.Model):
+    """
+    One of the counters a hot product's stock is split across, so that
+    concurrent sales decrement different rows (see products.stock).
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_shards')
+    index = models.PositiveSmallIntegerField()
+    quantity = models.PositiveIntegerField(default=0)
+    # Part of the product's sales counters, see products.counters
+    units_sold = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0'))
+
+    objects = CachedQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'index'], name='stock_shard_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id}#{self.index}: {self.quantity}"
+
+class Customer(CounterFieldsMixin, models.Model):
     name = models.CharField(max_length=200)
     email = models.EmailField(unique=True)
     phone = models.CharField(max_length=20, blank=True)
     address = models.TextField()
+    # Number and total of the sales that were not cancelled, maintained by products.counters
+    total_purchases = models.IntegerField(default=0)
+    total_spent = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0'))
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    counter_fields = ('total_purchases', 'total_spent')
+
+    objects = CachedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at'], name='customer_updated_at_idx'),
+            models.Index(fields=['created_at'], name='customer_created_at_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
 class Sale(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='sales')
-    sale_date = models.DateTimeField(auto_now_add=True)
+    # Stamped on creation unless set, as write-behind sales are dated when accepted
+    sale_date = models.DateTimeField(default=timezone.now, editable=False)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(
         max_length=20,
@@ -62,15 +229,46 @@ class Sale(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'sale_date'], name='sale_status_date_idx'),
+            models.Index(fields=['status', 'id'], name='sale_status_id_idx'),
+            models.Index(fields=['-sale_date'], name='sale_date_idx'),
+            models.Index(fields=['-created_at'], condition=models.Q(status='completed'),
+                         name='sale_completed_created_idx'),
+        ]
+
     def __str__(self):
         return f"Sale {self.id} - {self.customer.name}"
 
+class SaleDateField(models.DateTimeField):
+    """
+    The ``sale_date`` of the row's sale, copied on every save() and
+    bulk_create() so that sale items can be partitioned like sales (see
+    products.partitioning).
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs['editable'] = False
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        del kwargs['editable']
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = model_instance.sale.sale_date
+        setattr(model_instance, self.attname, value)
+        return value
+
 class SaleItem(models.Model):
     sale = models.ForeignKey(Sale, on_delete=models.CASCADE, related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField()
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
+    sale_date = SaleDateField()
 
     def save(self, *args, **kwargs):
         self.total_price = self.quantity * self.unit_price
@@ -78,3 +276,101 @@ class SaleItem(models.Model):
 
     def __str__(self):
         return f"{self.product.name} - {self.quantity} units"
+
+class DailySales(models.Model):
+    """Per-day sales totals, maintained incrementally by products.rollups."""
+    date = models.DateField()
+    status = models.CharField(max_length=20)
+    # Which of the day's rows a sale is added to, see products.rollups
+    shard = models.PositiveSmallIntegerField(default=0)
+    sales_count = models.IntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0'))
+
+    class Meta:
+        verbose_name_plural = 'Daily sales'
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'status', 'shard'], name='daily_sales_date_status_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} {self.status}: {self.total_amount}"
+
+class DailyProductSales(models.Model):
+    """Per-day, per-product sales totals, maintained incrementally by products.rollups."""
+    date = models.DateField()
+    status = models.CharField(max_length=20)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales')
+    shard = models.PositiveSmallIntegerField(default=0)
+    quantity = models.IntegerField(default=0)
+    items_count = models.IntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0'))
+
+    class Meta:
+        verbose_name_plural = 'Daily product sales'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['product', 'date', 'status', 'shard'], name='daily_product_sales_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} {self.product_id} {self.status}: {self.quantity}"
+
+class DailyCategorySales(models.Model):
+    """Per-day, per-category sales totals, maintained incrementally by products.rollups."""
+    date = models.DateField()
+    status = models.CharField(max_length=20)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='daily_sales')
+    shard = models.PositiveSmallIntegerField(default=0)
+    quantity = models.IntegerField(default=0)
+    items_count = models.IntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0'))
+
+    class Meta:
+        verbose_name_plural = 'Daily category sales'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['category', 'date', 'status', 'shard'], name='daily_category_sales_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} {self.category_id} {self.status}: {self.quantity}"
+
+class BestSellerSummary(models.Model):
+    """Space-Saving summary of product sales for one day or all time (see products.topk)."""
+    metric = models.CharField(max_length=20)
+    period = models.CharField(max_length=10)
+    total = models.DecimalField(max_digits=16, decimal_places=2, default=Decimal('0'))
+    counters = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'Best seller summaries'
+        constraints = [
+            models.UniqueConstraint(fields=['metric', 'period'], name='best_seller_summary_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.metric} {self.period}"
+
+class PendingSale(models.Model):
+    """A sale accepted by the write-behind API, waiting for process_sale_queue."""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('created', 'Created'),
+        ('failed', 'Failed'),
+    ]
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    sale = models.ForeignKey(Sale, on_delete=models.SET_NULL, null=True, blank=True,
+                             related_name='+')
+    errors = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='pending_sale_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"Pending sale {self.id} ({self.status})"
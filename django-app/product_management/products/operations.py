@@ -0,0 +1,32 @@
+"""
+Custom migration operations.
+"""
+from django.contrib.postgres.operations import AddIndexConcurrently as PostgresAddIndexConcurrently
+from django.db.migrations.operations import AddIndex
+
+class AddIndexConcurrently(PostgresAddIndexConcurrently):
+    """
+    Django's AddIndexConcurrently on PostgreSQL, so writes to the table go on
+    while the index is built, and a plain AddIndex on other databases and on
+    partitioned tables, which cannot be indexed concurrently. The migration
+    needs ``atomic = False`` either way.
+    """
+
+    def _concurrently(self, app_label, schema_editor, state):
+        from products import partitioning
+
+        model = state.apps.get_model(app_label, self.model_name)
+        return schema_editor.connection.vendor == 'postgresql' \
+            and not partitioning.is_partitioned(schema_editor.connection, model)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if self._concurrently(app_label, schema_editor, to_state):
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        else:
+            AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if self._concurrently(app_label, schema_editor, from_state):
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
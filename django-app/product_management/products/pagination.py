@@ -0,0 +1,171 @@
+"""
+Keyset pagination for the API.
+
+Pages are addressed by an opaque cursor holding the sort key of the row at
+the page boundary, and fetched with ``WHERE key > cursor ORDER BY key
+LIMIT size``. Page 10,000 costs the same as page 1, unlike the ``OFFSET``
+scan of page-number pagination. The key is the queryset's ordering (its
+``order_by()`` or the model's Meta.ordering) followed by the primary key,
+so rows with equal sort values are still visited exactly once. Ordering
+fields must be plain non-null model fields.
+
+Query parameters: ``cursor``, ``page_size`` (up to ``max_page_size``)
+and ``count=false`` to skip the ``COUNT(*)`` behind the ``count`` field. A
+cursor that was not issued by this API, or not for this ordering, is a 400.
+"""
+import datetime
+import decimal
+from functools import reduce
+from operator import and_, or_
+
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+from django.db.models.query import ValuesListIterable
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+SALT = 'products.pagination'
+INVALID_CURSOR = {'cursor': 'Invalid cursor.'}
+
+def _encode_value(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return value
+
+def encode_cursor(key, reverse=False):
+    """Opaque cursor for the page after (or with ``reverse``, before) ``key``."""
+    return signing.dumps([[_encode_value(value) for value in key], reverse],
+                         salt=SALT, compress=True)
+
+def decode_cursor(cursor):
+    try:
+        key, reverse = signing.loads(cursor, salt=SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        raise ValidationError(INVALID_CURSOR)
+    return key, bool(reverse)
+
+def key_ordering(queryset):
+    """``[(field, descending)]`` keyset ordering of ``queryset``, ending with the primary key."""
+    order_by = queryset.query.order_by
+    if not order_by and queryset.query.default_ordering:
+        order_by = queryset.model._meta.ordering
+    ordering = []
+    for field in order_by:
+        if not isinstance(field, str) or '__' in field or '?' in field:
+            raise ImproperlyConfigured(f'Keyset pagination cannot order by {field!r}')
+        name = field.lstrip('-')
+        if name == queryset.model._meta.pk.name:
+            name = 'pk'
+        ordering.append((name, field.startswith('-')))
+    if 'pk' not in (name for name, descending in ordering):
+        ordering.append(('pk', False))
+    return ordering
+
+def _after(ordering, key, reverse):
+    """Rows strictly after ``key`` in ``ordering`` (before it with ``reverse``)."""
+    clauses = []
+    for index, (name, descending) in enumerate(ordering):
+        lookup = 'lt' if descending != reverse else 'gt'
+        equal = [Q(**{field: value}) for (field, _), value in zip(ordering[:index], key)]
+        clauses.append(reduce(and_, equal + [Q(**{f'{name}__{lookup}': key[index]})]))
+    if len(clauses) == 1:
+        return clauses[0]
+    # Redundant, but gives the database a range on the first field to seek an index with
+    name, descending = ordering[0]
+    bound = Q(**{f"{name}__{'lte' if descending != reverse else 'gte'}": key[0]})
+    return bound & reduce(or_, clauses)
+
+class KeysetPagination(BasePagination):
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        ordering = key_ordering(queryset)
+        self.count = None
+        if request.query_params.get(self.count_query_param, 'true').lower() not in ('false', '0'):
+            self.count = queryset.count()
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        key, reverse = decode_cursor(cursor) if cursor else (None, False)
+        if key is not None and len(key) != len(ordering):
+            raise ValidationError(INVALID_CURSOR)
+
+        page = queryset.order_by(*(
+            ('-' if descending != reverse else '') + name for name, descending in ordering
+        ))
+        if key is not None:
+            page = page.filter(_after(ordering, key, reverse))
+
+        self.columns = None
+        if page._iterable_class is ValuesListIterable:
+            # Fetch the key along with the row, after the columns the caller asked for
+            fields = list(page._fields)
+            fields += [name for name, descending in ordering if name not in fields]
+            self.columns = [fields.index(name) for name, descending in ordering]
+            page = page.values_list(*fields)
+
+        rows = list(page[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+        self.ordering = ordering
+        self.has_next = bool(rows) and (has_more if not reverse else key is not None)
+        self.has_previous = bool(rows) and (has_more if reverse else key is not None)
+        self.first_key = self._row_key(rows[0]) if rows else None
+        self.last_key = self._row_key(rows[-1]) if rows else None
+        return rows
+
+    def _row_key(self, row):
+        if self.columns is not None:
+            return [row[index] for index in self.columns]
+        return [getattr(row, name) for name, descending in self.ordering]
+
+    def _link(self, key, reverse):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, 'page')
+        return replace_query_param(url, self.cursor_query_param, encode_cursor(key, reverse))
+
+    def get_next_link(self):
+        return self._link(self.last_key, False) if self.has_next else None
+
+    def get_previous_link(self):
+        return self._link(self.first_key, True) if self.has_previous else None
+
+    def get_paginated_response(self, data):
+        return Response({
+            'count': self.count,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'count': {'type': 'integer', 'nullable': True,
+                          'description': 'Total rows, null with count=false'},
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,245 @@
+"""
+Monthly range partitioning of the sales tables on PostgreSQL.
+
+With SALES_PARTITIONING enabled, products_sale is partitioned by
+``sale_date`` and products_saleitem by its copy of its sale's date
+(SaleItem.sale_date), one partition per calendar month (settings.TIME_ZONE)
+named ``<table>_pYYYYMM``, plus a ``<table>_default`` partition for rows
+outside them. Queries filtering on ``sale_date`` only read the partitions
+of the months they cover, and vacuum and index maintenance stay on the
+current months while older partitions are left alone.
+
+PostgreSQL requires the primary key of a partitioned table to include the
+partition key, so the primary keys become ``(id, sale_date)``; Django keeps
+treating ``id`` as the primary key, and a lookup by ``id`` alone probes the
+index of every partition. Line items reference their sale through
+``(sale_id, sale_date)``, updated in cascade if a sale's date changes.
+Nothing can reference a partitioned table by ``id`` alone, so the database
+constraint behind PendingSale.sale is dropped (Django still applies its
+``on_delete``).
+
+partition() converts the plain tables (migration 0010 when the setting is
+on, or ``manage.py partition_sales --convert``) by copying them, under a
+lock that blocks writes to sales until it commits; unpartition() converts
+them back. create_partitions() adds the partitions of the coming months;
+``manage.py partition_sales`` runs it on every deploy; converting is a
+one-off ``--convert`` run. Other databases
+keep plain tables.
+"""
+import json
+from datetime import datetime, timedelta
+
+from django.apps import apps as global_apps
+from django.db import connections
+from django.utils import timezone
+
+MONTHS_AHEAD = 3
+# Do not queue every query on the table behind DDL that waits for a long transaction
+LOCK_TIMEOUT = '5s'
+
+def _tables(apps):
+    """The partitioned models, parents first."""
+    return [apps.get_model('products', 'Sale'), apps.get_model('products', 'SaleItem')]
+
+def enabled(connection):
+    return connection.vendor == 'postgresql'
+
+def is_partitioned(connection, model):
+    if not enabled(connection):
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))',
+            [model._meta.db_table])
+        return cursor.fetchone()[0]
+
+def month_start(value):
+    """Midnight on the first day of ``value``'s month, in the current time zone."""
+    value = timezone.localtime(value)
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def next_month(start):
+    return month_start(start + timedelta(days=32))
+
+def partition_name(table, start):
+    return f'{table}_p{start:%Y%m}'
+
+def partitions(connection, table):
+    """``{name: (start, end)}`` of ``table``'s monthly partitions, from their names."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = %s::regclass', [table])
+        names = [row[0] for row in cursor.fetchall()]
+    result = {}
+    for name in names:
+        suffix = name[len(table) + 2:]
+        if name.startswith(f'{table}_p') and len(suffix) == 6 and suffix.isdigit():
+            start = timezone.make_aware(datetime.strptime(suffix, '%Y%m'))
+            result[name] = (start, next_month(start))
+    return result
+
+def _months(since, ahead):
+    """``(start, end)`` of each month from ``since``'s to ``ahead`` months after the current one."""
+    now = timezone.now()
+    last = month_start(now)
+    for _ in range(ahead):
+        last = next_month(last)
+    start = month_start(min(since or now, now))
+    while start <= last:
+        end = next_month(start)
+        yield start, end
+        start = end
+
+def _create_partitions(connection, parent, table, since, ahead):
+    """Partitions of ``parent`` named after ``table``; see create_partitions()."""
+    quote = connection.ops.quote_name
+    existing = partitions(connection, parent)
+    default = f'{table}_default'
+    created, skipped = [], []
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {quote(default)} PARTITION OF {quote(parent)} DEFAULT')
+        for start, end in _months(since, ahead):
+            name = partition_name(table, start)
+            if name in existing:
+                continue
+            cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {quote(default)} '
+                           f'WHERE sale_date >= %s AND sale_date < %s)', [start, end])
+            if cursor.fetchone()[0]:
+                skipped.append(name)
+                continue
+            cursor.execute(f'CREATE TABLE {quote(name)} PARTITION OF {quote(parent)} '
+                           f'FOR VALUES FROM (%s) TO (%s)', [start, end])
+            created.append(name)
+    return created, skipped
+
+def create_partitions(connection, since=None, ahead=MONTHS_AHEAD, apps=global_apps):
+    """
+    Create the missing monthly partitions from ``since``'s month (default
+    the current one) to ``ahead`` months after the current one. Return
+    ``(created, skipped)`` lists of partition names; a month is skipped when
+    rows for it already sit in the default partition, as the partition could
+    not be created over them. Call it in a transaction.
+    """
+    created, skipped = [], []
+    with connection.cursor() as cursor:
+        cursor.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+    for model in _tables(apps):
+        table = model._meta.db_table
+        result = _create_partitions(connection, table, table, since, ahead)
+        created += result[0]
+        skipped += result[1]
+    return created, skipped
+
+def _rebuild(schema_editor, model, partitioned, select):
+    """
+    Replace ``model``'s table with a copy, partitioned by ``sale_date`` or
+    not. ``select(table, columns)`` returns the query filling it from the old
+    table, given the table's quoted name and column names.
+    """
+    connection = schema_editor.connection
+    quote = connection.ops.quote_name
+    table = model._meta.db_table
+    new = f'{table}_new'
+    pk = model._meta.pk.column
+    with connection.cursor() as cursor:
+        columns = [column.name for column in connection.introspection.get_table_description(cursor, table)]
+        cursor.execute('SELECT min(sale_date) FROM ' + quote(table))
+        since = cursor.fetchone()[0]
+        cursor.execute(
+            'SELECT pg_get_indexdef(indexrelid) FROM pg_index '
+            'WHERE indrelid = %s::regclass AND NOT indisprimary', [table])
+        indexes = [row[0].replace(' ON ONLY ', ' ON ') for row in cursor.fetchall()]
+        # Those between the sales tables are put back by the caller
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype = 'f' AND confrelid <> ALL(%s::regclass[])",
+            [table, [other._meta.db_table for other in _tables(model._meta.apps)]])
+        foreign_keys = cursor.fetchall()
+
+    schema_editor.execute(
+        f'CREATE TABLE {quote(new)} (LIKE {quote(table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS '
+        f'INCLUDING IDENTITY)' + (' PARTITION BY RANGE (sale_date)' if partitioned else ''))
+    if partitioned:
+        _create_partitions(connection, new, table, since, MONTHS_AHEAD)
+    names = ', '.join(map(quote, columns))
+    schema_editor.execute(f'INSERT INTO {quote(new)} ({names}) {select(quote(table), columns)}')
+    schema_editor.execute(
+        f'SELECT setval(pg_get_serial_sequence(%s, %s), coalesce(max({quote(pk)}), 0) + 1, false) '
+        f'FROM {quote(new)}', [new, pk])
+
+    # Also drops the old table's partitions and the foreign keys pointing at it
+    schema_editor.execute(f'DROP TABLE {quote(table)} CASCADE')
+    schema_editor.execute(f'ALTER TABLE {quote(new)} RENAME TO {quote(table)}')
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, pk])
+        sequence = cursor.fetchone()[0]
+    schema_editor.execute(f'ALTER SEQUENCE {sequence} RENAME TO {quote(f"{table}_{pk}_seq")}')
+    key = f'{quote(pk)}, sale_date' if partitioned else quote(pk)
+    schema_editor.execute(
+        f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(table + "_pkey")} PRIMARY KEY ({key})')
+    for index in indexes:
+        schema_editor.execute(index)
+    for name, definition in foreign_keys:
+        schema_editor.execute(f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(name)} {definition}')
+
+def _copy(table, columns):
+    return f'SELECT {", ".join(columns)} FROM {table}'
+
+def partition(schema_editor, apps=global_apps):
+    """
+    Convert the plain sales tables to partitioned ones. Return False if
+    they already were, e.g. by a concurrent conversion this one waited for.
+    """
+    Sale, SaleItem = _tables(apps)
+    quote = schema_editor.connection.ops.quote_name
+    sales, items = quote(Sale._meta.db_table), quote(SaleItem._meta.db_table)
+    # Reads go on, writes wait for the copy
+    schema_editor.execute(f'LOCK TABLE {sales}, {items} IN EXCLUSIVE MODE')
+    if is_partitioned(schema_editor.connection, Sale):
+        return False
+    _rebuild(schema_editor, Sale, True, _copy)
+
+    def copy_items(table, columns):
+        # The dates are taken from the sales again, in case a QuerySet.update() moved one
+        selected = ['s.sale_date' if column == 'sale_date' else f'i.{quote(column)}' for column in columns]
+        return f'SELECT {", ".join(selected)} FROM {table} i JOIN {sales} s ON s.id = i.sale_id'
+
+    _rebuild(schema_editor, SaleItem, True, copy_items)
+    schema_editor.execute(
+        f'ALTER TABLE {items} ADD CONSTRAINT {quote(SaleItem._meta.db_table + "_sale_fk")} '
+        f'FOREIGN KEY (sale_id, sale_date) REFERENCES {sales} (id, sale_date) '
+        f'ON UPDATE CASCADE DEFERRABLE INITIALLY DEFERRED')
+    return True
+
+def unpartition(schema_editor, apps=global_apps):
+    """Convert the partitioned sales tables back to plain ones."""
+    Sale, SaleItem = _tables(apps)
+    PendingSale = apps.get_model('products', 'PendingSale')
+    quote = schema_editor.connection.ops.quote_name
+    schema_editor.execute(
+        f'LOCK TABLE {quote(Sale._meta.db_table)}, {quote(SaleItem._meta.db_table)} IN EXCLUSIVE MODE')
+    _rebuild(schema_editor, Sale, False, _copy)
+    _rebuild(schema_editor, SaleItem, False, _copy)
+    for model in (SaleItem, PendingSale):
+        schema_editor.execute(schema_editor._create_fk_sql(
+            model, model._meta.get_field('sale'), '_fk_%(to_table)s_%(to_column)s'))
+
+def scanned_partitions(queryset):
+    """Names of the tables and partitions PostgreSQL plans to read for ``queryset``."""
+    sql, params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    names = set()
+
+    def walk(node):
+        if 'Relation Name' in node:
+            names.add(node['Relation Name'])
+        for child in node.get('Plans', []):
+            walk(child)
+
+    walk(plan[0]['Plan'])
+    return names
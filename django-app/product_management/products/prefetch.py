@@ -0,0 +1,67 @@
+"""
+Eager loading derived from serializer fields.
+
+A serializer that reads ``category.name`` or nests ``items`` with their
+``product.name`` costs one query per row unless the queryset selects and
+prefetches those relations. for_serializer() walks a serializer's readable
+fields once per class and applies the select_related() and
+prefetch_related() lookups they traverse, so querysets serialized through
+it cost a fixed number of queries however many rows come back.
+"""
+from functools import lru_cache
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+
+def _forward_path(model, attrs):
+    """The longest prefix of ``attrs`` that follows forward foreign keys."""
+    path = []
+    for name in attrs:
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            break
+        if not (field.many_to_one or field.one_to_one) or not field.concrete:
+            break
+        path.append(name)
+        model = field.related_model
+    return path
+
+@lru_cache(maxsize=None)
+def lookups(serializer_class):
+    """``(select_related, prefetch_related)`` lookups for ``serializer_class``."""
+    serializer = serializer_class()
+    model = serializer.Meta.model
+    select, prefetch = set(), []
+    for field in serializer.fields.values():
+        if field.write_only or field.source == '*':
+            continue
+        if isinstance(field, serializers.ListSerializer):
+            child = type(field.child)
+            child_select, child_prefetch = lookups(child)
+            prefetch.append(Prefetch(field.source, queryset=child.Meta.model.objects.select_related(
+                *child_select).prefetch_related(*child_prefetch)))
+        elif isinstance(field, serializers.BaseSerializer):
+            child_select, child_prefetch = lookups(type(field))
+            select.add(field.source)
+            select.update(f'{field.source}__{lookup}' for lookup in child_select)
+            prefetch.extend(
+                Prefetch(f'{field.source}__{lookup.prefetch_to}', queryset=lookup.queryset)
+                for lookup in child_prefetch
+            )
+        else:
+            # The last attribute is read from the related row itself
+            path = _forward_path(model, field.source_attrs[:-1])
+            if path:
+                select.add('__'.join(path))
+    return tuple(sorted(select)), tuple(prefetch)
+
+def for_serializer(queryset, serializer_class):
+    """``queryset`` with the relations ``serializer_class`` reads loaded up front."""
+    select, prefetch = lookups(serializer_class)
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    return queryset
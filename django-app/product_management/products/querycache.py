@@ -0,0 +1,250 @@
+"""
+Cached results of read querysets.
+
+``Model.objects.cached()`` (on the models whose manager uses CachedQuerySet)
+marks a queryset whose rows, and count(), are served from the cache. The key
+is a hash of the query's SQL and parameters plus the products.caching version
+of every table the query read, so a write to any of those tables makes the
+entry unreachable once it commits. Versions are bumped by the model signals
+(products.signals) and by CachedQuerySet's update(), bulk_create(),
+bulk_update() and delete(); raw SQL writes to these tables must call
+caching.bump_version() themselves.
+
+Which tables a query reads is found by running it the first time, subqueries
+and prefetches included, and remembered per query. Results are only stored
+when every one of those tables belongs to a model using CachedQuerySet.
+Because versions are read before the query runs, a result that raced with a
+write is stored under versions that write has already retired.
+
+Results are pickled into two tiers: an LRU of QUERYSET_CACHE_LRU_BYTES per
+process, then the ``default`` cache, which every process shares. Each lookup
+still reads the versions from the ``default`` cache, so like CONDITIONAL_GET
+this is only correct across uWSGI processes with a shared CACHE_URL, and is
+off by default otherwise (QUERYSET_CACHE). Querysets evaluated inside a
+transaction are not cached, so a transaction reads its own writes and
+snapshot. stats() counts hits per tier, misses and uncacheable queries.
+"""
+import hashlib
+import pickle
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import connections, models
+
+from . import caching, routing
+
+KEY_PREFIX = 'querycache'
+# Queries whose tables are remembered, forgotten all at once beyond that
+MAX_QUERIES = 10_000
+
+class LRU:
+    """Pickled values, least recently used evicted first once over ``max_bytes``."""
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            if len(value) > settings.QUERYSET_CACHE_LRU_BYTES:
+                return
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > settings.QUERYSET_CACHE_LRU_BYTES:
+                self.size -= len(self._entries.popitem(last=False)[1])
+                _count('evictions')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+LOCAL = LRU()
+# SQL, without parameters: the tables it reads
+_tables = {}
+_stats_lock = threading.Lock()
+_stats = dict.fromkeys(('local_hits', 'shared_hits', 'misses', 'uncacheable', 'evictions'), 0)
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+def stats():
+    with _stats_lock:
+        counts = dict(_stats)
+    lookups = counts['local_hits'] + counts['shared_hits'] + counts['misses']
+    return {
+        **counts,
+        'hit_rate': round((counts['local_hits'] + counts['shared_hits']) / lookups, 3) if lookups else None,
+        'local_entries': len(LOCAL),
+        'local_bytes': LOCAL.size,
+        'local_max_bytes': settings.QUERYSET_CACHE_LRU_BYTES,
+        'queries': len(_tables),
+    }
+
+@lru_cache(maxsize=None)
+def _models_by_table():
+    return {model._meta.db_table: model for model in apps.get_models(include_auto_created=True)}
+
+@lru_cache(maxsize=None)
+def _tracked(model):
+    return issubclass(model._default_manager._queryset_class, CachedQuerySet)
+
+def _lookup(lookup):
+    if isinstance(lookup, models.Prefetch):
+        queryset = lookup.queryset
+        return (lookup.prefetch_through, lookup.to_attr,
+                queryset is not None and (str(queryset.query), _lookups(queryset)))
+    return lookup
+
+def _lookups(queryset):
+    return tuple(_lookup(lookup) for lookup in queryset._prefetch_related_lookups)
+
+def _query_key(queryset, kind):
+    """The hash of what ``queryset`` returns, and its SQL with its prefetches."""
+    sql, params = queryset.query.sql_with_params()
+    shape = (_lookups(queryset), sql)
+    key = repr((kind, queryset.model._meta.label, queryset._iterable_class.__name__, queryset._fields,
+                shape, params))
+    return hashlib.sha256(key.encode()).hexdigest(), shape
+
+def _fetch(queryset, kind, build):
+    """The result of ``build()``, an evaluation of ``queryset``, from the cache when current."""
+    connection = connections[queryset.db]
+    if not settings.QUERYSET_CACHE or connection.in_atomic_block:
+        return build()
+    try:
+        query_key, shape = _query_key(queryset, kind)
+    except EmptyResultSet:
+        return build()
+
+    by_table = _models_by_table()
+    tables = _tables.get(shape)
+    if tables is not None and not all(_tracked(by_table[table]) for table in tables):
+        _count('uncacheable')
+        return build()
+    # The first time, the versions of every cached table, as any may turn out to be read
+    candidates = tables if tables is not None else sorted(
+        table for table, model in by_table.items() if _tracked(model))
+    read_models = [by_table[table] for table in candidates]
+    versions = dict(zip(candidates, caching.get_versions(read_models)))
+
+    if tables is not None:
+        key = f'{KEY_PREFIX}:{query_key}:' + '.'.join(str(versions[table]) for table in tables)
+        value = LOCAL.get(key)
+        if value is not None:
+            _count('local_hits')
+            return pickle.loads(value)
+        value = cache.get(key)
+        if value is not None:
+            _count('shared_hits')
+            LOCAL.set(key, value)
+            return pickle.loads(value)
+    _count('misses')
+
+    # Not from a replica that has yet to receive the writes behind these versions
+    routing.use_primary_if_written(read_models)
+    read = set()
+    quote = connection.ops.quote_name
+
+    def record(execute, sql, params, many, context):
+        read.update(table for table in by_table if quote(table) in sql)
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(record):
+        result = build()
+    if tables is None or not read <= set(tables):
+        known = set(tables or ())
+        if len(_tables) >= MAX_QUERIES:
+            _tables.clear()
+        _tables[shape] = tables = tuple(sorted(read | known))
+        if not all(_tracked(by_table[table]) for table in tables):
+            _count('uncacheable')
+            return result
+        if known and not read <= known:
+            # Tables not read before have no version from before the query
+            return result
+
+    key = f'{KEY_PREFIX}:{query_key}:' + '.'.join(str(versions[table]) for table in tables)
+    value = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    cache.set(key, value, settings.QUERYSET_CACHE_TIMEOUT)
+    LOCAL.set(key, value)
+    return result
+
+class CachedQuerySet(models.QuerySet):
+    """A QuerySet that can be cached(), and whose writes invalidate cached querysets of its model."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cached = False
+
+    def cached(self):
+        """This queryset, with its rows and count() served from the cache while current."""
+        clone = self._chain()
+        clone._cached = True
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._cached = self._cached
+        return clone
+
+    def _uncached(self):
+        clone = self._chain()
+        clone._cached = False
+        return clone
+
+    def _fetch_all(self):
+        if self._cached and self._result_cache is None:
+            def build():
+                clone = self._uncached()
+                clone._fetch_all()
+                return clone._result_cache
+            self._result_cache = _fetch(self, 'rows', build)
+            self._prefetch_done = True
+        super()._fetch_all()
+
+    def iterator(self, chunk_size=None):
+        if self._cached:
+            self._fetch_all()
+            return iter(self._result_cache)
+        return super().iterator(chunk_size)
+
+    def count(self):
+        if self._cached and self._result_cache is None:
+            return _fetch(self, 'count', self._uncached().count)
+        return super().count()
+
+    def update(self, **kwargs):
+        caching.bump_version(self.model)
+        return super().update(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        caching.bump_version(self.model)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        caching.bump_version(self.model)
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def delete(self):
+        caching.bump_version(self.model)
+        return super().delete()
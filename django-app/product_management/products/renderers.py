@@ -0,0 +1,93 @@
+"""
+API renderers.
+
+FastJSONRenderer produces the same bytes as DRF's JSONRenderer with orjson
+instead of the stdlib ``json`` module. Types orjson does not handle the
+same way (Decimal, dates and times, lazy strings...) are passed to DRF's
+JSONEncoder, so they keep their current representation. Without orjson,
+for indented output, for anything orjson cannot encode (e.g. integers
+beyond 64 bits) and for floats that Python writes with an exponent
+(``1e+16``, ``1.5e-07``; orjson spells them differently) it falls back to
+JSONRenderer. The one difference is that NaN and infinite floats become
+null, where JSONRenderer raises ValueError.
+
+MessagePackRenderer, used when the client accepts ``application/msgpack``,
+needs the optional ``msgpack`` package and encodes those types the same way.
+
+The export endpoints (see products.export) stream their own response body.
+NDJSONRenderer and CSVRenderer only let DRF's content negotiation accept
+``?format=ndjson|csv`` and the matching Accept headers, and render error
+responses as JSON.
+"""
+import re
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Representation of everything JSON has no type for, as DRF encodes it
+encode_default = encoders.JSONEncoder().default
+
+# In orjson's output of every float below 1e-4 or from 1e16 up (also matches
+# some strings, which _has_exponent_float() then rules out)
+EXPONENT_FLOAT = re.compile(rb'[0-9]e|0\.0000')
+
+def _has_exponent_float(data):
+    """Whether ``data`` holds a float that repr() writes with an exponent."""
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, float):
+            if value and not 1e-4 <= abs(value) < 1e16:
+                return True
+        elif isinstance(value, dict):
+            stack.extend(value)
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            stack.extend(value)
+    return False
+
+class FastJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or not self.compact or self.ensure_ascii \
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=encode_default,
+                               option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        if EXPONENT_FLOAT.search(ret) and _has_exponent_float(data):
+            return super().render(data, accepted_media_type, renderer_context)
+        # Same escapes as JSONRenderer, so the output is a strict JavaScript subset
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=encode_default, use_bin_type=True, datetime=False)
+
+class NDJSONRenderer(FastJSONRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+class CSVRenderer(FastJSONRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
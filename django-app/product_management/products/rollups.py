@@ -0,0 +1,309 @@
+"""
+Incrementally maintained sales rollups.
+
+Every Sale and SaleItem write is folded into per-day summary rows (overall,
+per product and per category, each split by sale status) from the model
+signals in products.signals, so the rollups change in the same transaction
+as the write that caused them. The dashboard, dashboard_stats and the
+time-series API read these rows instead of grouping the raw sales tables.
+
+Each key is split across SHARDS rows, and a sale and its lines are always
+added to row ``sale_id % SHARDS``, the same index it takes sharded stock
+from (see products.stock). Concurrent sales of one product then update
+different rows instead of queueing on one, and readers sum the shards.
+Changing SHARDS needs a ``manage.py rebuild_sales_rollups``.
+
+Writes that bypass model signals (QuerySet.update(), raw SQL) are not
+tracked; run ``manage.py rebuild_sales_rollups`` after those.
+"""
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+from itertools import islice
+from operator import itemgetter
+
+from django.apps import apps as global_apps
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Mod, TruncDate, TruncMonth, TruncWeek
+from django.utils import timezone
+
+from .models import (
+    DailyCategorySales, DailyProductSales, DailySales, Product, Sale, SaleItem
+)
+
+GRANULARITIES = {'day': None, 'week': TruncWeek, 'month': TruncMonth}
+SHARDS = 8
+
+# Rollup- and counter-relevant columns of a row as last written to the database
+SaleState = namedtuple('SaleState', ['sale_date', 'status', 'total_amount', 'customer_id'])
+ItemState = namedtuple('ItemState', ['product_id', 'quantity', 'total_price'])
+
+def sale_day(sale_date):
+    """Calendar day a sale is rolled up under (same as TruncDate in the default timezone)."""
+    if timezone.is_naive(sale_date):
+        return sale_date.date()
+    return timezone.localdate(sale_date, timezone.get_default_timezone())
+
+def shard_of(sale_id):
+    """Rollup shard the sale ``sale_id`` is added to."""
+    return sale_id % SHARDS
+
+def _snapshot(instance, state_class, loaded_only):
+    if loaded_only and not set(state_class._fields) <= instance.__dict__.keys():
+        return None
+    return state_class(*(getattr(instance, name) for name in state_class._fields))
+
+def sale_state(sale, loaded_only=False):
+    """
+    Snapshot a Sale. With ``loaded_only`` deferred fields are not fetched and
+    None is returned instead.
+    """
+    return _snapshot(sale, SaleState, loaded_only)
+
+def item_state(item, loaded_only=False):
+    """Snapshot a SaleItem, see sale_state()."""
+    return _snapshot(item, ItemState, loaded_only)
+
+def load_sale_state(pk):
+    row = Sale.objects.filter(pk=pk).values_list(*SaleState._fields).first()
+    return row and SaleState(*row)
+
+def load_item_state(pk):
+    row = SaleItem.objects.filter(pk=pk).values_list(*ItemState._fields).first()
+    return row and ItemState(*row)
+
+def _bump(model, key, create=True, **deltas):
+    """Add ``deltas`` to the rollup row identified by ``key``, creating it if needed."""
+    if not any(deltas.values()):
+        return
+    updates = {field: F(field) + value for field, value in deltas.items()}
+    if model.objects.filter(**key).update(**updates) or not create:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**key, **deltas)
+    except IntegrityError:
+        # Another transaction created the row first
+        model.objects.filter(**key).update(**updates)
+
+def _upsert_add(model, key_fields, rows):
+    """
+    Add to many rollup rows in one INSERT ... ON CONFLICT DO UPDATE statement
+    (PostgreSQL and SQLite 3.24+). ``rows`` maps key tuples to dicts of deltas.
+    """
+    if not rows:
+        return
+    value_fields = list(next(iter(rows.values())))
+    fields = [model._meta.get_field(name) for name in key_fields + value_fields]
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    columns = [quote(field.column) for field in fields]
+    keys, values = columns[:len(key_fields)], columns[len(key_fields):]
+
+    row_sql = '(%s)' % ', '.join(['%s'] * len(fields))
+    sql = (
+        f'INSERT INTO {table} ({", ".join(columns)}) VALUES {", ".join([row_sql] * len(rows))} '
+        f'ON CONFLICT ({", ".join(keys)}) DO UPDATE SET '
+        + ', '.join(f'{column} = {table}.{column} + EXCLUDED.{column}' for column in values)
+    )
+    params = []
+    # In key order, so that concurrent statements lock shared rows in the same order
+    for key, deltas in sorted(rows.items(), key=itemgetter(0)):
+        for field, value in zip(fields, (*key, *(deltas[name] for name in value_fields))):
+            params.append(field.get_db_prep_save(value, connection))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+def _bump_line(day_key, product_id, category_id, create=True, **deltas):
+    date, status, shard = day_key
+    _bump(DailyProductSales, {'date': date, 'status': status, 'shard': shard, 'product_id': product_id},
+          create, **deltas)
+    _bump(DailyCategorySales, {'date': date, 'status': status, 'shard': shard, 'category_id': category_id},
+          create, **deltas)
+
+def _day_key(state, sale_id):
+    return state and (sale_day(state.sale_date), state.status, shard_of(sale_id))
+
+def _sales_key(day_key):
+    return dict(zip(('date', 'status', 'shard'), day_key))
+
+def record_sale_change(sale_id, old, new):
+    """
+    Fold the change of one Sale from ``old`` to ``new`` (SaleState, or None
+    for an insert/delete) into the rollups.
+    """
+    old_key, new_key = _day_key(old, sale_id), _day_key(new, sale_id)
+    if old_key == new_key:
+        if old_key:
+            _bump(DailySales, _sales_key(old_key),
+                  total_amount=Decimal(new.total_amount) - Decimal(old.total_amount))
+        return
+
+    if old_key:
+        _bump(DailySales, _sales_key(old_key), create=False,
+              sales_count=-1, total_amount=-Decimal(old.total_amount))
+    if new_key:
+        _bump(DailySales, _sales_key(new_key),
+              sales_count=1, total_amount=Decimal(new.total_amount))
+
+    if old_key and new_key:
+        # Status or date changed: the sale's lines move with it
+        lines = SaleItem.objects.filter(sale_id=sale_id).values(
+            'product_id', 'product__category_id'
+        ).annotate(
+            quantity=Sum('quantity'),
+            items_count=Count('id'),
+            total_amount=Sum('total_price'),
+        ).order_by()
+        for line in lines:
+            totals = {name: line[name] for name in ('quantity', 'items_count', 'total_amount')}
+            _bump_line(old_key, line['product_id'], line['product__category_id'], create=False,
+                       **{name: -value for name, value in totals.items()})
+            _bump_line(new_key, line['product_id'], line['product__category_id'], **totals)
+
+def record_item_change(item, old, new):
+    """
+    Fold the change of one SaleItem from ``old`` to ``new`` (ItemState, or
+    None for an insert/delete) into the product and category rollups.
+    """
+    if old == new:
+        return
+    day_key = _day_key(sale_state(item.sale), item.sale_id)
+
+    product_ids = {state.product_id for state in (old, new) if state}
+    categories = {}
+    if SaleItem.product.is_cached(item):
+        categories[item.product.pk] = item.product.category_id
+    missing = product_ids - categories.keys()
+    if missing:
+        categories.update(Product.objects.filter(pk__in=missing).values_list('id', 'category_id'))
+
+    if old and new and old.product_id == new.product_id:
+        _bump_line(day_key, new.product_id, categories[new.product_id],
+                   quantity=new.quantity - old.quantity,
+                   total_amount=Decimal(new.total_price) - Decimal(old.total_price))
+        return
+    if old and old.product_id in categories:
+        _bump_line(day_key, old.product_id, categories[old.product_id], create=False,
+                   quantity=-old.quantity, items_count=-1,
+                   total_amount=-Decimal(old.total_price))
+    if new:
+        _bump_line(day_key, new.product_id, categories[new.product_id],
+                   quantity=new.quantity, items_count=1,
+                   total_amount=Decimal(new.total_price))
+
+def record_sales_created(sales):
+    """
+    Fold Sales inserted without model signals (bulk_create) into the daily
+    rollups in one statement.
+    """
+    by_day = defaultdict(lambda: {'sales_count': 0, 'total_amount': Decimal('0')})
+    for sale in sales:
+        totals = by_day[_day_key(sale_state(sale), sale.pk)]
+        totals['sales_count'] += 1
+        totals['total_amount'] += Decimal(sale.total_amount)
+    _upsert_add(DailySales, ['date', 'status', 'shard'], by_day)
+
+def record_items_created(items):
+    """
+    Fold SaleItems inserted without model signals (bulk_create) into the
+    product and category rollups, one statement per table. Each item's
+    ``sale`` and ``product`` should already be loaded.
+    """
+    by_product = defaultdict(lambda: {'quantity': 0, 'items_count': 0, 'total_amount': Decimal('0')})
+    by_category = defaultdict(lambda: {'quantity': 0, 'items_count': 0, 'total_amount': Decimal('0')})
+    for item in items:
+        day_key = _day_key(sale_state(item.sale), item.sale_id)
+        for totals in (by_product[(*day_key, item.product_id)],
+                       by_category[(*day_key, item.product.category_id)]):
+            totals['quantity'] += item.quantity
+            totals['items_count'] += 1
+            totals['total_amount'] += item.total_price
+    _upsert_add(DailyProductSales, ['date', 'status', 'shard', 'product'], by_product)
+    _upsert_add(DailyCategorySales, ['date', 'status', 'shard', 'category'], by_category)
+
+def sales_timeseries(granularity='day', date_from=None, date_to=None, status='completed',
+                     product=None, category=None):
+    """
+    Sales totals bucketed by day, week or month, optionally for a single
+    product or category. Bounds are inclusive calendar days.
+    """
+    if product is not None:
+        queryset = DailyProductSales.objects.filter(product_id=product)
+        totals = {'quantity': Sum('quantity'), 'total_amount': Sum('total_amount')}
+    elif category is not None:
+        queryset = DailyCategorySales.objects.filter(category_id=category)
+        totals = {'quantity': Sum('quantity'), 'total_amount': Sum('total_amount')}
+    else:
+        queryset = DailySales.objects.all()
+        totals = {'sales_count': Sum('sales_count'), 'total_amount': Sum('total_amount')}
+
+    queryset = queryset.filter(status=status)
+    if date_from:
+        queryset = queryset.filter(date__gte=date_from)
+    if date_to:
+        queryset = queryset.filter(date__lte=date_to)
+
+    trunc = GRANULARITIES[granularity]
+    period = trunc('date') if trunc else F('date')
+    return list(queryset.annotate(period=period).values('period').annotate(
+        **totals
+    ).order_by('period'))
+
+def _bulk_create(model, objs, batch_size=1000):
+    objs = iter(objs)
+    while batch := list(islice(objs, batch_size)):
+        model.objects.bulk_create(batch)
+
+def rebuild_rollups(apps=global_apps):
+    """
+    Recompute every rollup row from the raw sales tables. ``apps`` lets
+    migrations run this against historical models.
+    """
+    Sale = apps.get_model('products', 'Sale')
+    SaleItem = apps.get_model('products', 'SaleItem')
+    DailySales = apps.get_model('products', 'DailySales')
+    DailyProductSales = apps.get_model('products', 'DailyProductSales')
+    DailyCategorySales = apps.get_model('products', 'DailyCategorySales')
+    tzinfo = timezone.get_default_timezone()
+
+    with transaction.atomic():
+        for model in (DailySales, DailyProductSales, DailyCategorySales):
+            model.objects.all().delete()
+
+        days = Sale.objects.annotate(
+            date=TruncDate('sale_date', tzinfo=tzinfo),
+            shard=Mod('id', SHARDS),
+        ).values('date', 'status', 'shard').annotate(
+            sales_count=Count('id'),
+            total_amount=Sum('total_amount'),
+        ).order_by()
+        _bulk_create(DailySales, (DailySales(**row) for row in days.iterator()))
+
+        lines = SaleItem.objects.annotate(
+            date=TruncDate('sale__sale_date', tzinfo=tzinfo),
+            status=F('sale__status'),
+            shard=Mod('sale_id', SHARDS),
+        ).values('date', 'status', 'shard', 'product_id', 'product__category_id').annotate(
+            quantity=Sum('quantity'),
+            items_count=Count('id'),
+            total_amount=Sum('total_price'),
+        ).order_by()
+
+        category_totals = defaultdict(lambda: [0, 0, Decimal('0')])
+        product_rows = []
+        for row in lines.iterator():
+            category_id = row.pop('product__category_id')
+            totals = category_totals[(row['date'], row['status'], row['shard'], category_id)]
+            totals[0] += row['quantity']
+            totals[1] += row['items_count']
+            totals[2] += row['total_amount']
+            product_rows.append(DailyProductSales(**row))
+        _bulk_create(DailyProductSales, product_rows)
+        _bulk_create(DailyCategorySales, (
+            DailyCategorySales(date=date, status=status, shard=shard, category_id=category_id,
+                               quantity=quantity, items_count=items_count,
+                               total_amount=total_amount)
+            for (date, status, shard, category_id), (quantity, items_count, total_amount)
+            in category_totals.items()
+        ))
@@ -0,0 +1,120 @@
+"""
+Reads from the database replicas.
+
+database.get_database_config() adds a ``replica<N>`` alias per host in
+DATABASE_REPLICA_HOSTS. During GET, HEAD and OPTIONS requests,
+ReplicaMiddleware picks one of them and ReplicaRouter sends the request's
+reads there. Everything else goes to ``default``:
+
+- writes, and reads outside requests (management commands, the sale queue
+  worker, background threads);
+- the rest of a request's reads once it has written;
+- requests from a client that made a POST, PUT, PATCH or DELETE less than
+  DATABASE_REPLICA_LAG seconds ago, so users read their own writes; a
+  cookie marks them, so API clients that drop cookies are not covered;
+- views marked with primary_db() or PrimaryDatabaseMixin, and ViewSet
+  actions marked with primary_db();
+- the rest of a request after use_primary(), which products.caching and
+  products.conditional call through use_primary_if_written() before
+  building a response from models written within the lag window, so a
+  lagging replica cannot be cached under the new version.
+
+Migrations only run on ``default``; the replicas get the schema by
+replication.
+"""
+import random
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import DEFAULT_DB_ALIAS
+from django.dispatch import receiver
+
+from . import caching
+
+PIN_COOKIE = 'db_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Always on the primary: the database cache backend
+PRIMARY_APPS = ('django_cache',)
+
+# Alias the current request reads from, None for the primary
+_replica = ContextVar('replica', default=None)
+
+def replicas():
+    return [alias for alias in settings.DATABASES if alias.startswith('replica')]
+
+def current_replica():
+    """Alias the current request reads from, None for the primary."""
+    return _replica.get()
+
+def use_primary():
+    """Read from the primary for the rest of the current request."""
+    _replica.set(None)
+
+def use_primary_if_written(models):
+    """use_primary() if any of ``models`` was written within the replica lag window."""
+    if _replica.get() is None:
+        return
+    modified = caching.get_modified(models)
+    if modified is None or time.time() - modified < settings.DATABASE_REPLICA_LAG:
+        use_primary()
+
+def primary_db(view):
+    """Mark a view function, or a ViewSet action, to read from the primary."""
+    view.use_primary_db = True
+    return view
+
+class PrimaryDatabaseMixin:
+    """Make a class-based view read from the primary."""
+    use_primary_db = True
+
+def _uses_primary(request, view_func):
+    view_class = getattr(view_func, 'view_class', None) or getattr(view_func, 'cls', None)
+    if getattr(view_func, 'use_primary_db', False) or getattr(view_class, 'use_primary_db', False):
+        return True
+    action = (getattr(view_func, 'actions', None) or {}).get(request.method.lower())
+    return getattr(getattr(view_class, action or '', None), 'use_primary_db', False)
+
+class ReplicaMiddleware:
+    """Choose the database a request reads from, and pin clients that wrote to the primary."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        aliases = replicas()
+        if aliases and request.method in SAFE_METHODS and PIN_COOKIE not in request.COOKIES:
+            _replica.set(random.choice(aliases))
+        else:
+            _replica.set(None)
+        response = self.get_response(request)
+        if aliases and request.method not in SAFE_METHODS:
+            response.set_cookie(PIN_COOKIE, '1', max_age=settings.DATABASE_REPLICA_LAG,
+                                secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax')
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if _replica.get() is not None and _uses_primary(request, view_func):
+            use_primary()
+
+@receiver(request_finished)
+def _reset(sender, **kwargs):
+    # After a streamed response has been sent
+    _replica.set(None)
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in PRIMARY_APPS:
+            return DEFAULT_DB_ALIAS
+        return _replica.get() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        use_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,179 @@
+"""
+Indexed full-text search for products and customers.
+
+search() filters a queryset by a search string and orders it by relevance
+(a ``search_rank`` annotation, highest first, then the primary key). Each
+whitespace-separated term must match one of the model's search fields as a
+substring, as with DRF's SearchFilter, but through an index:
+
+- PostgreSQL: the fields are matched with ``icontains``, served by pg_trgm
+  GIN indexes on ``UPPER(field)``, which also cover Japanese text (pg_trgm
+  needs a database locale that classifies CJK characters as letters, such
+  as en_US.UTF-8 or C.UTF-8). Relevance is ``ts_rank`` over a ``simple``
+  tsvector of all fields plus the trigram word similarity of the first
+  field, computed for the matching rows only; a tsvector index would not
+  help since rows are never filtered by word.
+- SQLite: an FTS5 table per model with the ``trigram`` tokenizer, kept in
+  step with the model table by triggers. Relevance is FTS5's bm25. Terms
+  shorter than three characters cannot use the trigram index and are
+  matched with ``icontains``.
+
+Any other database falls back to unindexed ``icontains`` ordered by primary
+key. The indexes are created by migration 0006. Django rebuilds a SQLite
+table (dropping its triggers) for some schema changes, so install() runs
+again after every migrate and refills the FTS tables when it had to put
+the triggers back.
+"""
+from functools import reduce
+from operator import and_, or_
+
+from django.db import connections
+from django.db.models import FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Upper
+from rest_framework import filters
+
+# Searched fields per model, the first one weighted for similarity
+SEARCH_FIELDS = {
+    'products.product': ['name', 'description'],
+    'products.customer': ['name', 'email'],
+}
+
+MIN_TRIGRAM_LENGTH = 3
+TRIGGERS = ('insert', 'delete', 'update')
+
+def search_fields(model):
+    return SEARCH_FIELDS.get(model._meta.label_lower)
+
+def terms(text):
+    """Search terms of ``text``, split like DRF's SearchFilter does."""
+    return text.replace('\x00', '').replace(',', ' ').split()
+
+def _contains(fields, term):
+    return reduce(or_, (Q(**{f'{field}__icontains': term}) for field in fields))
+
+def search(queryset, text):
+    """``queryset`` limited to rows matching ``text``, best matches first."""
+    fields = search_fields(queryset.model)
+    words = terms(text)
+    if not fields or not words:
+        return queryset
+    vendor = connections[queryset.db].vendor
+    if vendor == 'postgresql':
+        return _search_postgresql(queryset, fields, words)
+    if vendor == 'sqlite':
+        return _search_sqlite(queryset, fields, words)
+    return queryset.filter(reduce(and_, (_contains(fields, word) for word in words))).annotate(
+        search_rank=Value(0.0, output_field=FloatField())).order_by('-search_rank', 'pk')
+
+def _search_postgresql(queryset, fields, words):
+    from django.contrib.postgres.search import (
+        SearchQuery, SearchRank, SearchVector, TrigramWordSimilarity
+    )
+    text = ' '.join(words)
+    query = SearchQuery(text, config='simple', search_type='websearch')
+    return queryset.filter(
+        reduce(and_, (_contains(fields, word) for word in words))
+    ).annotate(
+        search_rank=SearchRank(SearchVector(*fields, config='simple'), query)
+        + TrigramWordSimilarity(text, fields[0])
+    ).order_by('-search_rank', 'pk')
+
+def _fts_table(model):
+    return f'{model._meta.db_table}_fts'
+
+def _search_sqlite(queryset, fields, words):
+    model = queryset.model
+    table = _fts_table(model)
+    long_words = [word for word in words if len(word) >= MIN_TRIGRAM_LENGTH]
+    for word in words:
+        if word not in long_words:
+            queryset = queryset.filter(_contains(fields, word))
+    if not long_words:
+        return queryset.annotate(search_rank=Value(0.0, output_field=FloatField())).order_by(
+            '-search_rank', 'pk')
+
+    # Each term is a quoted phrase, i.e. a substring match with the trigram tokenizer
+    match = ' '.join('"%s"' % word.replace('"', '""') for word in long_words)
+    quote = connections[queryset.db].ops.quote_name
+    column = f'{quote(model._meta.db_table)}.{quote(model._meta.pk.column)}'
+    # Joined rather than correlated, bm25() is only cheap for the row the MATCH is on
+    return queryset.extra(
+        tables=[table], where=[f'{table}.rowid = {column}', f'{table} MATCH %s'], params=[match]
+    ).annotate(
+        # bm25() is lower for better matches
+        search_rank=RawSQL(f'-bm25({table})', [], output_field=FloatField())
+    ).order_by('-search_rank', 'pk')
+
+class SearchFilter(filters.SearchFilter):
+    """DRF's SearchFilter, through search() for the models it indexes."""
+
+    def filter_queryset(self, request, queryset, view):
+        if search_fields(queryset.model) is None:
+            return super().filter_queryset(request, queryset, view)
+        return search(queryset, request.query_params.get(self.search_param, ''))
+
+def postgresql_indexes(model):
+    """The GIN indexes behind search() on PostgreSQL."""
+    from django.contrib.postgres.indexes import GinIndex, OpClass
+    name = model._meta.model_name
+    return [
+        GinIndex(OpClass(Upper(field), name='gin_trgm_ops'), name=f'{name}_{field}_trgm_idx')
+        for field in search_fields(model)
+    ]
+
+def _sqlite_statements(model):
+    table, fts = model._meta.db_table, _fts_table(model)
+    pk = model._meta.pk.column
+    columns = [model._meta.get_field(field).column for field in search_fields(model)]
+    names = ', '.join(columns)
+    new = ', '.join(f'new.{column}' for column in columns)
+    old = ', '.join(f'old.{column}' for column in columns)
+    delete = f"INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.{pk}, {old});"
+    insert = f'INSERT INTO {fts}(rowid, {names}) VALUES (new.{pk}, {new});'
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({names}, "
+        f"content='{table}', content_rowid='{pk}', tokenize='trigram')",
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN {insert} END',
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN {delete} END',
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {names} ON {table} '
+        f'BEGIN {delete} {insert} END',
+    ]
+
+def install(models, schema_editor):
+    """Create the search indexes of ``models`` that do not exist yet."""
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for model in models:
+            with connection.cursor() as cursor:
+                existing = set(connection.introspection.get_constraints(cursor, model._meta.db_table))
+            for index in postgresql_indexes(model):
+                if index.name not in existing:
+                    schema_editor.add_index(model, index)
+    elif connection.vendor == 'sqlite':
+        for model in models:
+            fts = _fts_table(model)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (%s, %s, %s)",
+                    [f'{fts}_{suffix}' for suffix in TRIGGERS])
+                complete = cursor.fetchone()[0] == len(TRIGGERS)
+            if complete:
+                continue
+            for statement in _sqlite_statements(model):
+                schema_editor.execute(statement)
+            schema_editor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+def uninstall(models, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        for model in models:
+            for index in postgresql_indexes(model):
+                schema_editor.remove_index(model, index)
+    elif connection.vendor == 'sqlite':
+        for model in models:
+            fts = _fts_table(model)
+            for suffix in TRIGGERS:
+                schema_editor.execute(f'DROP TRIGGER IF EXISTS {fts}_{suffix}')
+            schema_editor.execute(f'DROP TABLE IF EXISTS {fts}')
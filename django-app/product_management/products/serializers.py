@@ -1,23 +1,48 @@
+from collections import defaultdict
+from decimal import Decimal
+from django.db import transaction
 from rest_framework import serializers
-from .models import Category, Product, Customer, Sale, SaleItem
+from . import caching, counters, rollups, stock, topk
+from .models import Category, Product, Customer, Sale, SaleItem, PendingSale
 
 class CategorySerializer(serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = '__all__'
+        read_only_fields = Category.counter_fields
 
 class ProductSerializer(serializers.ModelSerializer):
     category_name = serializers.CharField(source='category.name', read_only=True)
+    stock = serializers.IntegerField(source='available_stock', min_value=0, required=False)
+    units_sold = serializers.IntegerField(source='total_units_sold', read_only=True)
+    revenue = serializers.DecimalField(source='total_revenue', max_digits=14, decimal_places=2,
+                                       read_only=True)
 
     class Meta:
         model = Product
         fields = ['id', 'name', 'description', 'category', 'category_name', 
-                 'price', 'stock', 'image', 'created_at', 'updated_at']
+                 'price', 'stock', 'units_sold', 'revenue', 'image', 'created_at', 'updated_at']
+        expandable_fields = {'category': CategorySerializer}
+
+    @staticmethod
+    def read_queryset():
+        """Base queryset products.fastread reads nested and expanded products from."""
+        return Product.objects.with_stock()
+
+    def create(self, validated_data):
+        validated_data['stock'] = validated_data.pop('available_stock', 0)
+        return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        if 'available_stock' in validated_data:
+            stock.set_stock(instance, validated_data.pop('available_stock'))
+        return super().update(instance, validated_data)
 
 class CustomerSerializer(serializers.ModelSerializer):
     class Meta:
         model = Customer
         fields = '__all__'
+        read_only_fields = Customer.counter_fields
 
 class SaleItemSerializer(serializers.ModelSerializer):
     product_name = serializers.CharField(source='product.name', read_only=True)
@@ -25,6 +50,11 @@ class SaleItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = SaleItem
         fields = ['id', 'product', 'product_name', 'quantity', 'unit_price', 'total_price']
+        expandable_fields = {'product': ProductSerializer}
+
+class SaleItemExportSerializer(SaleItemSerializer):
+    class Meta(SaleItemSerializer.Meta):
+        fields = ['id', 'sale', 'product', 'product_name', 'quantity', 'unit_price', 'total_price']
 
 class SaleSerializer(serializers.ModelSerializer):
     items = SaleItemSerializer(many=True, read_only=True)
@@ -34,29 +64,78 @@ class SaleSerializer(serializers.ModelSerializer):
         model = Sale
         fields = ['id', 'customer', 'customer_name', 'sale_date', 
                  'total_amount', 'status', 'items', 'created_at', 'updated_at']
+        expandable_fields = {'customer': CustomerSerializer}
+
+    def get_lines(self):
+        """
+        Validate the ``items`` passed in the context as ``(product_id, quantity)``
+        pairs. ``product`` may be a primary key or a Product instance.
+        """
+        lines = []
+        for item_data in self.context.get('items', []):
+            product = item_data.get('product')
+            product_id = getattr(product, 'pk', product)
+            try:
+                product_id, quantity = int(product_id), int(item_data.get('quantity'))
+            except (TypeError, ValueError):
+                raise serializers.ValidationError(
+                    {'items': 'Each item needs a product id and a quantity.'})
+            if quantity < 1:
+                raise serializers.ValidationError({'items': 'Quantities must be positive.'})
+            lines.append((product_id, quantity))
+        return lines
 
     def create(self, validated_data):
-        items_data = self.context.get('items', [])
-        sale = Sale.objects.create(**validated_data)
-        
-        total_amount = 0
-        for item_data in items_data:
-            product = item_data['product']
-            quantity = item_data['quantity']
-            unit_price = product.price
-            
-            SaleItem.objects.create(
-                sale=sale,
-                product=product,
-                quantity=quantity,
-                unit_price=unit_price
-            )
-            total_amount += quantity * unit_price
-            
-            # Update product stock
-            product.stock -= quantity
-            product.save()
-        
-        sale.total_amount = total_amount
-        sale.save()
+        lines = self.get_lines()
+        needed = defaultdict(int)
+        for product_id, quantity in lines:
+            needed[product_id] += quantity
+
+        with transaction.atomic():
+            products = stock.lock_products(needed)
+            missing = sorted(set(needed) - set(products))
+            if missing:
+                raise serializers.ValidationError(
+                    {'items': f'Unknown products: {", ".join(map(str, missing))}.'})
+            short = [products[product_id].name for product_id, quantity in needed.items()
+                     if products[product_id].available_stock < quantity]
+            if short:
+                raise serializers.ValidationError(
+                    {'items': f'Insufficient stock for: {", ".join(short)}.'})
+
+            items = [
+                SaleItem(
+                    product=products[product_id],
+                    quantity=quantity,
+                    unit_price=products[product_id].price,
+                    total_price=quantity * products[product_id].price
+                )
+                for product_id, quantity in lines
+            ]
+            validated_data['total_amount'] = sum(
+                (item.total_price for item in items), Decimal('0'))
+            sale = Sale.objects.create(**validated_data)
+
+            if items:
+                for item in items:
+                    item.sale = sale
+                SaleItem.objects.bulk_create(items)
+                try:
+                    shards = stock.decrement(needed, products, sale.pk)
+                except stock.InsufficientStock:
+                    raise serializers.ValidationError({'items': 'Insufficient stock.'})
+                rollups.record_items_created(items)
+                counters.record_items_created(items, shards)
+                caching.bump_version(SaleItem)
+                caching.bump_version(Product)
+
+        topk.record_sale(sale.sale_date, [
+            (item.product_id, item.quantity, item.total_price) for item in items
+        ])
         return sale
+
+class PendingSaleSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PendingSale
+        fields = ['id', 'status', 'sale', 'errors', 'created_at', 'processed_at']
+        expandable_fields = {'sale': SaleSerializer}
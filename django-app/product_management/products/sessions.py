@@ -0,0 +1,201 @@
+"""
+Database sessions that are rarely written.
+
+SESSION_ENGINE points here. Sessions are still stored in django_session, with
+three changes to Django's database backend:
+
+- Each process keeps the last SESSION_CACHE_SIZE sessions it read or wrote in
+  memory and serves them again for SESSION_CACHE_TTL seconds without a query.
+  An anonymous session changed or deleted by another process can be seen
+  stale for that long; this process's own writes replace its entry. Every
+  save and delete also sets a version of the session in the ``default``
+  cache, and a logged-in session (one with an ``_auth_user_id``) is only
+  served from memory while that version is the one it was read with, so a
+  logout or password change in one process ends the session in all of them.
+  Like products.querycache, that needs a CACHE_URL the processes share.
+- save() is skipped when the session's data is the same as when it was
+  loaded, such as after a view assigned a value that was already there.
+- Sessions are not saved just to push their expiry back. Loading a session
+  whose expiry is more than SESSION_TOUCH_INTERVAL seconds older than a save
+  would set queues it, and the queue is flushed with one UPDATE at the end of
+  a request every FLUSH_INTERVAL seconds. The session is marked modified, so
+  SessionMiddleware sends the cookie again with a new Max-Age while save()
+  still writes nothing. A session in use thus keeps expiring
+  SESSION_COOKIE_AGE after its last use, to within the interval, in the
+  database and the browser alike.
+
+Flash messages live in a cookie (MESSAGE_STORAGE), so the success message of
+a form post no longer writes the session twice. clear_expired() deletes in
+batches; ``manage.py purge_sessions`` runs it.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.contrib.sessions.backends import db
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.dispatch import receiver
+from django.utils import timezone
+
+FLUSH_INTERVAL = 30
+BATCH_SIZE = 5000
+KEY_PREFIX = 'sessions'
+
+class SessionCache:
+    """
+    A bounded, least recently used map of session key to ``(session_data,
+    expire_date, version)``.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, session_key):
+        with self._lock:
+            entry = self._entries.get(session_key)
+            if entry is None or time.monotonic() - entry[3] > settings.SESSION_CACHE_TTL:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_key)
+            self.hits += 1
+            return entry[:3]
+
+    def set(self, session_key, session_data, expire_date, version):
+        with self._lock:
+            self._entries[session_key] = (session_data, expire_date, version, time.monotonic())
+            self._entries.move_to_end(session_key)
+            while len(self._entries) > settings.SESSION_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def extend(self, session_keys, expire_date):
+        with self._lock:
+            for session_key in session_keys:
+                if session_key in self._entries:
+                    session_data, old, version, cached_at = self._entries[session_key]
+                    self._entries[session_key] = (session_data, expire_date, version, cached_at)
+
+    def delete(self, session_key):
+        with self._lock:
+            self._entries.pop(session_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+CACHE = SessionCache()
+
+def _version_key(session_key):
+    return f'{KEY_PREFIX}:version:{session_key}'
+
+def get_version(session_key):
+    """The shared version of a session, None when it was not written lately."""
+    return cache.get(_version_key(session_key))
+
+def bump_version(session_key):
+    """Give a session a new shared version, and return it."""
+    version = uuid.uuid4().hex
+    # Outlives every entry cached in memory before the bump
+    cache.set(_version_key(session_key), version, 2 * settings.SESSION_CACHE_TTL)
+    return version
+
+_touch_lock = threading.Lock()
+_touched = set()
+_last_flush = time.monotonic()
+
+def flush_touches():
+    """Push back the expiry of the sessions loaded since the last flush; return how many were."""
+    global _last_flush
+    with _touch_lock:
+        keys, _last_flush = list(_touched), time.monotonic()
+        _touched.clear()
+    if not keys:
+        return 0
+    expire_date = timezone.now() + timedelta(seconds=settings.SESSION_COOKIE_AGE)
+    Session = SessionStore.get_model_class()
+    updated = 0
+    for start in range(0, len(keys), BATCH_SIZE):
+        updated += Session.objects.filter(
+            session_key__in=keys[start:start + BATCH_SIZE], expire_date__gt=timezone.now()
+        ).update(expire_date=expire_date)
+    CACHE.extend(keys, expire_date)
+    return updated
+
+@receiver(request_finished)
+def _flush_touches(sender, **kwargs):
+    if _touched and time.monotonic() - _last_flush >= FLUSH_INTERVAL:
+        flush_touches()
+
+class SessionStore(db.SessionStore):
+    # Serialized data as last loaded or saved
+    _loaded = None
+
+    def _dump(self, data):
+        return self.serializer().dumps(data)
+
+    def load(self):
+        session_key = self.session_key
+        entry = CACHE.get(session_key) if session_key else None
+        data = None
+        if entry is not None and entry[1] > timezone.now():
+            data = self.decode(entry[0])
+            if SESSION_KEY in data and get_version(session_key) != entry[2]:
+                # Logged in, and written or ended by another process since
+                data = None
+        if data is None:
+            # Read before the row, so a write in between retires the entry
+            version = get_version(session_key) if session_key else None
+            session = self._get_session_from_db()
+            if session is None:
+                CACHE.delete(session_key)
+                return {}
+            entry = session.session_data, session.expire_date, version
+            CACHE.set(session.session_key, *entry)
+            data = self.decode(entry[0])
+        self._loaded = self._dump(data)
+        stale_after = settings.SESSION_COOKIE_AGE - settings.SESSION_TOUCH_INTERVAL
+        if '_session_expiry' not in data and entry[1] < timezone.now() + timedelta(seconds=stale_after):
+            with _touch_lock:
+                _touched.add(session_key)
+            # SessionMiddleware sends the cookie again; save() writes nothing
+            self.modified = True
+        return data
+
+    def create_model_instance(self, data):
+        instance = super().create_model_instance(data)
+        self._saved = instance
+        return instance
+
+    def save(self, must_create=False):
+        if (not must_create and self.session_key is not None and self._loaded is not None
+                and self._dump(self._get_session()) == self._loaded):
+            return
+        super().save(must_create)
+        CACHE.set(self._saved.session_key, self._saved.session_data, self._saved.expire_date,
+                  bump_version(self._saved.session_key))
+        self._loaded = self._dump(self._get_session())
+
+    def delete(self, session_key=None):
+        session_key = session_key or self.session_key
+        super().delete(session_key)
+        if session_key is not None:
+            bump_version(session_key)
+            CACHE.delete(session_key)
+
+    @classmethod
+    def clear_expired(cls, batch_size=BATCH_SIZE):
+        """Delete expired sessions ``batch_size`` at a time, by the expiry index; return how many."""
+        Session = cls.get_model_class()
+        deleted = 0
+        while True:
+            keys = list(Session.objects.filter(expire_date__lt=timezone.now()).order_by(
+                'expire_date').values_list('session_key', flat=True)[:batch_size])
+            if not keys:
+                return deleted
+            deleted += Session.objects.filter(session_key__in=keys).delete()[0]
@@ -0,0 +1,96 @@
+"""
+Signal handlers keeping derived data in step with writes to the core models.
+"""
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
+from django.dispatch import receiver
+
+from . import caching, counters, rollups
+from .models import Category, Customer, PendingSale, Product, Sale, SaleItem, StockShard
+
+def _deleted_with(origin, *models):
+    """Whether a delete cascaded from an instance or queryset of ``models``."""
+    return isinstance(origin, models) or getattr(origin, 'model', None) in models
+
+@receiver(post_init, sender=Product)
+def snapshot_product(sender, instance, **kwargs):
+    instance._category_id = instance.__dict__.get('category_id') if instance.pk else None
+
+@receiver(pre_save, sender=Product)
+def load_product_snapshot(sender, instance, **kwargs):
+    if instance._category_id is None and instance.pk and not instance._state.adding:
+        instance._category_id = Product.objects.filter(pk=instance.pk).values_list(
+            'category_id', flat=True).first()
+
+@receiver(post_save, sender=Product)
+def count_product(sender, instance, created, **kwargs):
+    counters.record_product_change(None if created else instance._category_id, instance.category_id)
+    instance._category_id = instance.category_id
+
+@receiver(post_delete, sender=Product)
+def count_product_delete(sender, instance, origin=None, **kwargs):
+    if not _deleted_with(origin, Category):
+        counters.record_product_change(instance._category_id or instance.category_id, None)
+
+@receiver(post_init, sender=Sale)
+def snapshot_sale(sender, instance, **kwargs):
+    instance._rollup_state = rollups.sale_state(instance, loaded_only=True) if instance.pk else None
+
+@receiver(pre_save, sender=Sale)
+def load_sale_snapshot(sender, instance, **kwargs):
+    if instance._rollup_state is None and instance.pk and not instance._state.adding:
+        instance._rollup_state = rollups.load_sale_state(instance.pk)
+
+@receiver(post_save, sender=Sale)
+def roll_up_sale(sender, instance, created, **kwargs):
+    state = rollups.sale_state(instance)
+    old = None if created else instance._rollup_state
+    rollups.record_sale_change(instance.pk, old, state)
+    counters.record_sale_change(instance.pk, old, state)
+    if old and old.sale_date != state.sale_date:
+        # The items' copy of the date (their partition key on PostgreSQL)
+        SaleItem.objects.filter(sale=instance).update(sale_date=instance.sale_date)
+    instance._rollup_state = state
+
+@receiver(post_delete, sender=Sale)
+def roll_up_sale_delete(sender, instance, origin=None, **kwargs):
+    old = instance._rollup_state or rollups.sale_state(instance)
+    rollups.record_sale_change(instance.pk, old, None)
+    if not _deleted_with(origin, Customer):
+        counters.record_sale_change(instance.pk, old, None)
+
+@receiver(post_init, sender=SaleItem)
+def snapshot_sale_item(sender, instance, **kwargs):
+    instance._rollup_state = rollups.item_state(instance, loaded_only=True) if instance.pk else None
+
+@receiver(pre_save, sender=SaleItem)
+def load_sale_item_snapshot(sender, instance, **kwargs):
+    if instance._rollup_state is None and instance.pk and not instance._state.adding:
+        instance._rollup_state = rollups.load_item_state(instance.pk)
+
+@receiver(post_save, sender=SaleItem)
+def roll_up_sale_item(sender, instance, created, **kwargs):
+    state = rollups.item_state(instance)
+    old = None if created else instance._rollup_state
+    rollups.record_item_change(instance, old, state)
+    counters.record_item_change(instance, old, state)
+    instance._rollup_state = state
+
+@receiver(post_delete, sender=SaleItem)
+def roll_up_sale_item_delete(sender, instance, origin=None, **kwargs):
+    if _deleted_with(origin, Category):
+        # The category's products and all their rollup rows go in the same cascade
+        return
+    old = instance._rollup_state or rollups.item_state(instance)
+    rollups.record_item_change(instance, old, None)
+    if not _deleted_with(origin, Product):
+        counters.record_item_change(instance, old, None)
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Customer)
+@receiver([post_save, post_delete], sender=Sale)
+@receiver([post_save, post_delete], sender=SaleItem)
+@receiver([post_save, post_delete], sender=PendingSale)
+@receiver([post_save, post_delete], sender=StockShard)
+def bump_cache_version(sender, **kwargs):
+    caching.bump_version(sender)
@@ -0,0 +1,161 @@
+"""
+Stock bookkeeping for sales.
+
+A product's stock normally lives in ``Product.stock``, and a sale locks and
+decrements that row. Every sale of a hot product then queues on the same
+row lock. Such a product can be sharded with ``manage.py shard_stock``. Its
+stock is then split across ``stock_shard_count`` StockShard rows and the
+column is kept at 0. Each decrement takes the whole quantity from one
+shard, picked by the sale's id like its rollup rows (see products.rollups)
+and its counters (see products.counters), so concurrent sales of the
+product write different rows throughout, and the product row itself is
+never locked or written by a sale. Reads go through ``Product.available_stock`` (or
+``Product.objects.with_stock()``), which adds the shards to the column.
+"""
+import random
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.db import models, transaction
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+
+from . import counters
+from .models import Product, StockShard
+
+class InsufficientStock(Exception):
+    pass
+
+def lock_products(product_ids, lock_shards=False):
+    """
+    Return ``{pk: Product}`` for ``product_ids`` with ``available_stock`` set.
+    Unsharded products are locked in primary key order so that concurrent
+    sales cannot deadlock. Sharded products are not locked and their
+    ``available_stock`` is only a hint that decrement() enforces, unless
+    ``lock_shards`` is set, which locks all their shards as well.
+    """
+    products = {
+        product.pk: product
+        for product in Product.objects.select_for_update().filter(
+            pk__in=product_ids, stock_shard_count=0).order_by('pk')
+    }
+    for product in products.values():
+        product.available_stock = product.stock
+
+    rest = set(product_ids) - set(products)
+    if rest:
+        sharded = Product.objects.filter(pk__in=rest, stock_shard_count__gt=0).in_bulk()
+        shards = StockShard.objects.filter(product__in=sharded)
+        if lock_shards:
+            shards = shards.select_for_update().order_by('product_id', 'index')
+        totals = defaultdict(int)
+        for product_id, quantity in shards.values_list('product_id', 'quantity'):
+            totals[product_id] += quantity
+        for product in sharded.values():
+            product.available_stock = product.stock + totals[product.pk]
+        products.update(sharded)
+    return products
+
+def decrement(needed, products, sale_id=None):
+    """
+    Take ``{product_id: quantity}`` out of stock. ``products`` maps the ids
+    to the Products from lock_products(). A sharded product's quantity is
+    taken from shard ``sale_id % count`` when that holds enough, and from
+    a random one without ``sale_id``. Return ``{product_id: index}`` of
+    the shard each sharded product's quantity was taken from, which this
+    transaction now holds locked. Raises InsufficientStock, leaving the
+    caller to roll back, if any product would go negative.
+    """
+    plain = {
+        product_id: quantity for product_id, quantity in needed.items()
+        if not products[product_id].stock_shard_count
+    }
+    if plain:
+        enough_stock = reduce(or_, (
+            Q(pk=product_id, stock__gte=quantity) for product_id, quantity in plain.items()
+        ))
+        updated = Product.objects.filter(enough_stock).update(
+            stock=Case(
+                *(When(pk=product_id, then=F('stock') - quantity)
+                  for product_id, quantity in plain.items()),
+                output_field=models.PositiveIntegerField()
+            ),
+            updated_at=timezone.now()
+        )
+        if updated != len(plain):
+            raise InsufficientStock()
+
+    # Shards are always taken in product order, for the same reason
+    return {
+        product_id: _take_from_shards(products[product_id], needed[product_id], sale_id)
+        for product_id in sorted(set(needed) - set(plain))
+    }
+
+def _take_from_shards(product, quantity, sale_id=None):
+    """Take ``quantity`` from ``product``'s shards; return the index of the shard written."""
+    count = product.stock_shard_count
+    shards = StockShard.objects.filter(product=product)
+    start = random.randrange(count) if sale_id is None else sale_id % count
+    for offset in range(count):
+        index = (start + offset) % count
+        if shards.filter(index=index, quantity__gte=quantity).update(
+                quantity=F('quantity') - quantity):
+            return index
+
+    # No single shard holds enough: drain them in index order
+    rows = list(shards.select_for_update().order_by('index'))
+    if sum(row.quantity for row in rows) < quantity:
+        raise InsufficientStock()
+    for row in rows:
+        taken = min(row.quantity, quantity)
+        row.quantity -= taken
+        quantity -= taken
+    StockShard.objects.bulk_update(rows, ['quantity'])
+    return rows[0].index
+
+def _spread(product, total, count):
+    """Replace ``product``'s shards with ``count`` rows holding ``total`` between them."""
+    counters.fold_shards(product)
+    StockShard.objects.filter(product=product).delete()
+    StockShard.objects.bulk_create(
+        StockShard(product=product, index=index,
+                   quantity=total // count + (index < total % count))
+        for index in range(count)
+    )
+
+def set_stock(product, total):
+    """
+    Set ``product``'s total stock, e.g. from a form. A sharded product's
+    shards are rewritten; otherwise ``product.stock`` is set and the caller
+    saves it.
+    """
+    if product.stock_shard_count:
+        with transaction.atomic():
+            list(StockShard.objects.select_for_update().filter(product=product))
+            _spread(product, total, product.stock_shard_count)
+        product.stock = 0
+    else:
+        product.stock = total
+    product.available_stock = total
+
+def shard(product_id, count):
+    """
+    Split a product's stock across ``count`` shards, or with ``count`` 0
+    move it back into ``Product.stock``.
+    """
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(pk=product_id)
+        shards = StockShard.objects.select_for_update().filter(product=product)
+        total = product.stock + sum(shards.values_list('quantity', flat=True))
+        if count:
+            _spread(product, total, count)
+            product.stock = 0
+        else:
+            counters.fold_shards(product)
+            shards.delete()
+            product.stock = total
+        product.stock_shard_count = count
+        product.save(update_fields=['stock', 'stock_shard_count', 'updated_at'])
+        product.available_stock = total
+    return product
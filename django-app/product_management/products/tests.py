@@ -0,0 +1,1980 @@
+import csv
+import datetime
+import functools
+import gzip
+import io
+import json
+import re
+import threading
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock, skipIf, skipUnless
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from django import forms
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, get_user_model
+from django.contrib.sessions.models import Session
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import Count, F, Sum
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import parse_http_date
+from django.utils.translation import gettext_lazy
+from psycopg2 import extensions
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import BasePermission
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from product_management.postgresql_pool import base as pooling
+
+from . import (
+    autocomplete, caching, conditional, fastread, ingest, pagination, partitioning, prefetch, querycache, renderers,
+    rollups, routing, search, sessions, stock, topk, writebehind
+)
+from .apps import install_search_indexes
+from .management.commands import generate_dataset
+from .models import (
+    BestSellerSummary, Category, Customer, DailyCategorySales, DailyProductSales, DailySales, PendingSale, Product,
+    Sale, SaleItem, StockShard
+)
+from .parsers import FastJSONParser, MessagePackParser
+from .renderers import FastJSONRenderer, MessagePackRenderer
+from .serializers import CategorySerializer, CustomerSerializer, ProductSerializer, SaleItemSerializer, SaleSerializer
+from .views import (
+    CategoryViewSet, CustomerViewSet, DashboardView, PendingSaleViewSet, ProductViewSet, SaleItemViewSet, SaleViewSet
+)
+
+INITIAL_STOCK = 1_000
+STATUSES = ['cancelled', 'completed', 'pending']
+
+def create_catalog(products=3, stock=INITIAL_STOCK):
+    category = Category.objects.create(name='Tools', description='Hand tools')
+    return category, [
+        Product.objects.create(
+            name=f'Product {index}', description='A product', category=category,
+            price=Decimal('10.00'), stock=stock
+        )
+        for index in range(products)
+    ]
+
+def create_customer(email='customer@example.com'):
+    return Customer.objects.create(name='Customer', email=email, address='1 Main Street')
+
+def create_sale(customer, lines, status='completed'):
+    """A sale of ``lines``, ``(product, quantity)`` pairs, made by SaleSerializer."""
+    items = [{'product': product.pk, 'quantity': quantity} for product, quantity in lines]
+    serializer = SaleSerializer(
+        data={'customer': customer.pk, 'total_amount': '0', 'status': status},
+        context={'items': items},
+    )
+    serializer.is_valid(raise_exception=True)
+    return serializer.save()
+
+class PrimaryClient(Client):
+    """
+    A test client that reads from the primary, where a TestCase's uncommitted
+    rows are, when a replica is configured.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cookies[routing.PIN_COOKIE] = '1'
+
+class SaleCreateTests(TestCase):
+    def setUp(self):
+        self.category, self.products = create_catalog(products=10)
+        self.customer = create_customer()
+
+    def statements(self, lines):
+        with CaptureQueriesContext(connection) as queries:
+            create_sale(self.customer, [(product, 1) for product in self.products[:lines]])
+        return [
+            query['sql'] for query in queries
+            if query['sql'].split(' ', 1)[0] not in ('SAVEPOINT', 'RELEASE', 'ROLLBACK')
+        ]
+
+    def test_statements_do_not_grow_with_lines(self):
+        create_sale(self.customer, [(self.products[0], 1)])  # creates today's rollup rows
+        one, ten = self.statements(1), self.statements(10)
+        # The per-row path issued 2N + 2 statements
+        self.assertLess(len(ten), 2 * 10 + 2)
+        self.assertEqual(
+            len([sql for sql in ten if 'products_dailyproductsales' not in sql]),
+            len([sql for sql in one if 'products_dailyproductsales' not in sql]),
+        )
+
+    def test_stock_decremented(self):
+        create_sale(self.customer, [(self.products[0], 3), (self.products[1], 2), (self.products[0], 1)])
+        stock = dict(Product.objects.with_stock().values_list('pk', 'available_stock'))
+        self.assertEqual(stock[self.products[0].pk], INITIAL_STOCK - 4)
+        self.assertEqual(stock[self.products[1].pk], INITIAL_STOCK - 2)
+
+# Committed sales reach the summaries before the next assertion, and no flush
+# timer outlives the test
+unbuffered_best_sellers = override_settings(BEST_SELLERS_FLUSH_INTERVAL=0)
+
+@unbuffered_best_sellers
+class BestSellerTests(TransactionTestCase):
+    def setUp(self):
+        self.category, self.products = create_catalog()
+        self.customer = create_customer()
+
+    def assertSummariesMatchSales(self):
+        sold = SaleItem.objects.aggregate(quantity=Sum('quantity'), revenue=Sum('total_price'))
+        for row in BestSellerSummary.objects.all():
+            self.assertEqual(row.total, sold[row.metric], f'{row.metric} {row.period}')
+        for product in self.products:
+            quantity = SaleItem.objects.filter(product=product).aggregate(total=Sum('quantity'))['total']
+            self.assertEqual(
+                BestSellerSummary.objects.get(metric='quantity', period=topk.ALL_TIME).counters[str(product.pk)],
+                [str(quantity), '0'],
+            )
+
+    def test_summaries_follow_sales(self):
+        create_sale(self.customer, [(self.products[0], 3), (self.products[1], 1)])
+        create_sale(self.customer, [(self.products[1], 5), (self.products[2], 2)])
+        self.assertEqual(BestSellerSummary.objects.count(), 4)
+        self.assertSummariesMatchSales()
+        self.assertEqual(
+            [row['product'] for row in topk.best_sellers(3)],
+            [self.products[1].pk, self.products[0].pk, self.products[2].pk],
+        )
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_concurrent_sales_lose_no_updates(self):
+        threads, sales = 8, 10
+        failures = []
+
+        def worker(index):
+            try:
+                for sale in range(sales):
+                    create_sale(self.customer, [
+                        (self.products[(index + sale) % 3], 1),
+                        (self.products[(index + sale + 1) % 3], 2),
+                    ])
+            except Exception as exc:
+                failures.append(exc)
+            finally:
+                connection.close()
+
+        pool = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(SaleItem.objects.aggregate(total=Sum('quantity'))['total'], threads * sales * 3)
+        sold = dict(SaleItem.objects.values_list('product_id').order_by().annotate(total=Sum('quantity')))
+        for product in Product.objects.with_stock():
+            self.assertEqual(product.available_stock, INITIAL_STOCK - sold[product.pk], product.name)
+        self.assertSummariesMatchSales()
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_summary_inserted_by_another_transaction_is_locked(self):
+        day = timezone.localdate().isoformat()
+        get_or_create = BestSellerSummary.objects.get_or_create
+        racing = threading.current_thread()
+        blocked = []
+
+        def apply_in_thread(weight):
+            def work():
+                try:
+                    topk._apply(day, {'quantity': {self.products[0].pk: Decimal(weight)}})
+                finally:
+                    connection.close()
+            return threading.Thread(target=work)
+
+        def racing_get_or_create(**kwargs):
+            if threading.current_thread() is not racing or blocked:
+                return get_or_create(**kwargs)
+            # Both rows are inserted after this transaction's locking read found none
+            inserting = apply_in_thread(1)
+            inserting.start()
+            inserting.join()
+            row = get_or_create(**kwargs)
+            # Waits for this transaction if it locked the row
+            blocked.append(apply_in_thread(10))
+            blocked[0].start()
+            blocked[0].join(timeout=1)
+            return row
+
+        with mock.patch.object(BestSellerSummary.objects, 'get_or_create', racing_get_or_create):
+            topk._apply(day, {'quantity': {self.products[0].pk: Decimal(100)}})
+        blocked[0].join()
+
+        for row in BestSellerSummary.objects.all():
+            self.assertEqual(row.total, 111, row.period)
+
+    @override_settings(BEST_SELLERS_FLUSH_INTERVAL=60)
+    def test_committed_sales_are_buffered(self):
+        with mock.patch.object(topk, '_apply', wraps=topk._apply) as apply:
+            create_sale(self.customer, [(self.products[0], 3), (self.products[1], 1)])
+            create_sale(self.customer, [(self.products[1], 5), (self.products[2], 2)])
+            self.assertFalse(BestSellerSummary.objects.exists())
+            topk.flush()
+        # One locked update for both sales
+        self.assertEqual(apply.call_count, 1)
+        self.assertSummariesMatchSales()
+
+    @override_settings(BEST_SELLERS_FLUSH_INTERVAL=0.1)
+    def test_buffer_flushed_after_interval(self):
+        create_sale(self.customer, [(product, 1) for product in self.products])
+        timer = topk._flush_timer
+        self.assertIsNotNone(timer)
+        timer.join(timeout=5)
+        self.assertIsNone(topk._flush_timer)
+        self.assertSummariesMatchSales()
+
+    @override_settings(BEST_SELLERS_FLUSH_INTERVAL=60)
+    def test_rebuild_drops_buffered_sales(self):
+        create_sale(self.customer, [(product, 1) for product in self.products])
+        topk.rebuild()
+        topk.flush()
+        self.assertSummariesMatchSales()
+
+class BulkIngestTests(TestCase):
+    def setUp(self):
+        self.category, self.products = create_catalog()
+        self.customer = create_customer()
+
+    def post(self, records):
+        return self.client.post('/api/sales/bulk/', '\n'.join(map(json.dumps, records)),
+                                content_type='application/x-ndjson')
+
+    def test_records_are_validated_one_by_one(self):
+        sale = {'customer': self.customer.pk, 'status': 'completed',
+                'items': [{'product': self.products[0].pk, 'quantity': 2}]}
+        response = self.post([
+            sale,
+            {**sale, 'customer': 2 ** 70},
+            {**sale, 'items': [{'product': 2 ** 70, 'quantity': 1}]},
+            {**sale, 'items': [{'product': -2 ** 63 - 1, 'quantity': 1}]},
+            {**sale, 'items': [{'product': self.products[1].pk, 'quantity': INITIAL_STOCK + 1}]},
+            {**sale, 'customer': 2 ** 63 - 1},
+            sale,
+        ])
+
+        self.assertEqual(response.status_code, 200, response.content)
+        body = response.json()
+        self.assertEqual((body['created'], body['failed']), (2, 5))
+        self.assertEqual(
+            [(result['index'], result['status'], sorted(result.get('errors', ()))) for result in body['results']],
+            [(0, 'created', []), (1, 'error', ['customer']), (2, 'error', ['items']), (3, 'error', ['items']),
+             (4, 'error', ['items']), (5, 'error', ['customer']), (6, 'created', [])],
+        )
+        self.assertEqual(Sale.objects.count(), 2)
+        self.assertEqual(Product.objects.with_stock().get(pk=self.products[0].pk).available_stock,
+                         INITIAL_STOCK - 4)
+
+    def test_malformed_input_keeps_records_before_it(self):
+        sale = {'customer': self.customer.pk, 'items': [{'product': self.products[0].pk, 'quantity': 1}]}
+        response = self.client.post('/api/sales/bulk/', json.dumps(sale) + '\n{"customer": ',
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['created'], 1)
+        self.assertEqual(Sale.objects.count(), 1)
+
+@skipUnless(connection.vendor == 'postgresql', 'Needs row locks')
+@unbuffered_best_sellers
+class ConcurrentIngestTests(TransactionTestCase):
+    def setUp(self):
+        self.category, self.products = create_catalog(products=4)
+        self.customer = create_customer()
+        # The rollup rows exist, so every chunk locks the ones it adds to
+        for status in STATUSES:
+            create_sale(self.customer, [(product, 1) for product in self.products], status)
+
+    def rollup_rows(self):
+        return {model.__name__: sorted(model.objects.values_list(*fields))
+                for model, fields in [
+                    (DailySales, ('date', 'status', 'shard', 'sales_count', 'total_amount')),
+                    (DailyProductSales, ('date', 'status', 'shard', 'product', 'quantity', 'total_amount')),
+                    (DailyCategorySales, ('date', 'status', 'shard', 'category', 'quantity', 'total_amount')),
+                ]}
+
+    def test_concurrent_chunks_and_sales(self):
+        threads, chunks = 4, 10
+        failures = []
+
+        def worker(index):
+            # Each thread has its own product, and meets the statuses in its own order
+            product = self.products[index]
+            statuses = STATUSES[index % 3:] + STATUSES[:index % 3]
+            try:
+                for chunk in range(chunks):
+                    records = [{'customer': self.customer.pk, 'status': status,
+                                'items': [{'product': product.pk, 'quantity': 1}]} for status in statuses]
+                    if index % 2:
+                        results = list(ingest.ingest_sales(records))
+                        self.assertEqual({result['status'] for result in results}, {'created'})
+                    else:
+                        for status in statuses:
+                            create_sale(self.customer, [(product, 1)], status)
+            except Exception as exc:
+                failures.append(exc)
+            finally:
+                connection.close()
+
+        pool = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(Sale.objects.count(), len(STATUSES) * (1 + threads * chunks))
+        rows = self.rollup_rows()
+        rollups.rebuild_rollups()
+        self.assertEqual(rows, self.rollup_rows())
+
+@skipUnless(connection.vendor == 'postgresql', 'Row lock waits are only observable on PostgreSQL')
+@unbuffered_best_sellers
+class HotProductTests(TransactionTestCase):
+    """Concurrent sales of one sharded product write different rows."""
+
+    def setUp(self):
+        self.category, self.products = create_catalog(products=1)
+        stock.shard(self.products[0].pk, rollups.SHARDS)
+        # Every row a sale of the product adds to exists, as it does for a hot product
+        for index in range(rollups.SHARDS):
+            create_sale(create_customer(f'warm{index}@example.com'), [(self.products[0], 1)])
+
+    def test_open_sale_does_not_block_the_next(self):
+        holding, release = threading.Event(), threading.Event()
+        failures = []
+
+        def hold():
+            try:
+                with transaction.atomic():
+                    create_sale(create_customer('first@example.com'), [(self.products[0], 1)])
+                    holding.set()
+                    release.wait(timeout=10)
+            except Exception as exc:
+                failures.append(exc)
+            finally:
+                holding.set()
+                connection.close()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        holding.wait()
+        customer = create_customer('second@example.com')
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    # Raises instead of waiting for a row the open sale holds
+                    cursor.execute("SET LOCAL lock_timeout = '2s'")
+                create_sale(customer, [(self.products[0], 1)])
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(Product.objects.with_stock().get().total_units_sold, rollups.SHARDS + 2)
+
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        self.category, self.products = create_catalog()
+        self.customer = create_customer()
+
+    def enqueue(self, product, quantity=1):
+        return writebehind.enqueue(self.customer.pk, 'completed', [(product.pk, quantity)])
+
+    def test_sales_are_dated_when_accepted(self):
+        pending = self.enqueue(self.products[0], 2)
+        accepted = timezone.now() - timedelta(hours=3)
+        PendingSale.objects.filter(pk=pending.pk).update(created_at=accepted)
+
+        self.assertEqual(writebehind.drain(), 1)
+        pending.refresh_from_db()
+        self.assertEqual(pending.status, 'created')
+        self.assertEqual(pending.sale.sale_date, accepted)
+        self.assertEqual(list(pending.sale.items.values_list('sale_date', 'quantity')), [(accepted, 2)])
+
+    def test_rows_that_cannot_be_written_are_failed(self):
+        rows = [self.enqueue(product) for product in self.products]
+        poison = rows[1].pk
+        write_chunk = ingest.write_chunk
+
+        def failing_write_chunk(chunk, *args, **kwargs):
+            if any(key == poison for key, record in chunk):
+                raise ValueError('Poison')
+            return write_chunk(chunk, *args, **kwargs)
+
+        with mock.patch.object(ingest, 'write_chunk', failing_write_chunk):
+            self.assertEqual(writebehind.drain(), 3)
+        self.assertEqual(writebehind.drain(), 0)
+
+        statuses = dict(PendingSale.objects.values_list('pk', 'status'))
+        self.assertEqual([statuses[row.pk] for row in rows], ['created', 'failed', 'created'])
+        self.assertEqual(PendingSale.objects.get(pk=poison).errors,
+                         {'non_field_errors': ['The sale could not be written.']})
+        self.assertEqual(Sale.objects.count(), 2)
+
+    def test_transient_errors_leave_the_batch_queued(self):
+        self.enqueue(self.products[0])
+        with mock.patch.object(ingest, 'write_chunk', side_effect=OperationalError('deadlock detected')):
+            with self.assertRaises(OperationalError):
+                writebehind.drain()
+        self.assertEqual(PendingSale.objects.get().status, 'queued')
+        self.assertEqual(writebehind.drain(), 1)
+        self.assertEqual(PendingSale.objects.get().status, 'created')
+
+class DenyObjects(BasePermission):
+    def has_object_permission(self, request, view, obj):
+        return False
+
+# Error responses outside a request transaction would roll back the test's own
+error_responses = override_settings(SAFE_REQUEST_TRANSACTION='atomic')
+
+class FastReadTests(TestCase):
+    client_class = PrimaryClient
+    viewsets = [CategoryViewSet, ProductViewSet, CustomerViewSet, SaleViewSet, SaleItemViewSet,
+                PendingSaleViewSet]
+
+    def setUp(self):
+        self.category, self.products = create_catalog()
+        self.customer = create_customer()
+        self.sales = [
+            create_sale(self.customer, [(self.products[0], 2), (self.products[1], 1)]),
+            create_sale(self.customer, [(self.products[2], 3)], status='pending'),
+            create_sale(self.customer, []),
+        ]
+        writebehind.enqueue(self.customer.pk, 'completed', [(self.products[0].pk, 1)])
+        writebehind.drain()
+        self.context = {'request': Request(APIRequestFactory().get('/api/'))}
+
+    def serialize(self, viewset, queryset):
+        return viewset.serializer_class(queryset, many=True, context=self.context).data
+
+    def test_output_is_byte_identical(self):
+        renderer = JSONRenderer()
+        for viewset in self.viewsets:
+            with self.subTest(viewset.__name__):
+                queryset = viewset.queryset.order_by('pk')
+                self.assertTrue(queryset.exists())
+                self.assertEqual(
+                    renderer.render(fastread.serialize(viewset.serializer_class, queryset, self.context)),
+                    renderer.render(self.serialize(viewset, queryset)),
+                )
+
+    def test_endpoints_match_serializers(self):
+        for viewset, url in [(ProductViewSet, '/api/products/'), (CustomerViewSet, '/api/customers/'),
+                             (SaleViewSet, '/api/sales/'), (SaleItemViewSet, '/api/sale-items/')]:
+            for instance in viewset.queryset.all():
+                with self.subTest(f'{url}{instance.pk}/'):
+                    response = self.client.get(f'{url}{instance.pk}/')
+                    self.assertEqual(response.status_code, 200)
+                    expected = self.serialize(viewset, viewset.queryset.filter(pk=instance.pk))[0]
+                    self.assertEqual(response.json(), json.loads(JSONRenderer().render(expected)))
+
+    def test_fields_and_expand(self):
+        sale = self.sales[0]
+        self.customer.refresh_from_db()
+        response = self.client.get(f'/api/sales/{sale.pk}/?fields=id,customer,items&expand=customer')
+        self.assertEqual(response.status_code, 200)
+        full = json.loads(JSONRenderer().render(self.serialize(SaleViewSet, Sale.objects.filter(pk=sale.pk))[0]))
+        self.assertEqual(response.json(), {
+            'id': sale.pk,
+            'customer': json.loads(JSONRenderer().render(CustomerSerializer(self.customer).data)),
+            'items': full['items'],
+        })
+        response = self.client.get('/api/products/?fields=name,category&expand=category')
+        self.assertEqual(response.status_code, 200)
+        self.category.refresh_from_db()
+        category = json.loads(JSONRenderer().render(CategorySerializer(self.category).data))
+        self.assertEqual([row['category'] for row in response.json()['results']], [category] * 3)
+
+    @error_responses
+    def test_invalid_fields_are_rejected(self):
+        for url in ['/api/products/?fields=', '/api/products/?fields=,', '/api/products/?fields=name,colour',
+                    f'/api/products/{self.products[0].pk}/?fields=', '/api/sales/?fields=', '/api/sales/?expand=items']:
+            with self.subTest(url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(list(response.json()), [url.rsplit('?', 1)[1].split('=')[0]])
+
+    @error_responses
+    def test_invalid_ids_are_not_found(self):
+        for url in ['/api/products/abc/', '/api/sales/1.5/', f'/api/customers/{self.customer.pk + 1}/',
+                    '/api/sale-queue/abc/']:
+            with self.subTest(url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+    @error_responses
+    def test_object_permissions_are_checked(self):
+        with mock.patch.object(ProductViewSet, 'permission_classes', [DenyObjects]):
+            self.assertEqual(self.client.get(f'/api/products/{self.products[0].pk}/').status_code, 403)
+            self.assertEqual(self.client.get('/api/products/abc/').status_code, 404)
+            self.assertEqual(self.client.get('/api/products/').status_code, 200)
+
+class PaginationTests(TestCase):
+    client_class = PrimaryClient
+
+    def setUp(self):
+        self.category, self.products = create_catalog()
+        self.customer = create_customer()
+
+    def get(self, url, status=200):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status, response.content)
+        return response.json()
+
+    def paginate(self, queryset, url):
+        paginator = pagination.KeysetPagination()
+        rows = paginator.paginate_queryset(queryset, Request(APIRequestFactory().get(url)))
+        return paginator.get_paginated_response([{'id': row.pk} for row in rows]).data
+
+    def walk(self, fetch, url):
+        """The ids of every page from ``url`` on, following ``next``, then back following ``previous``."""
+        forward, backward, pages = [], [], []
+        while url:
+            page = fetch(url)
+            pages.append(page)
+            forward += [row['id'] for row in page['results']]
+            url = page['next']
+        url = pages[-1]['previous']
+        while url:
+            page = fetch(url)
+            backward = [row['id'] for row in page['results']] + backward
+            url = page['previous']
+        return forward, backward + [row['id'] for row in pages[-1]['results']]
+
+    def test_cursors_walk_equal_sort_keys(self):
+        # Ordered by name, then pk: pages end in the middle of the equal names
+        for _ in range(7):
+            Product.objects.create(name='Same', description='A product', category=self.category,
+                                   price=Decimal('1.00'), stock=1)
+        expected = list(Product.objects.order_by('name', 'pk').values_list('pk', flat=True))
+        self.assertEqual(self.walk(self.get, '/api/products/?page_size=3'), (expected, expected))
+
+        # Descending, as the sales list orders them
+        for _ in range(5):
+            create_sale(self.customer, [(self.products[0], 1)])
+        Sale.objects.update(sale_date=timezone.now())
+        queryset = Sale.objects.order_by('-sale_date', '-pk')
+        expected = list(queryset.values_list('pk', flat=True))
+        fetch = functools.partial(self.paginate, queryset)
+        self.assertEqual(self.walk(fetch, '/api/sales/?page_size=2'), (expected, expected))
+
+    @error_responses
+    def test_invalid_cursor(self):
+        cursor = parse_qs(urlsplit(self.get('/api/products/?page_size=1')['next']).query)['cursor'][0]
+        unsigned = signing.dumps([['Product 0', self.products[0].pk], False], compress=True)
+        other_ordering = pagination.encode_cursor(['Product 0'])
+        for label, value in [('tampered', cursor[:-2] + ('AA' if cursor[-2:] != 'AA' else 'BB')),
+                             ('unsigned', unsigned), ('garbage', 'garbage'), ('other ordering', other_ordering)]:
+            with self.subTest(label):
+                self.assertEqual(self.get(f'/api/products/?{urlencode({"cursor": value})}', status=400),
+                                 pagination.INVALID_CURSOR)
+
+    def test_page_size(self):
+        Product.objects.bulk_create(
+            Product(name=f'Bulk {index:03}', description='A product', category=self.category,
+                    price=Decimal('1.00'), stock=1)
+            for index in range(pagination.KeysetPagination.max_page_size)
+        )
+        for page_size, expected in [('1000', pagination.KeysetPagination.max_page_size), ('0', 1), ('-5', 1),
+                                    ('x', pagination.KeysetPagination.page_size), ('7', 7)]:
+            with self.subTest(page_size):
+                self.assertEqual(len(self.get(f'/api/products/?page_size={page_size}')['results']), expected)
+
+    def test_count(self):
+        self.assertEqual(self.get('/api/products/')['count'], 3)
+        with CaptureQueriesContext(connection) as queries:
+            page = self.get('/api/products/?count=false')
+        self.assertIsNone(page['count'])
+        self.assertEqual(len(page['results']), 3)
+        self.assertFalse([query['sql'] for query in queries if 'COUNT(' in query['sql']])
+
+class ExportTests(TestCase):
+    client_class = PrimaryClient
+
+    def setUp(self):
+        self.category, self.products = create_catalog()
+        self.customer = create_customer()
+        self.sales = [
+            create_sale(self.customer, [(self.products[index % 3], 1), (self.products[(index + 1) % 3], 2)],
+                        status=STATUSES[index % 3])
+            for index in range(6)
+        ]
+        for index, sale in enumerate(self.sales):
+            sale.sale_date = timezone.make_aware(datetime.datetime(2024, 1, 1 + index, 12))
+        Sale.objects.bulk_update(self.sales, ['sale_date'])
+
+    def export(self, url, **headers):
+        response = self.client.get(url, **headers)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content)
+
+    def ndjson(self, url):
+        response, body = self.export(url)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line) for line in body.decode().splitlines()]
+
+    def test_ndjson(self):
+        listed = self.client.get('/api/sales/?page_size=100').json()['results']
+        self.assertEqual(self.ndjson('/api/sales/export/'), listed)
+
+    def test_csv(self):
+        response, body = self.export('/api/sales/export/?format=csv')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="sales.csv"')
+        rows = list(csv.DictReader(io.StringIO(body.decode())))
+        expected = self.ndjson('/api/sales/export/')
+        self.assertEqual(list(rows[0]), list(expected[0]))
+        self.assertEqual([row['id'] for row in rows], [str(row['id']) for row in expected])
+        self.assertEqual([row['status'] for row in rows], [row['status'] for row in expected])
+        # Nested values are written as JSON
+        self.assertEqual([json.loads(row['items']) for row in rows], [row['items'] for row in expected])
+
+    def test_filters(self):
+        def ids(url):
+            return [row['id'] for row in self.ndjson(url)]
+
+        completed = [sale.pk for sale in self.sales if sale.status == 'completed']
+        self.assertEqual(ids('/api/sales/export/?status=completed'), completed)
+        self.assertEqual(ids('/api/sales/export/?from=2024-01-02&to=2024-01-04'),
+                         [sale.pk for sale in self.sales[1:4]])
+        self.assertEqual(ids('/api/sales/export/?status=completed&from=2024-01-03'), completed[1:])
+        self.assertEqual(
+            [row['sale'] for row in self.ndjson('/api/sale-items/export/?status=completed&to=2024-01-02')],
+            [completed[0]] * 2
+        )
+
+    @error_responses
+    def test_invalid_parameters(self):
+        for query in ['from=2024-13-01', 'to=yesterday', 'after=x']:
+            with self.subTest(query):
+                self.assertEqual(self.client.get(f'/api/sales/export/?{query}').status_code, 400)
+
+    @override_settings(EXPORT_MAX_ROWS=4)
+    def test_next_link(self):
+        exported, url, responses = [], '/api/sales/export/?format=ndjson', 0
+        while url:
+            response, body = self.export(url)
+            rows = [json.loads(line) for line in body.decode().splitlines()]
+            self.assertLessEqual(len(rows), 4)
+            exported += [row['id'] for row in rows]
+            links = response.get('Link')
+            url = re.fullmatch(r'<(.+)>; rel="next"', links).group(1) if links else None
+            responses += 1
+        self.assertEqual(responses, 2)
+        self.assertEqual(exported, [sale.pk for sale in self.sales])
+
+        # Exactly EXPORT_MAX_ROWS rows: no next link
+        response, body = self.export('/api/sales/export/?after=%d' % self.sales[1].pk)
+        self.assertEqual(len(body.splitlines()), 4)
+        self.assertNotIn('Link', response)
+        # limit pages the same way, up to EXPORT_MAX_ROWS
+        for limit, rows in [(2, 2), (5, 4)]:
+            response, body = self.export(f'/api/sales/export/?limit={limit}')
+            self.assertEqual(len(body.splitlines()), rows)
+            self.assertIn('after=%d' % self.sales[rows - 1].pk, response['Link'])
+
+    def test_gzip(self):
+        plain_response, plain = self.export('/api/customers/export/?format=csv')
+        response, body = self.export('/api/customers/export/?format=csv', HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertNotIn('Content-Encoding', plain_response)
+        self.assertIn('Accept-Encoding', plain_response['Vary'])
+        self.assertEqual(gzip.decompress(body), plain)
+        self.assertEqual(plain.decode().splitlines()[1].split(',')[0], str(self.customer.pk))
+
+class QueryCountTests(TestCase):
+    """Queries per endpoint, which must not grow with the rows or nested items returned."""
+    client_class = PrimaryClient
+    endpoints = [
+        ('/api/categories/', 2),
+        ('/api/categories/{category}/', 1),
+        ('/api/categories/{category}/products/', 3),
+        ('/api/products/', 2),
+        ('/api/products/{product}/', 1),
+        ('/api/products/?expand=category', 3),
+        ('/api/products/low_stock/', 2),
+        ('/api/customers/', 2),
+        ('/api/customers/{customer}/', 1),
+        ('/api/customers/{customer}/purchase_history/', 4),
+        ('/api/sales/', 3),
+        ('/api/sales/{sale}/', 2),
+        ('/api/sales/?expand=customer', 4),
+        ('/api/sale-items/', 2),
+        ('/api/sale-items/{item}/', 1),
+        ('/api/sale-items/?expand=product', 3),
+        ('/api/sale-queue/', 2),
+        ('/api/sale-queue/{pending}/', 1),
+    ]
+
+    def setUp(self):
+        self.category, self.products = create_catalog(products=2)
+        self.customer = create_customer()
+        self.sale = create_sale(self.customer, [(self.products[0], 1)])
+        self.pending = writebehind.enqueue(self.customer.pk, 'completed', [(self.products[0].pk, 1)])
+
+    def add_rows(self):
+        self.products += create_catalog(products=10)[1]
+        for index in range(5):
+            create_sale(create_customer(f'customer{index}@example.com'),
+                        [(product, 1) for product in self.products])
+        for _ in range(5):
+            writebehind.enqueue(self.customer.pk, 'completed', [(self.products[1].pk, 1)])
+        writebehind.drain()
+
+    def assertEndpointQueries(self):
+        ids = {'category': self.category.pk, 'product': self.products[0].pk, 'customer': self.customer.pk,
+               'sale': self.sale.pk, 'item': self.sale.items.get().pk, 'pending': self.pending.pk}
+        for url, queries in self.endpoints:
+            url = url.format(**ids)
+            with self.subTest(url), self.assertNumQueries(queries):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_endpoint_queries(self):
+        self.assertEndpointQueries()
+
+    def test_endpoint_queries_with_more_rows(self):
+        self.add_rows()
+        self.assertEndpointQueries()
+
+    def test_serializers_with_eager_loading(self):
+        self.add_rows()
+        for serializer_class, queryset, queries in [
+            (ProductSerializer, ProductSerializer.read_queryset(), 1),
+            (SaleSerializer, Sale.objects.all(), 2),
+            (SaleItemSerializer, SaleItem.objects.all(), 1),
+        ]:
+            with self.subTest(serializer_class.__name__), self.assertNumQueries(queries):
+                data = serializer_class(prefetch.for_serializer(queryset, serializer_class), many=True).data
+                self.assertGreater(len(data), 10)
+
+@override_settings(CONDITIONAL_GET=True)
+class ConditionalGetTests(TestCase):
+    client_class = PrimaryClient
+
+    def setUp(self):
+        # Writes and reads are seconds apart, so that Last-Modified is sent
+        self.now = time.time()
+        for module in (caching, conditional):
+            patcher = mock.patch.object(module, 'time', mock.Mock(wraps=time, time=lambda: self.now))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category, self.products = create_catalog()
+            # Last-Modified needs the time of a write to every model read
+            for model in apps.get_app_config('products').get_models():
+                caching.bump_version(model)
+
+    def validators(self, path='/api/products/', **headers):
+        self.now += 5
+        response = self.client.get(path, **headers)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag'], response['Last-Modified']
+
+    def write(self, method, path, data=None):
+        self.now += 5
+        with self.captureOnCommitCallbacks(execute=True):
+            response = getattr(self.client, method)(path, data and json.dumps(data), content_type='application/json')
+        self.assertLess(response.status_code, 300, response.content)
+
+    def test_matching_validators_are_not_modified(self):
+        etag, last_modified = self.validators()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(
+                self.client.get('/api/products/', HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(self.client.get('/api/products/', HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_writes_change_validators(self):
+        seen = [self.validators()]
+        product = self.products[0].pk
+        for method, path, data in [
+                ('post', '/api/products/', {'name': 'New', 'description': 'A product', 'price': '5.00',
+                                            'stock': 1, 'category': self.category.pk}),
+                ('patch', f'/api/products/{product}/', {'price': '12.00'}),
+                ('delete', f'/api/products/{product}/', None)]:
+            with self.subTest(method):
+                self.write(method, path, data)
+                etag, last_modified = self.validators()
+                self.assertNotIn(etag, [old for old, _ in seen])
+                self.assertGreater(parse_http_date(last_modified), parse_http_date(seen[-1][1]))
+                self.assertEqual(self.client.get('/api/products/', HTTP_IF_NONE_MATCH=seen[-1][0]).status_code,
+                                 200)
+                seen.append((etag, last_modified))
+
+    def test_etag_varies_with_accept_and_user(self):
+        etags = [
+            self.validators()[0],
+            self.validators(HTTP_ACCEPT='application/json; indent=2')[0],
+        ]
+        for username in ('first', 'second'):
+            self.client.force_login(get_user_model().objects.create_user(username))
+            etags.append(self.validators()[0])
+        self.assertEqual(len(set(etags)), 4)
+        # Another user's copy is not current for this one
+        self.assertEqual(self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etags[2]).status_code, 200)
+
+@unbuffered_best_sellers
+class DashboardCacheTests(TestCase):
+    client_class = PrimaryClient
+
+    def setUp(self):
+        cache.clear()
+        self.category, self.products = create_catalog()
+        self.customer = create_customer()
+        self.client.force_login(get_user_model().objects.create_user('dashboard-user'))
+
+    def stats(self):
+        response = self.client.get('/api/sales/dashboard_stats/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def sell(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return create_sale(self.customer, [(self.products[0], 2)])
+
+    @override_settings(DASHBOARD_CACHE=True)
+    def test_write_invalidates_cached_dashboard(self):
+        with mock.patch.object(SaleViewSet, 'build_dashboard_stats',
+                               wraps=SaleViewSet.build_dashboard_stats) as build_stats, \
+                mock.patch.object(DashboardView, 'build_dashboard_data',
+                                  wraps=DashboardView.build_dashboard_data) as build_data:
+            self.assertEqual(self.stats()['recent_sales'], [])
+            self.assertEqual(self.client.get('/').context['total_products'], 3)
+            self.stats()
+            self.client.get('/')
+            self.assertEqual((build_stats.call_count, build_data.call_count), (1, 1))
+
+            versions = caching.get_versions([Sale])
+            sale = self.sell()
+            self.assertNotEqual(caching.get_versions([Sale]), versions)
+            self.assertEqual([row['id'] for row in self.stats()['recent_sales']], [sale.pk])
+            self.assertEqual(build_stats.call_count, 2)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                create_catalog(products=1)
+            self.assertEqual(self.client.get('/').context['total_products'], 4)
+            self.assertEqual(build_data.call_count, 2)
+
+    def test_off_with_a_per_process_cache(self):
+        self.assertEqual(settings.CACHES['default']['BACKEND'], 'django.core.cache.backends.locmem.LocMemCache')
+        self.assertFalse(settings.DASHBOARD_CACHE)
+        with mock.patch.object(SaleViewSet, 'build_dashboard_stats',
+                               wraps=SaleViewSet.build_dashboard_stats) as build_stats:
+            self.stats()
+            self.stats()
+            self.assertEqual(build_stats.call_count, 2)
+        # Nothing was cached that another process's writes could leave stale
+        self.assertFalse([key for key in cache._cache if 'dashboard' in key])
+
+class RendererTests(TestCase):
+    """FastJSONRenderer and the parsers against DRF's JSON renderer and parser."""
+    client_class = PrimaryClient
+    jst = datetime.timezone(datetime.timedelta(hours=9))
+    edge_cases = {
+        'decimal': Decimal('1234.50'), 'utc': datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+        'aware': datetime.datetime(2024, 1, 2, 3, 4, 5, 678901, tzinfo=jst),
+        'naive': datetime.datetime(2024, 1, 2, 3, 4, 5), 'date': datetime.date(2024, 1, 2),
+        'time': datetime.time(3, 4, 5, 600), 'timedelta': datetime.timedelta(hours=1, microseconds=5),
+        'uuid': uuid.UUID(int=1), 'lazy': gettext_lazy('Sales'), 'separators': 'a\u2028b\u2029c',
+        'text': '日本語 "quoted" \\ \n', 'tuple': (1, 2.5, None, True), 'set': {3},
+        'nested': [{'price': Decimal('0.10'), 'at': datetime.datetime(2024, 1, 2, tzinfo=jst)}], 'float': 0.1,
+    }
+
+    def setUp(self):
+        self.category, self.products = create_catalog()
+        self.customer = create_customer()
+        create_sale(self.customer, [(self.products[0], 2), (self.products[1], 1)])
+        create_sale(self.customer, [(self.products[2], 1)], status='pending')
+        context = {'request': Request(APIRequestFactory().get('/api/'))}
+        self.payloads = {
+            'edge cases': self.edge_cases,
+            'integer beyond 64 bits': {'big': 2 ** 70},
+            'exponent floats': {'a': 1e16, 'b': [1.5e-7, -2.5e-05], 'c': (1e300,)},
+            'products': fastread.serialize(ProductSerializer, ProductSerializer.read_queryset(), context),
+            'sales': fastread.serialize(SaleSerializer, Sale.objects.all(), context),
+        }
+
+    def test_fast_json_is_byte_identical(self):
+        for label, data in self.payloads.items():
+            expected = JSONRenderer().render(data)
+            with self.subTest(label):
+                self.assertEqual(FastJSONRenderer().render(data), expected)
+                self.assertEqual(FastJSONParser().parse(io.BytesIO(expected)), JSONParser().parse(io.BytesIO(expected)))
+            with self.subTest(f'{label} without orjson'), mock.patch.object(renderers, 'orjson', None):
+                self.assertEqual(FastJSONRenderer().render(data), expected)
+
+    @skipIf(renderers.orjson is None, 'orjson is not installed')
+    def test_fast_json_keeps_plain_floats_on_orjson(self):
+        data = {'uuid': '3e4f0000-0000-0000-0000-000000000000', 'text': 'rate 0.00001', 'floats': [0.5, 1e-4, 1e15]}
+        with mock.patch.object(JSONRenderer, 'render', side_effect=AssertionError('fell back')):
+            self.assertEqual(FastJSONRenderer().render(data), json.dumps(
+                data, ensure_ascii=False, separators=(',', ':')).encode())
+
+    @skipIf(renderers.msgpack is None, 'msgpack is not installed')
+    def test_message_pack_round_trips(self):
+        # MessagePack has no integers beyond 64 bits
+        del self.payloads['integer beyond 64 bits']
+        for label, data in self.payloads.items():
+            with self.subTest(label):
+                self.assertEqual(MessagePackParser().parse(io.BytesIO(MessagePackRenderer().render(data))),
+                                 json.loads(JSONRenderer().render(data)))
+
+    @skipIf(renderers.msgpack is None, 'msgpack is not installed')
+    def test_message_pack_endpoints(self):
+        response = self.client.get('/api/sales/', HTTP_ACCEPT='application/json')
+        packed = self.client.get('/api/sales/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(packed['Content-Type'], 'application/msgpack')
+        self.assertEqual(MessagePackParser().parse(io.BytesIO(packed.content)), json.loads(response.content))
+
+        payload = {'customer': self.customer.pk, 'total_amount': '0', 'status': 'completed',
+                   'items': [{'product': self.products[0].pk, 'quantity': 1}]}
+        created = self.client.post('/api/sales/', MessagePackRenderer().render(payload),
+                                   content_type='application/msgpack')
+        self.assertEqual(created.status_code, 200, created.content)
+        self.assertEqual(Sale.objects.count(), 3)
+
+class AutocompleteTests(SimpleTestCase):
+    def setUp(self):
+        self.index = autocomplete.TypeaheadIndex(Product)
+        self.index._load([(1, 'Stainless Bottle'), (2, 'Bottle Opener'), (3, 'ワイヤレス イヤホン')])
+        self.index.built = True
+        patcher = mock.patch.object(self.index, 'refresh')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup('bot'), [{'id': 2, 'name': 'Bottle Opener'},
+                                                    {'id': 1, 'name': 'Stainless Bottle'}])
+        self.assertEqual(self.index.lookup('bottle stain'), [{'id': 1, 'name': 'Stainless Bottle'}])
+        self.assertEqual(self.index.lookup('いやほん'), [{'id': 3, 'name': 'ワイヤレス イヤホン'}])
+        self.assertEqual(self.index.lookup('ttle'), [{'id': 2, 'name': 'Bottle Opener'},
+                                                     {'id': 1, 'name': 'Stainless Bottle'}])
+
+    def test_lookup_during_rebuild(self):
+        results = []
+        with self.index.lock:
+            lookup = threading.Thread(target=lambda: results.append(self.index.lookup('bottle')))
+            lookup.start()
+            lookup.join(timeout=0.1)
+            # A rebuild that replaces the lists while the lookup waits for them
+            self.index._load([(pk, f'Bottle {pk}') for pk in range(10, 20)])
+        lookup.join()
+        self.assertEqual([row['id'] for row in results[0]], list(range(10, 20)))
+
+class SearchTests(TestCase):
+    client_class = PrimaryClient
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Tools', description='Hand tools')
+        self.products = {
+            name: Product.objects.create(name=name, description=description, category=self.category,
+                                         price=Decimal('10.00'), stock=1)
+            for name, description in [
+                ('Claw hammer', 'Steel head, wooden handle'),
+                ('Sledge hammer', 'Heavy steel head'),
+                ('Screwdriver', 'Flat head, for a hammer-free job'),
+                ('Tape measure', 'Five metres'),
+                ('ハンマー', '日本製の金づち'),
+                ('AB bracket', 'Steel angle bracket'),
+            ]
+        }
+
+    def found(self, text):
+        return [product.name for product in search.search(Product.objects.all(), text)]
+
+    def fts_rowids(self, text):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT rowid FROM products_product_fts WHERE products_product_fts MATCH %s',
+                           ['"%s"' % text])
+            return sorted(row[0] for row in cursor.fetchall())
+
+    def test_search(self):
+        self.assertCountEqual(self.found('hammer'), ['Claw hammer', 'Sledge hammer', 'Screwdriver'])
+        # Every term must match, in any field, ignoring case
+        self.assertCountEqual(self.found('STEEL hammer'), ['Claw hammer', 'Sledge hammer'])
+        self.assertEqual(self.found('heavy, HAMMER'), ['Sledge hammer'])
+        self.assertEqual(self.found('ンマー'), ['ハンマー'])
+        self.assertEqual(self.found('金づち'), ['ハンマー'])
+        self.assertEqual(self.found('chisel'), [])
+        self.assertEqual(len(self.found('  ')), len(self.products))
+        # Ordered by relevance, then primary key
+        results = search.search(Product.objects.all(), 'head')
+        ranks = [(-product.search_rank, product.pk) for product in results]
+        self.assertEqual(len(ranks), 3)
+        self.assertEqual(ranks, sorted(ranks))
+
+        response = self.client.get('/api/products/?search=steel+hammer')
+        self.assertEqual([row['name'] for row in response.json()['results']], self.found('steel hammer'))
+        customer = create_customer('ada@example.com')
+        create_customer('grace@example.com')
+        response = self.client.get('/api/customers/?search=ada@')
+        self.assertEqual([row['id'] for row in response.json()['results']], [customer.pk])
+
+    def test_short_terms(self):
+        self.assertEqual(self.found('ab'), ['AB bracket'])
+        self.assertEqual(self.found('ab steel'), ['AB bracket'])
+        self.assertEqual(self.found('he'), ['Claw hammer', 'Sledge hammer', 'Screwdriver'])
+        queryset = search.search(Product.objects.all(), 'ab')
+        self.assertTrue(all(product.search_rank == 0 for product in queryset))
+        if connection.vendor == 'sqlite':
+            # Not through the trigram index, which cannot match fewer than three characters
+            self.assertNotIn('MATCH', str(queryset.query))
+            self.assertIn('MATCH', str(search.search(Product.objects.all(), 'ab steel').query))
+
+    @skipUnless(connection.vendor == 'sqlite', 'FTS5 tables are SQLite only')
+    def test_fts_follows_writes(self):
+        product = Product.objects.create(name='Mallet', description='Rubber head', category=self.category,
+                                         price=Decimal('5.00'), stock=1)
+        self.assertEqual(self.fts_rowids('allet'), [product.pk])
+        self.assertEqual(self.fts_rowids('ubber'), [product.pk])
+
+        product.name = 'Soft mallet'
+        product.save()
+        self.assertEqual(self.fts_rowids('soft mal'), [product.pk])
+        Product.objects.filter(pk=product.pk).update(description='Wooden head')
+        self.assertEqual(self.fts_rowids('ubber'), [])
+        self.assertEqual(self.fts_rowids('wooden'), sorted([product.pk, self.products['Claw hammer'].pk]))
+        # Writes to other columns leave the index alone
+        Product.objects.filter(pk=product.pk).update(stock=F('stock') + 1)
+        self.assertEqual(self.fts_rowids('soft mal'), [product.pk])
+
+        product.delete()
+        self.assertEqual(self.fts_rowids('allet'), [])
+        self.assertEqual(self.found('mallet'), [])
+
+    @skipUnless(connection.vendor == 'postgresql', 'pg_trgm indexes are PostgreSQL only')
+    def test_trigram_index_used(self):
+        queryset = search.search(Product.objects.all(), 'hammer')
+        with transaction.atomic(), connection.cursor() as cursor:
+            # The table is too small for the planner to prefer an index unless made to
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+        self.assertIn('product_name_trgm_idx', plan)
+        self.assertIn('product_description_trgm_idx', plan)
+
+@skipUnless(connection.vendor == 'sqlite', 'FTS5 tables are SQLite only')
+class SearchInstallTests(TransactionTestCase):
+    def triggers(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE %s",
+                           ['products_product_fts_%'])
+            return sorted(row[0] for row in cursor.fetchall())
+
+    def test_install_restores_triggers_after_table_rebuild(self):
+        category = Category.objects.create(name='Tools', description='Hand tools')
+        self.assertEqual(self.triggers(), [f'products_product_fts_{suffix}' for suffix in sorted(search.TRIGGERS)])
+        # As Django does for some ALTER TABLEs on SQLite
+        with connection.schema_editor() as editor:
+            editor._remake_table(Product)
+        self.assertEqual(self.triggers(), [])
+        product = Product.objects.create(name='Mallet', description='Rubber head', category=category,
+                                         price=Decimal('5.00'), stock=1)
+        self.assertEqual(list(search.search(Product.objects.all(), 'mallet')), [])
+
+        # Run after every migrate
+        install_search_indexes(using=connection.alias)
+        self.assertEqual(len(self.triggers()), len(search.TRIGGERS))
+        self.assertEqual(list(search.search(Product.objects.all(), 'mallet')), [product])
+        product.name = 'Soft mallet'
+        product.save()
+        self.assertEqual(list(search.search(Product.objects.all(), 'soft mal')), [product])
+
+@skipUnless(connection.vendor == 'sqlite', 'A small dataset is planned differently on PostgreSQL')
+class AuditQueryPlansTests(TestCase):
+    def test_no_view_scans_a_large_table(self):
+        out = io.StringIO()
+        call_command('audit_query_plans', rows=2000, threshold=500, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Seeded 2000 products, 2000 customers and 4000 sales')
+        self.assertEqual(lines[-1], 'No query scans a large table')
+        # GET <path>  <n> queries, <n> scans
+        audited = {line.split()[1]: line for line in lines if line.startswith('GET ')}
+        for path in ['/api/products/?search=', '/api/products/low_stock/?threshold=', '/api/sales/?status=',
+                     '/api/sales/export/?from=', '/api/sales/timeseries/?granularity=', '/api/sale-items/?product=',
+                     '/api/customers/?search=', '/api/autocomplete/?q=']:
+            with self.subTest(path):
+                line = next(line for request, line in audited.items() if request.startswith(path))
+                self.assertTrue(line.endswith(' 0 scans'), line)
+        self.assertFalse([line for line in lines if line.startswith('    scans ')])
+
+class RollupTests(TestCase):
+    client_class = PrimaryClient
+
+    def setUp(self):
+        self.customer = create_customer()
+
+    def rollup_rows(self):
+        """``{model: {row, ...}}`` of every rollup row with anything in it."""
+        rows = {}
+        for model, counts in ((DailySales, 'sales_count'), (DailyProductSales, 'items_count'),
+                              (DailyCategorySales, 'items_count')):
+            fields = [field.attname for field in model._meta.concrete_fields if not field.primary_key]
+            rows[model] = set(model.objects.exclude(**{counts: 0}).values_list(*fields))
+        return rows
+
+    def assertRollupsRebuilt(self):
+        """The incrementally maintained rollups are what rebuild_rollups() computes from the sales."""
+        maintained = self.rollup_rows()
+        rollups.rebuild_rollups()
+        self.assertEqual(maintained, self.rollup_rows())
+
+    def test_rollups_follow_sale_writes(self):
+        category, products = create_catalog()
+        other_category = Category.objects.create(name='Garden', description='Garden tools')
+        products[2].category = other_category
+        products[2].save()
+
+        def set_status(sale, status):
+            sale.status = status
+            sale.save()
+
+        def move(sale, days):
+            sale.sale_date += timedelta(days=days)
+            sale.save()
+
+        def change_line(sale, quantity):
+            item = sale.items.first()
+            item.quantity = quantity
+            item.save()
+
+        sales = [create_sale(self.customer, [(products[index % 3], index + 1), (products[(index + 1) % 3], 1)],
+                             status=STATUSES[index % 3])
+                 for index in range(rollups.SHARDS + 2)]
+        move(sales[0], -3)
+        self.assertRollupsRebuilt()
+
+        for label, write in [
+            ('status changed', lambda: set_status(sales[1], 'cancelled')),
+            ('reinstated', lambda: set_status(sales[1], 'completed')),
+            ('moved a day', lambda: move(sales[2], -1)),
+            ('line added', lambda: SaleItem.objects.create(sale=sales[3], product=products[2], quantity=4,
+                                                           unit_price=products[2].price)),
+            ('line changed', lambda: change_line(sales[4], 7)),
+            ('line deleted', lambda: sales[5].items.first().delete()),
+            ('sale deleted', lambda: sales[6].delete()),
+            ('every sale deleted', lambda: Sale.objects.all().delete()),
+        ]:
+            with self.subTest(label):
+                write()
+                self.assertRollupsRebuilt()
+        self.assertEqual(self.rollup_rows(), {DailySales: set(), DailyProductSales: set(),
+                                              DailyCategorySales: set()})
+
+    def test_timeseries_reads_rollups(self):
+        category, products = create_catalog(products=2)
+        sales = [create_sale(self.customer, [(products[0], 1), (products[1], index + 1)], status=status)
+                 for index, status in enumerate(['completed', 'completed', 'completed', 'cancelled'])]
+        day = sales[0].sale_date
+        sales[0].sale_date = day - timedelta(days=1)
+        sales[0].save()
+
+        def series(query):
+            response = self.client.get(f'/api/sales/timeseries/?{query}')
+            self.assertEqual(response.status_code, 200)
+            return [(row['period'], row.get('sales_count', row.get('quantity')), Decimal(row['total_amount']))
+                    for row in response.json()]
+
+        def expected(sales, value):
+            totals = {}
+            for sale in sales:
+                period = rollups.sale_day(sale.sale_date).isoformat()
+                count, amount = totals.get(period, (0, Decimal('0')))
+                count_delta, amount_delta = value(sale)
+                totals[period] = (count + count_delta, amount + amount_delta)
+            return [(period, *totals[period]) for period in sorted(totals)]
+
+        def product_line(sale):
+            item = sale.items.get(product=products[1])
+            return item.quantity, item.total_price
+
+        def all_lines(sale):
+            items = sale.items.all()
+            return sum(item.quantity for item in items), sum(item.total_price for item in items)
+
+        completed = list(Sale.objects.filter(status='completed').order_by('pk'))
+        self.assertEqual(series('granularity=day'), expected(completed, lambda sale: (1, sale.total_amount)))
+        self.assertEqual(series('status=cancelled'), expected(sales[3:], lambda sale: (1, sale.total_amount)))
+        self.assertEqual(series(f'product={products[1].pk}'), expected(completed, product_line))
+        self.assertEqual(series(f'category={category.pk}&from={rollups.sale_day(day).isoformat()}'),
+                         expected(completed[1:], all_lines))
+
+        # Read from the rollup rows, not the sales
+        DailySales.objects.filter(pk=DailySales.objects.filter(status='completed').first().pk).update(
+            sales_count=F('sales_count') + 5)
+        self.assertEqual(sum(count for period, count, amount in series('granularity=month')), len(completed) + 5)
+
+    def upserted_keys(self, write):
+        """``{table: [key, ...]}`` of the rollup rows ``write()`` upserted, in statement order."""
+        keys = {}
+
+        def record(execute, sql, params, many, context):
+            if 'ON CONFLICT' in sql:
+                table = sql.split()[2].strip('"`')
+                width = sql.split('VALUES (', 1)[1].split(')', 1)[0].count('%s')
+                key_width = sql.split('ON CONFLICT (', 1)[1].split(')', 1)[0].count(',') + 1
+                keys.setdefault(table, []).extend(
+                    tuple(params[start:start + key_width]) for start in range(0, len(params), width))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            write()
+        return keys
+
+    def test_upserts_in_key_order(self):
+        products = [create_catalog(products=1)[1][0] for _ in range(2)]
+        # Lines in the reverse of the category and product order
+        lines = [(product, 1) for product in sorted(products, key=lambda product: product.pk, reverse=True)]
+        keys = self.upserted_keys(lambda: create_sale(self.customer, lines))
+        for table in ('products_dailyproductsales', 'products_dailycategorysales'):
+            with self.subTest(table):
+                self.assertEqual(len(keys[table]), 2)
+                self.assertEqual(keys[table], sorted(keys[table]))
+
+        sales = [Sale(pk=1, customer=self.customer, status=status, total_amount=Decimal('1.00'))
+                 for status in ('pending', 'completed', 'cancelled')]
+        keys = self.upserted_keys(lambda: rollups.record_sales_created(sales))
+        self.assertEqual([status for date, status, shard in keys['products_dailysales']],
+                         ['cancelled', 'completed', 'pending'])
+
+    def test_sale_rows_share_a_shard(self):
+        category, products = create_catalog(products=2)
+        stock.shard(products[0].pk, 4)
+        for _ in range(rollups.SHARDS):
+            before = dict(StockShard.objects.values_list('index', 'quantity'))
+            sale = create_sale(self.customer, [(product, 1) for product in products])
+            after = dict(StockShard.objects.values_list('index', 'quantity'))
+            self.assertEqual([index for index in before if before[index] != after[index]], [sale.pk % 4])
+            shard = rollups.shard_of(sale.pk)
+            self.assertEqual(DailySales.objects.get(shard=shard).sales_count, 1)
+            self.assertEqual(DailyProductSales.objects.filter(shard=shard).count(), 2)
+            self.assertEqual(DailyCategorySales.objects.get(shard=shard).items_count, 2)
+
+class CounterTests(TestCase):
+    def setUp(self):
+        self.category, self.products = create_catalog(products=2)
+        self.customer = create_customer()
+
+    def assertCounters(self, units, purchases, spent):
+        """``units`` is the units sold of each product."""
+        totals = Product.objects.with_stock().order_by('pk')
+        self.assertEqual([product.total_units_sold for product in totals], units)
+        self.assertEqual([product.total_revenue for product in totals],
+                         [Decimal('10.00') * count for count in units])
+        self.customer.refresh_from_db()
+        self.assertEqual((self.customer.total_purchases, self.customer.total_spent), (purchases, spent))
+
+    def test_counters_follow_sales(self):
+        self.category.refresh_from_db()
+        self.assertEqual(self.category.products_count, 2)
+        sale = create_sale(self.customer, [(self.products[0], 3), (self.products[1], 1)])
+        self.assertCounters([3, 1], 1, Decimal('40.00'))
+
+        sale.status = 'cancelled'
+        sale.save()
+        self.assertCounters([0, 0], 0, Decimal('0'))
+        sale.status = 'completed'
+        sale.save()
+        self.assertCounters([3, 1], 1, Decimal('40.00'))
+
+        sale.items.get(product=self.products[1]).delete()
+        self.assertEqual(Product.objects.with_stock().get(pk=self.products[1].pk).total_units_sold, 0)
+        self.products[1].delete()
+        self.category.refresh_from_db()
+        self.assertEqual(self.category.products_count, 1)
+
+    def test_sales_credit_the_shard_they_took_stock_from(self):
+        stock.shard(self.products[0].pk, 4)
+        quantities = dict(StockShard.objects.values_list('index', 'quantity'))
+        for quantity in range(1, 11):
+            create_sale(self.customer, [(self.products[0], quantity)])
+        self.assertEqual(Product.objects.with_stock().get(pk=self.products[0].pk).total_units_sold, 55)
+        for row in StockShard.objects.all():
+            self.assertEqual(row.units_sold, quantities[row.index] - row.quantity, row.index)
+            self.assertEqual(row.revenue, Decimal('10.00') * row.units_sold, row.index)
+
+    def test_recount_command(self):
+        stock.shard(self.products[0].pk, 2)
+        create_sale(self.customer, [(self.products[0], 3), (self.products[1], 1)])
+        Product.objects.filter(pk=self.products[1].pk).update(units_sold=99)
+        Customer.objects.update(total_purchases=0, total_spent=0)
+        Category.objects.update(products_count=7)
+
+        out = io.StringIO()
+        call_command('recount', stdout=out)
+        self.assertIn('corrected 1 categories, 1 customers, 1 products', out.getvalue())
+        self.assertCounters([3, 1], 1, Decimal('40.00'))
+        self.category.refresh_from_db()
+        self.assertEqual(self.category.products_count, 2)
+        # The shards' part of the counters was folded into the product row
+        self.assertEqual(StockShard.objects.filter(units_sold=0).count(), 2)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).units_sold, 3)
+
+        out = io.StringIO()
+        call_command('recount', stdout=out)
+        self.assertIn('corrected 0 categories, 0 customers, 0 products', out.getvalue())
+
+class SaleDateTests(TestCase):
+    """SaleItem.sale_date, the partition key of sale items, follows its sale's date."""
+
+    def setUp(self):
+        self.category, self.products = create_catalog()
+        self.customer = create_customer()
+
+    def assertItemDates(self, sale):
+        sale.refresh_from_db()
+        self.assertEqual(set(sale.items.values_list('sale_date', flat=True)), {sale.sale_date})
+
+    def test_save(self):
+        sale = Sale.objects.create(customer=self.customer, total_amount=Decimal('10.00'))
+        SaleItem.objects.create(sale=sale, product=self.products[0], quantity=1, unit_price=Decimal('10.00'))
+        self.assertItemDates(sale)
+
+    def test_bulk_create(self):
+        sale = create_sale(self.customer, [(self.products[0], 1), (self.products[1], 2)])
+        self.assertEqual(sale.items.count(), 2)
+        self.assertItemDates(sale)
+
+    def test_date_change(self):
+        sale = create_sale(self.customer, [(self.products[0], 1), (self.products[1], 2)])
+        sale.sale_date -= timedelta(days=45)
+        sale.save()
+        self.assertItemDates(sale)
+
+@skipUnless(connection.vendor == 'postgresql', 'Sales are only partitioned on PostgreSQL')
+class PartitioningTests(TestCase):
+    def setUp(self):
+        with connection.schema_editor() as editor:
+            partitioning.partition(editor)
+        self.month = partitioning.month_start(timezone.now())
+        self.last_month = partitioning.month_start(self.month - timedelta(days=1))
+        partitioning.create_partitions(connection, since=self.last_month)
+        category, products = create_catalog()
+        customer = create_customer()
+        for sale_date in [self.month, self.last_month + timedelta(days=3), self.month - timedelta(days=800)]:
+            sale = create_sale(customer, [(products[0], 1)])
+            sale.sale_date = sale_date
+            sale.save()
+
+    def partitions(self, table, *months):
+        return {partitioning.partition_name(table, month) for month in months}
+
+    def test_date_ranges_read_their_partitions(self):
+        end = partitioning.next_month(self.month)
+        for model in (Sale, SaleItem):
+            table = model._meta.db_table
+            with self.subTest(table):
+                self.assertTrue(partitioning.is_partitioned(connection, model))
+                this_month = model.objects.filter(sale_date__gte=self.month, sale_date__lt=end)
+                self.assertEqual(partitioning.scanned_partitions(this_month), self.partitions(table, self.month))
+                self.assertEqual(this_month.count(), 1)
+                two_months = model.objects.filter(sale_date__gte=self.last_month, sale_date__lt=end)
+                self.assertEqual(partitioning.scanned_partitions(two_months),
+                                 self.partitions(table, self.last_month, self.month))
+                self.assertEqual(two_months.count(), 2)
+                self.assertIn(f'{table}_default', partitioning.scanned_partitions(model.objects.all()))
+                self.assertEqual(model.objects.count(), 3)
+
+    def test_date_change_moves_items(self):
+        sale = Sale.objects.get(sale_date=self.month)
+        sale.sale_date = self.last_month
+        sale.save()
+        self.assertEqual(list(SaleItem.objects.filter(sale=sale).values_list('sale_date', flat=True)),
+                         [self.last_month])
+        last_month = SaleItem.objects.filter(sale_date__gte=self.last_month, sale_date__lt=self.month)
+        self.assertEqual(last_month.count(), 2)
+
+@skipUnless(connection.vendor == 'postgresql', 'Sales are only partitioned on PostgreSQL')
+@unbuffered_best_sellers
+class PartitionCommandTests(TransactionTestCase):
+    def setUp(self):
+        category, products = create_catalog(products=1)
+        create_sale(create_customer(), [(products[0], 1)])
+        self.addCleanup(self.unpartition)
+
+    def unpartition(self):
+        if partitioning.is_partitioned(connection, Sale):
+            with connection.schema_editor() as editor:
+                partitioning.unpartition(editor)
+
+    def test_plain_tables_are_not_converted(self):
+        out = io.StringIO()
+        call_command('partition_sales', stdout=out)
+        self.assertIn('not partitioned', out.getvalue())
+        self.assertFalse(partitioning.is_partitioned(connection, Sale))
+
+    def test_concurrent_conversions(self):
+        is_partitioned = partitioning.is_partitioned
+        checked, local = threading.Barrier(2, timeout=10), threading.local()
+        outputs, failures = [], []
+
+        def check_together(connection, model):
+            partitioned = is_partitioned(connection, model)
+            if not hasattr(local, 'checked'):
+                # Both commands find plain tables before either locks them
+                local.checked = True
+                checked.wait()
+            return partitioned
+
+        def convert():
+            out = io.StringIO()
+            try:
+                call_command('partition_sales', '--convert', '--ahead', '0', stdout=out)
+            except Exception as exc:
+                failures.append(exc)
+            finally:
+                outputs.append(out.getvalue())
+                connection.close()
+
+        with mock.patch.object(partitioning, 'is_partitioned', check_together):
+            pool = [threading.Thread(target=convert) for _ in range(2)]
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(sorted('meanwhile' in output for output in outputs), [False, True])
+        self.assertTrue(partitioning.is_partitioned(connection, Sale))
+        self.assertEqual((Sale.objects.count(), SaleItem.objects.count()), (1, 1))
+
+def as_row(row):
+    if isinstance(row, Product):
+        return row.pk, row.name, row.price, row.category.name
+    return row
+
+class GenerateDatasetTests(TestCase):
+    options = {'categories': 3, 'products': 6, 'customers': 5, 'days': 10, 'end': datetime.date(2024, 3, 31),
+               'seed': 1}
+
+    def generate(self, **options):
+        out = io.StringIO()
+        call_command('generate_dataset', **{**self.options, **options}, stdout=out)
+        return out.getvalue()
+
+    def dataset(self):
+        """The generated rows, by their values rather than their primary keys."""
+        return {
+            'categories': list(Category.objects.order_by('pk').values_list('name', 'description')),
+            'products': list(Product.objects.order_by('pk').values_list(
+                'name', 'description', 'category__name', 'price', 'stock')),
+            'customers': list(Customer.objects.order_by('pk').values_list('name', 'email', 'phone', 'address')),
+            'sales': list(Sale.objects.order_by('pk').values_list(
+                'customer__email', 'sale_date', 'total_amount', 'status')),
+            'items': list(SaleItem.objects.order_by('pk').values_list(
+                'sale__customer__email', 'sale__sale_date', 'product__name', 'quantity', 'unit_price',
+                'total_price', 'sale_date')),
+        }
+
+    def clear(self):
+        for model in (Category, Customer, BestSellerSummary, DailySales, DailyProductSales, DailyCategorySales):
+            model.objects.all().delete()
+
+    def assertDerivedMatchSales(self):
+        counted_items = SaleItem.objects.exclude(sale__status='cancelled')
+        for product in Product.objects.with_stock():
+            with self.subTest(product=product.name):
+                items = counted_items.filter(product=product).aggregate(units=Sum('quantity'),
+                                                                        revenue=Sum('total_price'))
+                self.assertEqual((product.total_units_sold, product.total_revenue),
+                                 (items['units'] or 0, items['revenue'] or 0))
+                self.assertEqual(
+                    BestSellerSummary.objects.get(metric='quantity', period=topk.ALL_TIME).counters.get(
+                        str(product.pk), ['0'])[0],
+                    str(SaleItem.objects.filter(product=product).aggregate(total=Sum('quantity'))['total'] or 0))
+        for customer in Customer.objects.all():
+            sales = Sale.objects.filter(customer=customer).exclude(status='cancelled')
+            self.assertEqual((customer.total_purchases, customer.total_spent),
+                             (sales.count(), sales.aggregate(total=Sum('total_amount'))['total'] or 0))
+        for category in Category.objects.all():
+            self.assertEqual(category.products_count, category.products.count())
+        def totals(queryset, *aggregates):
+            return tuple(value or 0 for value in queryset.aggregate(*aggregates).values())
+
+        for status in STATUSES:
+            with self.subTest(status=status):
+                self.assertEqual(
+                    totals(DailySales.objects.filter(status=status), Sum('sales_count'), Sum('total_amount')),
+                    totals(Sale.objects.filter(status=status), Count('id'), Sum('total_amount')))
+                items = totals(SaleItem.objects.filter(sale__status=status), Sum('quantity'), Sum('total_price'))
+                for model in (DailyProductSales, DailyCategorySales):
+                    self.assertEqual(
+                        totals(model.objects.filter(status=status), Sum('quantity'), Sum('total_amount')), items)
+
+    def test_seed_decides_the_data(self):
+        self.generate(sales=30)
+        first = self.dataset()
+        self.clear()
+        self.generate(sales=30)
+        self.assertEqual(self.dataset(), first)
+
+        self.clear()
+        self.generate(sales=30, seed=2)
+        other = self.dataset()
+        self.assertEqual(len(other['sales']), 30)
+        self.assertNotEqual(other['products'], first['products'])
+        self.assertNotEqual(other['sales'], first['sales'])
+
+    @mock.patch('products.management.commands.generate_dataset.CHUNK', 8)
+    def test_resume_after_partial_run(self):
+        self.generate(sales=30)
+        complete = self.dataset()
+        self.assertEqual(len(complete['sales']), 30)
+        # Nothing is missing, so a rerun adds nothing
+        self.assertNotIn('Created', self.generate(sales=30))
+        self.assertEqual(self.dataset(), complete)
+
+        # A run of fewer sales, then one that stops in its third chunk
+        self.clear()
+        self.generate(sales=12)
+        sales_chunk = generate_dataset.Command.sales_chunk
+
+        def stop_at_third_chunk(command, index, *args):
+            if index == 2:
+                raise KeyboardInterrupt
+            return sales_chunk(command, index, *args)
+
+        with mock.patch.object(generate_dataset.Command, 'sales_chunk', stop_at_third_chunk), \
+                self.assertRaises(KeyboardInterrupt):
+            self.generate(sales=30)
+        self.assertEqual(Sale.objects.count(), 16)
+        self.assertIn('Resuming after 16 sales', self.generate(sales=30))
+        self.assertEqual(self.dataset(), complete)
+        self.assertDerivedMatchSales()
+
+    def test_refresh_derived(self):
+        self.generate(sales=30)
+        self.assertDerivedMatchSales()
+        # Generated sales are written without signals: only the refresh counts them
+        for model in (DailySales, DailyProductSales, DailyCategorySales, BestSellerSummary):
+            model.objects.all().delete()
+        Product.objects.update(units_sold=0, revenue=0)
+        Customer.objects.update(total_purchases=0, total_spent=0)
+        self.assertIn('Recounted counters and rebuilt rollups', self.generate(sales=30))
+        self.assertDerivedMatchSales()
+
+@override_settings(QUERYSET_CACHE=True)
+@unbuffered_best_sellers
+class QuerysetCacheTests(TransactionTestCase):
+    """No cached queryset (products.querycache) is read stale once a write commits."""
+
+    def setUp(self):
+        querycache.LOCAL.clear()
+        cache.clear()
+        self.category, self.products = create_catalog()
+        self.customer = create_customer()
+
+    def reads(self):
+        """``{label: queryset}`` of the cached reads checked, uncached."""
+        products = Product.objects.filter(category=self.category)
+        return {
+            'categories': Category.objects.filter(pk=self.category.pk).values_list(
+                'pk', 'name', 'description', 'products_count'),
+            'products with stock': products.with_stock().order_by('pk').values_list(
+                'pk', 'name', 'price', 'available_stock', 'total_units_sold'),
+            'product instances': products.select_related('category').order_by('pk'),
+            'customer': Customer.objects.filter(pk=self.customer.pk).values_list(
+                'pk', 'name', 'total_purchases', 'total_spent'),
+        }
+
+    def assertFresh(self):
+        for label, queryset in self.reads().items():
+            with self.subTest(label):
+                self.assertEqual(list(map(as_row, queryset.cached())), list(map(as_row, queryset)))
+                self.assertEqual(queryset.cached().count(), queryset.count())
+        with self.subTest('category dropdown'):
+            self.assertEqual(
+                [str(label) for value, label in forms.ModelChoiceField(Category.objects.cached()).choices],
+                [str(label) for value, label in forms.ModelChoiceField(Category.objects.all()).choices])
+
+    def assertFreshAfter(self, write):
+        self.assertFresh()
+        # Now served from the cache, so a stale entry would be read
+        with self.assertNumQueries(0):
+            for queryset in self.reads().values():
+                list(queryset.cached())
+        with transaction.atomic():
+            write()
+            # Inside the transaction the cache is bypassed
+            self.assertFresh()
+        self.assertFresh()
+
+    def test_save(self):
+        product = self.products[0]
+        product.price += 1
+        self.assertFreshAfter(product.save)
+
+    def test_save_of_a_related_row(self):
+        self.category.name = 'Garden'
+        self.assertFreshAfter(self.category.save)
+
+    def test_create(self):
+        self.assertFreshAfter(lambda: Product.objects.create(
+            name='Hammer', description='Claw hammer', category=self.category, price=Decimal('12.00')))
+
+    def test_delete(self):
+        self.assertFreshAfter(self.products[0].delete)
+
+    def test_queryset_update(self):
+        self.assertFreshAfter(lambda: Product.objects.filter(category=self.category).update(price=F('price') + 1))
+
+    def test_bulk_create(self):
+        self.assertFreshAfter(lambda: Product.objects.bulk_create(
+            Product(name=f'Bulk {index}', description='Bulk', category=self.category, price=Decimal('1.00'))
+            for index in range(3)))
+
+    def test_bulk_update(self):
+        self.assertFreshAfter(lambda: Category.objects.bulk_update(
+            [Category(pk=self.category.pk, name='Renamed')], ['name']))
+
+    def test_queryset_delete(self):
+        self.assertFreshAfter(lambda: Product.objects.filter(pk=self.products[1].pk).delete())
+
+    def test_stock_shard(self):
+        self.assertFreshAfter(lambda: stock.shard(self.products[0].pk, 4))
+        self.assertFreshAfter(lambda: create_sale(self.customer, [(self.products[0], 3)]))
+        self.assertFreshAfter(lambda: stock.shard(self.products[0].pk, 0))
+
+    def test_sale(self):
+        self.assertFreshAfter(lambda: create_sale(self.customer, [(product, 2) for product in self.products]))
+
+class SessionTests(TestCase):
+    client_class = PrimaryClient
+
+    def setUp(self):
+        sessions.CACHE.clear()
+        self.addCleanup(sessions.flush_touches)
+        self.client.force_login(get_user_model().objects.create_user('session-user'))
+        self.session_key = self.client.session.session_key
+
+    def session_writes(self, request):
+        with CaptureQueriesContext(connection) as captured:
+            response = request()
+        return response, [query['sql'] for query in captured
+                          if 'django_session' in query['sql'] and not query['sql'].startswith('SELECT')]
+
+    def test_cached(self):
+        sessions.SessionStore(self.session_key).load()
+        with self.assertNumQueries(0):
+            self.assertIn(SESSION_KEY, sessions.SessionStore(self.session_key).load())
+
+    def test_touch_sends_the_cookie_again(self):
+        # Stores the CSRF token in the session
+        self.client.get('/products/')
+        stale = timezone.now() + timedelta(
+            seconds=settings.SESSION_COOKIE_AGE - settings.SESSION_TOUCH_INTERVAL - 60)
+        Session.objects.filter(session_key=self.session_key).update(expire_date=stale)
+        sessions.CACHE.clear()
+        response, writes = self.session_writes(lambda: self.client.get('/products/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(writes, [])
+        cookie = response.cookies[settings.SESSION_COOKIE_NAME]
+        self.assertEqual(cookie.value, self.session_key)
+        self.assertEqual(cookie['max-age'], settings.SESSION_COOKIE_AGE)
+
+        self.assertEqual(sessions.flush_touches(), 1)
+        expire_date = Session.objects.get(session_key=self.session_key).expire_date
+        self.assertGreater(expire_date, timezone.now() + timedelta(seconds=settings.SESSION_COOKIE_AGE - 60))
+        response = self.client.get('/products/')
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+    def test_logout_in_another_process(self):
+        store = sessions.SessionStore(self.session_key)
+        store.load()
+        cached = sessions.CACHE.get(self.session_key)
+        store.delete()
+        # The entry a process that did not serve the logout still holds
+        sessions.CACHE.set(self.session_key, *cached)
+        self.assertEqual(sessions.SessionStore(self.session_key).load(), {})
+        self.assertEqual(self.client.get('/products/').status_code, 302)
+
+    def test_anonymous_sessions_are_not_checked(self):
+        store = sessions.SessionStore()
+        store['cart'] = [1]
+        store.save()
+        cached = sessions.CACHE.get(store.session_key)
+        sessions.SessionStore(store.session_key).delete()
+        sessions.CACHE.set(store.session_key, *cached)
+        with self.assertNumQueries(0):
+            self.assertEqual(sessions.SessionStore(store.session_key).load(), {'cart': [1]})
+
+@skipUnless(connection.vendor == 'postgresql', 'Only PostgreSQL runs read_only request transactions')
+@unbuffered_best_sellers
+class RequestTransactionTests(TransactionTestCase):
+    client_class = PrimaryClient
+
+    def setUp(self):
+        create_catalog()
+
+    def session_setting(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SHOW {name}')
+            return cursor.fetchone()[0]
+
+    @override_settings(SAFE_REQUEST_TRANSACTION='read_only', SAFE_REQUEST_ISOLATION='serializable')
+    def test_read_only(self):
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.client.get('/api/products/').status_code, 200)
+        # Django logs BEGIN and COMMIT too
+        statements = [query['sql'] for query in captured if query['sql'] not in ('BEGIN', 'COMMIT')]
+        self.assertEqual(statements[0], 'SET TRANSACTION ISOLATION LEVEL SERIALIZABLE READ ONLY')
+        self.assertEqual(sum(sql.startswith('SET') for sql in statements), 1)
+        # Nothing is left on the session for the next transaction
+        self.assertEqual(self.session_setting('default_transaction_read_only'), 'off')
+        self.assertEqual(self.session_setting('transaction_read_only'), 'off')
+        self.assertEqual(self.session_setting('transaction_isolation'), 'read committed')
+
+    @override_settings(SAFE_REQUEST_TRANSACTION='read_only')
+    def test_nothing_set_without_queries(self):
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.client.options('/api/products/').status_code, 200)
+        self.assertEqual([query['sql'] for query in captured], ['BEGIN', 'COMMIT'])
+
+@skipUnless(routing.replicas(), 'Needs a replica: --settings=product_management.test_settings')
+@unbuffered_best_sellers
+class RoutingTests(TransactionTestCase):
+    """Which database each request reads from (see products.routing)."""
+    databases = {'default', *routing.replicas()}
+
+    def setUp(self):
+        self.category, self.products = create_catalog()
+
+    def reads(self, request):
+        """The aliases ``request()`` queried, and its response."""
+        with ExitStack() as stack:
+            captured = {alias: stack.enter_context(CaptureQueriesContext(connections[alias]))
+                        for alias in self.databases}
+            response = request()
+        return {alias for alias, queries in captured.items() if queries}, response
+
+    def assertReads(self, aliases, request, status_code=200):
+        used, response = self.reads(request)
+        self.assertEqual(response.status_code, status_code)
+        self.assertEqual(used, set(aliases))
+        return response
+
+    # A lag of 0 treats the rows written in setUp as replicated
+    @override_settings(DATABASE_REPLICA_LAG=0)
+    def test_safe_reads_go_to_a_replica(self):
+        for url in ['/api/categories/', f'/api/products/{self.products[0].pk}/']:
+            with self.subTest(url):
+                self.assertReads(routing.replicas(), lambda: self.client.get(url))
+
+    def test_writes_pin_the_client_to_the_primary(self):
+        response = self.assertReads(['default'], lambda: self.client.post(
+            '/api/categories/', {'name': 'Tools'}, content_type='application/json'), 201)
+        cookie = response.cookies[routing.PIN_COOKIE]
+        self.assertEqual(cookie['max-age'], settings.DATABASE_REPLICA_LAG)
+        self.assertEqual((cookie['secure'], cookie['httponly'], cookie['samesite']), (True, True, 'Lax'))
+        # Secure like the session cookie, so plain-HTTP development still pins
+        with override_settings(SESSION_COOKIE_SECURE=False):
+            response = self.client_class().post('/api/categories/', {'name': 'Garden'},
+                                                content_type='application/json')
+        self.assertEqual(response.cookies[routing.PIN_COOKIE]['secure'], '')
+        with override_settings(DATABASE_REPLICA_LAG=0):
+            self.assertReads(['default'], lambda: self.client.get('/api/categories/'))
+            self.assertReads(routing.replicas(), lambda: self.client_class().get('/api/categories/'))
+
+    @override_settings(DATABASE_REPLICA_LAG=0)
+    def test_primary_views(self):
+        # PendingSaleViewSet is a PrimaryDatabaseMixin
+        self.assertReads(['default'], lambda: self.client.get('/api/sale-queue/'))
+        with mock.patch.object(CategoryViewSet.list, 'use_primary_db', True, create=True):
+            self.assertReads(['default'], lambda: self.client.get('/api/categories/'))
+            self.assertReads(routing.replicas(),
+                             lambda: self.client.get(f'/api/categories/{self.category.pk}/'))
+
+    @skipUnless(connection.vendor == 'postgresql', 'Only PostgreSQL runs read_only request transactions')
+    @override_settings(DATABASE_REPLICA_LAG=0, SAFE_REQUEST_TRANSACTION='read_only')
+    def test_read_only_transaction_on_the_replica(self):
+        replica = routing.replicas()[0]
+        with CaptureQueriesContext(connections[replica]) as captured:
+            self.assertEqual(self.client.get('/api/products/').status_code, 200)
+        statements = [query['sql'] for query in captured]
+        self.assertEqual(statements[:2], ['BEGIN', 'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY'])
+        self.assertEqual(statements[-1], 'COMMIT')
+        self.assertFalse(connections[replica].in_atomic_block)
+
+    def test_primary_db_view(self):
+        middleware = routing.ReplicaMiddleware(lambda request: None)
+        request = APIRequestFactory().get('/')
+        for view, alias in [(routing.primary_db(lambda request: None), None),
+                            (lambda request: None, 'replica1')]:
+            with self.subTest(alias=alias):
+                routing._replica.set('replica1')
+                middleware.process_view(request, view, (), {})
+                self.assertEqual(routing._replica.get(), alias)
+        routing.use_primary()
+
+    def test_use_primary_if_written(self):
+        self.addCleanup(routing.use_primary)
+        caching.bump_version(Category)
+        lag = settings.DATABASE_REPLICA_LAG
+        for seconds, alias in [(0, None), (lag - 1, None), (lag + 1, 'replica1')]:
+            with self.subTest(seconds_since_write=seconds):
+                routing._replica.set('replica1')
+                modified = caching.get_modified([Category])
+                with mock.patch('products.routing.time.time', return_value=modified + seconds):
+                    routing.use_primary_if_written([Category])
+                self.assertEqual(routing._replica.get(), alias)
+        # When a model was last written is not known
+        routing._replica.set('replica1')
+        with mock.patch('products.routing.caching.get_modified', return_value=None):
+            routing.use_primary_if_written([Category])
+        self.assertIsNone(routing._replica.get())
+
+class FakeConnection:
+    """The parts of a psycopg2 connection that Pool uses."""
+
+    def __init__(self):
+        self.closed = 0
+        self.alive = True
+        self.autocommit = True
+        self.info = SimpleNamespace(transaction_status=extensions.TRANSACTION_STATUS_IDLE)
+
+    def cursor(self):
+        if not self.alive:
+            raise pooling.Database.OperationalError('server closed the connection unexpectedly')
+        return mock.MagicMock()
+
+    def rollback(self):
+        if not self.alive:
+            raise pooling.Database.OperationalError('server closed the connection unexpectedly')
+        self.info.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+class PoolTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 0.0
+        clock = mock.patch.object(pooling, 'time', SimpleNamespace(monotonic=lambda: self.now))
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.pool = pooling.Pool(max_size=2, timeout=0, max_lifetime=100, max_idle=10, check_after=1)
+        self.opened = []
+
+    def connect(self):
+        self.opened.append(FakeConnection())
+        return self.opened[-1]
+
+    def assertCounts(self, **counts):
+        stats = self.pool.stats()
+        self.assertEqual({name: stats[name] for name in counts}, counts)
+
+    def test_reuse(self):
+        connection = self.pool.borrow(self.connect)
+        self.pool.give_back(connection)
+        self.now += 5
+        self.assertIs(self.pool.borrow(self.connect), connection)
+        self.assertCounts(connects=1, borrows=2, in_use=1, idle=0)
+
+    def test_timeout(self):
+        borrowed = [self.pool.borrow(self.connect) for _ in range(2)]
+        with self.assertRaises(pooling.PoolTimeout):
+            self.pool.borrow(self.connect)
+        self.assertCounts(connects=2, waits=1, timeouts=1, in_use=2)
+        self.pool.give_back(borrowed[0])
+        self.assertIs(self.pool.borrow(self.connect), borrowed[0])
+
+    def test_wait_for_a_connection(self):
+        pool = pooling.Pool(max_size=1, timeout=5, max_lifetime=100, max_idle=10, check_after=1)
+        connection = pool.borrow(self.connect)
+        threading.Timer(0.05, pool.give_back, [connection]).start()
+        self.assertIs(pool.borrow(self.connect), connection)
+        self.assertEqual(pool.stats()['waits'], 1)
+
+    def test_failed_connect(self):
+        with self.assertRaises(pooling.Database.OperationalError):
+            self.pool.borrow(mock.Mock(side_effect=pooling.Database.OperationalError))
+        self.assertCounts(size=0, connects=0)
+        self.pool.borrow(self.connect)
+        self.pool.borrow(self.connect)
+        self.assertCounts(size=2)
+
+    def test_max_lifetime(self):
+        connection = self.pool.borrow(self.connect)
+        self.now += 100
+        self.pool.give_back(connection)
+        self.assertTrue(connection.closed)
+        self.assertIsNot(self.pool.borrow(self.connect), connection)
+        self.assertCounts(recycled=1, connects=2, size=1)
+
+    def test_max_lifetime_while_idle(self):
+        connection = self.pool.borrow(self.connect)
+        self.now += 95
+        self.pool.give_back(connection)
+        self.now += 5
+        self.assertIsNot(self.pool.borrow(self.connect), connection)
+        self.assertTrue(connection.closed)
+        self.assertCounts(recycled=1, size=1)
+
+    def test_max_idle(self):
+        connection = self.pool.borrow(self.connect)
+        self.pool.give_back(connection)
+        self.now += 10
+        self.assertIsNot(self.pool.borrow(self.connect), connection)
+        self.assertTrue(connection.closed)
+        self.assertCounts(recycled=1, size=1)
+
+    def test_health_check(self):
+        connection = self.pool.borrow(self.connect)
+        self.pool.give_back(connection)
+        connection.alive = False
+        # Not checked within check_after of being returned
+        self.assertIs(self.pool.borrow(self.connect), connection)
+        self.pool.give_back(connection)
+        self.now += 2
+        self.assertIsNot(self.pool.borrow(self.connect), connection)
+        self.assertTrue(connection.closed)
+        self.assertCounts(failed_checks=1, size=1)
+
+    def test_give_back_in_transaction(self):
+        connection = self.pool.borrow(self.connect)
+        connection.info.transaction_status = extensions.TRANSACTION_STATUS_INTRANS
+        self.pool.give_back(connection)
+        # Rolled back and kept
+        self.assertEqual(connection.info.transaction_status, extensions.TRANSACTION_STATUS_IDLE)
+        self.assertIs(self.pool.borrow(self.connect), connection)
+
+        connection.info.transaction_status = extensions.TRANSACTION_STATUS_INERROR
+        connection.alive = False
+        self.pool.give_back(connection)
+        self.assertTrue(connection.closed)
+        self.assertCounts(discarded=1, size=0)
+
+    def test_give_back_closed(self):
+        connection = self.pool.borrow(self.connect)
+        connection.close()
+        self.pool.give_back(connection)
+        self.assertCounts(discarded=1, size=0)
+
+    def test_fork(self):
+        settings_dict = {'POOL': {'MAX_SIZE': 1}}
+        with mock.patch.dict(pooling._pools, clear=True), mock.patch.object(pooling, '_inherited', []):
+            parent = pooling.get_pool('default', settings_dict)
+            self.assertIs(pooling.get_pool('default', settings_dict), parent)
+            connection = parent.borrow(self.connect)
+            parent.give_back(connection)
+            with mock.patch.object(pooling.os, 'getpid', return_value=parent.pid + 1):
+                child = pooling.get_pool('default', settings_dict)
+                self.assertIsNot(child, parent)
+                self.assertEqual(pooling.pools(), {'default': child})
+                self.assertIs(pooling.get_pool('default', settings_dict), child)
+                self.assertIsNot(child.borrow(self.connect), connection)
+            # The parent's connection stays open for the parent
+            self.assertEqual(pooling._inherited, [parent])
+            self.assertFalse(connection.closed)
+            self.assertEqual(child.max_size, 1)
@@ -0,0 +1,323 @@
+"""
+Streaming best-seller summaries.
+
+Units sold and revenue per product are tracked with Space-Saving summaries
+(Metwally et al.) instead of aggregating SaleItem on every request. A
+summary keeps at most ``k`` counters ``[count, error]`` over a weighted
+stream of total weight N, and guarantees:
+
+* a tracked product's true total lies in ``[count - error, count]``;
+* an untracked product's true total is at most ``min_count()``;
+* ``error`` and ``min_count()`` never exceed N / k, so every product whose
+  true total is above N / k is tracked.
+
+One summary is kept for all time and one per day; the 7 and 30 day windows
+merge the daily summaries, which keeps the bound at N_window / k. Summaries
+only ever grow: cancelled or edited sales are not subtracted until the next
+``manage.py reconcile_best_sellers --rebuild``.
+
+Every summary update locks the all-time row, so committed sales are not
+applied one by one: each process adds their weights to a buffer that is
+applied, in one update per day, BEST_SELLERS_FLUSH_INTERVAL seconds after
+its first sale (at once when that is 0). Summaries lag the sales by that
+much, and a process killed outright loses its buffer until the next
+rebuild.
+"""
+import atexit
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from functools import reduce
+from operator import or_
+
+from django.apps import apps as global_apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from . import caching
+from .models import BestSellerSummary, Product
+from .rollups import sale_day
+
+ALL_TIME = 'all'
+WINDOWS = {'all': None, '30d': 30, '7d': 7}
+METRICS = {'quantity': 'quantity', 'revenue': 'total_price'}
+
+_pending = {}
+_pending_lock = threading.Lock()
+_flush_timer = None
+
+class SpaceSaving:
+    """A weighted Space-Saving summary with at most ``k`` counters."""
+
+    def __init__(self, k, counters=None, total=Decimal('0')):
+        self.k = k
+        self.counters = counters if counters is not None else {}
+        self.total = total
+        self._untracked = None
+
+    @classmethod
+    def from_json(cls, k, counters, total):
+        return cls(k, {
+            int(key): [Decimal(count), Decimal(error)]
+            for key, (count, error) in counters.items()
+        }, Decimal(total))
+
+    def to_json(self):
+        return {str(key): [str(count), str(error)] for key, (count, error) in self.counters.items()}
+
+    def offer(self, key, weight):
+        weight = Decimal(weight)
+        self.total += weight
+        if key in self.counters:
+            self.counters[key][0] += weight
+        elif len(self.counters) < self.k:
+            self.counters[key] = [weight, Decimal('0')]
+        else:
+            victim = min(self.counters, key=lambda candidate: self.counters[candidate][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[key] = [floor + weight, floor]
+
+    def min_count(self):
+        """Upper bound on the total of any product that is not tracked."""
+        if self._untracked is not None:
+            return self._untracked
+        if len(self.counters) < self.k:
+            return Decimal('0')
+        return min(count for count, error in self.counters.values())
+
+    def estimate(self, key):
+        """Upper bound on ``key``'s true total."""
+        if key in self.counters:
+            return self.counters[key][0]
+        return self.min_count()
+
+    def top(self, n):
+        """The ``n`` largest ``(key, count, error)`` entries."""
+        ranked = sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)
+        return [(key, count, error) for key, (count, error) in ranked[:n]]
+
+    @classmethod
+    def merge(cls, summaries):
+        """
+        Combine summaries of disjoint streams. A product missing from one
+        of them is charged that summary's min_count() as both count and error.
+        """
+        summaries = list(summaries)
+        merged = cls(sum(summary.k for summary in summaries))
+        floors = [summary.min_count() for summary in summaries]
+        keys = set().union(*(summary.counters for summary in summaries))
+        for key in keys:
+            count = error = Decimal('0')
+            for summary, floor in zip(summaries, floors):
+                if key in summary.counters:
+                    count += summary.counters[key][0]
+                    error += summary.counters[key][1]
+                else:
+                    count += floor
+                    error += floor
+            merged.counters[key] = [count, error]
+        merged.total = sum((summary.total for summary in summaries), Decimal('0'))
+        merged._untracked = sum(floors, Decimal('0'))
+        return merged
+
+def _capacity():
+    return settings.BEST_SELLERS_CAPACITY
+
+def _window_periods(window, today=None):
+    days = WINDOWS[window]
+    if days is None:
+        return [ALL_TIME]
+    today = today or timezone.localdate()
+    return [(today - timedelta(days=offset)).isoformat() for offset in range(days)]
+
+def _oldest_day():
+    """First day of the longest windowed summary."""
+    return min(_window_periods(window)[-1] for window, days in WINDOWS.items() if days)
+
+def _day_weights():
+    return {metric: defaultdict(Decimal) for metric in METRICS}
+
+def record_sale(sale_date, lines):
+    """
+    Add a sale's ``(product_id, quantity, total_price)`` lines to the
+    all-time and daily summaries once the current transaction commits.
+    """
+    record_sales([(sale_date, lines)])
+
+def record_sales(sales):
+    """record_sale() for many ``(sale_date, lines)`` pairs at once."""
+    days = defaultdict(_day_weights)
+    for sale_date, lines in sales:
+        weights = days[sale_day(sale_date).isoformat()]
+        for product_id, quantity, total_price in lines:
+            weights['quantity'][product_id] += quantity
+            weights['revenue'][product_id] += total_price
+    # The sales stand even if this fails; reconcile_best_sellers repairs drift
+    transaction.on_commit(lambda: _buffer(days), robust=True)
+
+def _buffer(days):
+    """Add committed weights to the buffer and schedule its flush."""
+    global _flush_timer
+    interval = settings.BEST_SELLERS_FLUSH_INTERVAL
+    if not interval:
+        _apply_days(days)
+        return
+    with _pending_lock:
+        for day, weights in days.items():
+            pending = _pending.setdefault(day, _day_weights())
+            for metric, products in weights.items():
+                for product_id, weight in products.items():
+                    pending[metric][product_id] += weight
+        if _flush_timer is None:
+            _flush_timer = threading.Timer(interval, _flush_in_thread)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+def flush():
+    """Apply the weights buffered in this process now."""
+    global _flush_timer
+    with _pending_lock:
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+        days = dict(_pending)
+        _pending.clear()
+    _apply_days(days)
+
+def _flush_in_thread():
+    try:
+        flush()
+    finally:
+        connection.close()
+
+atexit.register(flush)
+
+def _apply_days(days):
+    for day, weights in sorted(days.items()):
+        _apply(day, weights)
+
+def _apply(day, weights):
+    keys = sorted((metric, period) for metric in weights for period in (ALL_TIME, day))
+    with transaction.atomic():
+        # Rows are locked in a fixed order so concurrent sales cannot deadlock
+        rows = {
+            (row.metric, row.period): row
+            for row in BestSellerSummary.objects.select_for_update().filter(
+                reduce(or_, (Q(metric=metric, period=period) for metric, period in keys))
+            ).order_by('metric', 'period')
+        }
+        for metric, period in keys:
+            if (metric, period) not in rows:
+                row, created = BestSellerSummary.objects.get_or_create(metric=metric, period=period)
+                if not created:
+                    # Another transaction inserted it since the locking read
+                    row = BestSellerSummary.objects.select_for_update().get(pk=row.pk)
+                elif period != ALL_TIME:
+                    _prune()
+                rows[(metric, period)] = row
+
+        now = timezone.now()
+        for (metric, period), row in rows.items():
+            summary = SpaceSaving.from_json(_capacity(), row.counters, row.total)
+            for product_id, weight in weights[metric].items():
+                summary.offer(product_id, weight)
+            row.counters = summary.to_json()
+            row.total = summary.total
+            row.updated_at = now
+        BestSellerSummary.objects.bulk_update(rows.values(), ['counters', 'total', 'updated_at'])
+        caching.bump_version(BestSellerSummary)
+
+def _prune():
+    """Drop daily summaries that have left the longest window."""
+    BestSellerSummary.objects.exclude(period=ALL_TIME).filter(period__lt=_oldest_day()).delete()
+
+def window_summary(window='all', metric='quantity'):
+    """The (merged) summary covering ``window``."""
+    rows = BestSellerSummary.objects.filter(metric=metric, period__in=_window_periods(window))
+    return SpaceSaving.merge(
+        SpaceSaving.from_json(_capacity(), row.counters, row.total) for row in rows
+    )
+
+def best_sellers(n=5, window='all', metric='quantity'):
+    """
+    Top ``n`` products as dicts with the estimated total (an upper bound)
+    and the maximum overestimate ``error``.
+    """
+    summary = window_summary(window, metric)
+    convert = int if metric == 'quantity' else Decimal
+    return [
+        {'product': key, 'estimate': convert(count), 'error': convert(error)}
+        for key, count, error in summary.top(n)
+    ]
+
+def top_products(n=5, window='all'):
+    """
+    Best selling products by units, each annotated with ``units_estimate``
+    (an upper bound, see best_sellers()).
+    """
+    ranked = best_sellers(n, window, 'quantity')
+    products = Product.objects.select_related('category').in_bulk(
+        [entry['product'] for entry in ranked])
+    result = []
+    for entry in ranked:
+        product = products.get(entry['product'])
+        if product is not None:
+            product.units_estimate = entry['estimate']
+            result.append(product)
+    return result
+
+def exact_totals(window='all', metric='quantity', apps=global_apps):
+    """Exact per-product totals for ``window`` straight from SaleItem."""
+    SaleItem = apps.get_model('products', 'SaleItem')
+    items = SaleItem.objects.all()
+    if WINDOWS[window]:
+        periods = _window_periods(window)
+        items = items.annotate(
+            day=TruncDate('sale__sale_date', tzinfo=timezone.get_default_timezone())
+        ).filter(day__gte=periods[-1], day__lte=periods[0])
+    return dict(items.values('product_id').annotate(
+        total=Sum(METRICS[metric])
+    ).order_by().values_list('product_id', 'total'))
+
+def rebuild(apps=global_apps):
+    """
+    Replace all summaries with exact top-k counts (error 0) computed from
+    SaleItem. ``apps`` lets migrations run this against historical models.
+    Sales still buffered by other processes are added again when they
+    flush, so run it while writes are quiet.
+    """
+    SaleItem = apps.get_model('products', 'SaleItem')
+    BestSellerSummary = apps.get_model('products', 'BestSellerSummary')
+    k = _capacity()
+
+    def summary_row(metric, period, totals):
+        summary = SpaceSaving(k, total=sum(totals.values(), Decimal('0')))
+        for key, total in sorted(totals.items(), key=lambda item: item[1], reverse=True)[:k]:
+            summary.counters[key] = [Decimal(total), Decimal('0')]
+        return BestSellerSummary(metric=metric, period=period,
+                                 counters=summary.to_json(), total=summary.total)
+
+    with _pending_lock:
+        # Committed sales, which the rebuild counts
+        _pending.clear()
+    rows = []
+    for metric, field in METRICS.items():
+        rows.append(summary_row(metric, ALL_TIME, exact_totals('all', metric, apps)))
+        daily = defaultdict(dict)
+        lines = SaleItem.objects.annotate(
+            day=TruncDate('sale__sale_date', tzinfo=timezone.get_default_timezone())
+        ).filter(day__gte=_oldest_day()).values('day', 'product_id').annotate(
+            total=Sum(field)
+        ).order_by()
+        for line in lines:
+            daily[line['day'].isoformat()][line['product_id']] = line['total']
+        rows.extend(summary_row(metric, period, totals) for period, totals in daily.items())
+
+    with transaction.atomic():
+        BestSellerSummary.objects.all().delete()
+        BestSellerSummary.objects.bulk_create(rows)
+        caching.bump_version(BestSellerSummary)
@@ -0,0 +1,125 @@
+"""
+Request transactions by HTTP method.
+
+ATOMIC_REQUESTS stays on, so POST, PUT, PATCH and DELETE requests (sale
+creation included) run in one transaction, which Django REST Framework rolls
+back when it turns an exception into an error response.
+``transaction.non_atomic_requests`` still opts a view out of it.
+
+GET, HEAD and OPTIONS requests follow SAFE_REQUEST_TRANSACTION instead:
+
+- ``autocommit``: every query commits on its own, saving the BEGIN and
+  COMMIT round trips. At PostgreSQL's READ COMMITTED default, queries in one
+  transaction each saw their own snapshot anyway.
+- ``read_only``: one READ ONLY transaction at SAFE_REQUEST_ISOLATION (REPEATABLE
+  READ by default), so every query of the request, template rendering
+  included, reads the same snapshot. The characteristics are set with SET
+  TRANSACTION before the first statement, one round trip more than
+  ``atomic``, and end with the transaction, so nothing is left on the
+  session (see TRANSACTION_MODE in product_management.postgresql_pool).
+  The replica a request reads from (see products.routing) gets one too,
+  although replicas are not ATOMIC_REQUESTS, so a request that also reads
+  from the primary sees a snapshot on each. Other databases than PostgreSQL
+  use ``atomic``.
+- ``atomic``: Django's ATOMIC_REQUESTS transaction.
+
+A view picks its own with ``@safe_transaction(mode)`` on a view function or
+ViewSet action, a ``safe_request_transaction`` attribute on the view class,
+or AtomicReadsMixin. SafeRequestTransactionMiddleware, last in MIDDLEWARE,
+calls safe requests' views itself in their mode, so their exceptions do not
+reach the process_exception() of other middleware.
+"""
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction
+
+from . import routing
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+MODES = ('autocommit', 'read_only', 'atomic')
+ISOLATION_LEVELS = ('read committed', 'repeatable read', 'serializable')
+
+def safe_transaction(mode):
+    """Run GET, HEAD and OPTIONS requests of a view function, or a ViewSet action, in ``mode``."""
+    if mode not in MODES:
+        raise ValueError(f'Unknown request transaction mode {mode!r}')
+
+    def decorator(view):
+        view.safe_request_transaction = mode
+        return view
+    return decorator
+
+class AtomicReadsMixin:
+    """Run a class-based view's GET, HEAD and OPTIONS requests in one read-write transaction."""
+    safe_request_transaction = 'atomic'
+
+def _view_mode(request, view_func):
+    view_class = getattr(view_func, 'view_class', None) or getattr(view_func, 'cls', None)
+    action = (getattr(view_func, 'actions', None) or {}).get(request.method.lower())
+    for view in (getattr(view_class, action or '', None), view_func, view_class):
+        mode = getattr(view, 'safe_request_transaction', None)
+        if mode:
+            return mode
+    return settings.SAFE_REQUEST_TRANSACTION
+
+def _read_only(isolation_level):
+    """
+    An execute wrapper making the transaction it runs in READ ONLY at
+    ``isolation_level``, with SET TRANSACTION before its first statement.
+    """
+    statement = f'SET TRANSACTION ISOLATION LEVEL {isolation_level.upper()} READ ONLY'
+    pending = True
+
+    def wrapper(execute, sql, params, many, context):
+        nonlocal pending
+        if pending:
+            pending = False
+            context['cursor'].execute(statement)
+        return execute(sql, params, many, context)
+    return wrapper
+
+class SafeRequestTransactionMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if settings.SAFE_REQUEST_TRANSACTION not in MODES:
+            raise ImproperlyConfigured(f'SAFE_REQUEST_TRANSACTION must be one of {", ".join(MODES)}')
+        if settings.SAFE_REQUEST_ISOLATION not in ISOLATION_LEVELS:
+            raise ImproperlyConfigured(
+                f'SAFE_REQUEST_ISOLATION must be one of {", ".join(ISOLATION_LEVELS)}')
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in SAFE_METHODS:
+            return None
+        non_atomic = getattr(view_func, '_non_atomic_requests', set())
+        aliases = [alias for alias, settings_dict in connections.settings.items()
+                   if settings_dict['ATOMIC_REQUESTS'] and alias not in non_atomic]
+        mode = _view_mode(request, view_func)
+        replica = routing.current_replica()
+        if mode == 'read_only' and replica is not None and replica not in non_atomic:
+            aliases.append(replica)
+        if not aliases or mode == 'atomic':
+            return None
+        if mode == 'autocommit':
+            return view_func(request, *view_args, **view_kwargs)
+
+        if any(connections[alias].vendor != 'postgresql' for alias in aliases):
+            return None
+        with ExitStack() as stack:
+            for alias in aliases:
+                connection = connections[alias]
+                # SET TRANSACTION is refused once a transaction has run a query
+                outermost = not connection.in_atomic_block
+                stack.enter_context(transaction.atomic(using=alias))
+                if outermost:
+                    stack.enter_context(connection.execute_wrapper(
+                        _read_only(settings.SAFE_REQUEST_ISOLATION)))
+            response = view_func(request, *view_args, **view_kwargs)
+            if callable(getattr(response, 'render', None)):
+                # Lists are queried when the template renders
+                response = response.render()
+        return response
@@ -7,7 +7,8 @@ from .views import (
     ProductDeleteView, CategoryListView, CategoryCreateView,
     CategoryUpdateView, CategoryDeleteView, CustomerListView,
     CustomerCreateView, CustomerUpdateView, CustomerDeleteView,
-    SaleListView
+    SaleListView, SaleBulkView, PendingSaleViewSet, AutocompleteView, AutocompleteStatsView,
+    DatabasePoolStatsView, QuerysetCacheStatsView
 )
 
 app_name = 'products'
@@ -19,6 +20,7 @@ router.register(r'products', ProductViewSet)
 router.register(r'customers', CustomerViewSet)
 router.register(r'sales', SaleViewSet)
 router.register(r'sale-items', SaleItemViewSet)
+router.register(r'sale-queue', PendingSaleViewSet)
 
 urlpatterns = [
     # Template Views
@@ -45,6 +47,11 @@ urlpatterns = [
     path('sales/', SaleListView.as_view(), name='sale_list'),
     
     # API Routes
+    path('api/sales/bulk/', SaleBulkView.as_view(), name='sale_bulk'),
+    path('api/autocomplete/', AutocompleteView.as_view(), name='autocomplete'),
+    path('api/autocomplete/stats/', AutocompleteStatsView.as_view(), name='autocomplete_stats'),
+    path('api/db-pool/stats/', DatabasePoolStatsView.as_view(), name='db_pool_stats'),
+    path('api/queryset-cache/stats/', QuerysetCacheStatsView.as_view(), name='queryset_cache_stats'),
     path('api/', include(router.urls)),
 ]
 
@@ -62,8 +69,19 @@ urlpatterns = [
 # /api/customers/{id}/purchase_history/ - Get customer's purchase history
 
 # /api/sales/ - List and create sales
+# /api/sales/bulk/ - Create many sales from a JSON array or NDJSON body
 # /api/sales/{id}/ - Retrieve, update, delete sale
 # /api/sales/dashboard_stats/ - Get sales dashboard statistics
+# /api/sales/best_sellers/ - Approximate top-N products (window=all|30d|7d, metric=quantity|revenue)
+# /api/sales/timeseries/ - Sales totals per day/week/month from the rollups
+
+# /api/sale-queue/ - Sales accepted by the write-behind API
+# /api/sale-queue/{id}/ - Status of an accepted sale (queued, created or failed)
+
+# /api/autocomplete/?q=&type=product|customer - Typeahead matches from the worker's in-memory index
+# /api/autocomplete/stats/ - Size of the typeahead indexes in the worker that answers
+# /api/db-pool/stats/ - Connection pool counters of the worker that answers (DATABASE_POOL)
+# /api/queryset-cache/stats/ - Queryset cache hits and misses of the worker that answers
 
 # /api/sale-items/ - List and create sale items
 # /api/sale-items/{id}/ - Retrieve, update, delete sale item
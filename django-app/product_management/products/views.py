@@ -1,26 +1,199 @@
-from rest_framework import viewsets, filters
+import io
+import os
+
+from rest_framework import viewsets, filters, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import BasePermission
 from rest_framework.response import Response
-from django.db.models import Sum, Count, F
+from rest_framework.views import APIView
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Sum, F
+from django.http import Http404
 from django.views.generic import TemplateView, ListView, CreateView, UpdateView, DeleteView
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.urls import reverse_lazy
 from django.contrib import messages
+from django.conf import settings
 from django.utils import timezone
-from django.db.models.functions import TruncDate
+from django.utils.decorators import method_decorator
+from django.db import connections, transaction
+from django.utils.dateparse import parse_date
 from datetime import timedelta
 from django_filters.rest_framework import DjangoFilterBackend
-from .models import Category, Product, Customer, Sale, SaleItem
+from . import (
+    autocomplete, caching, conditional, export, fastread, ingest, prefetch, querycache, rollups, routing, search,
+    stock, topk, transactions, writebehind
+)
+from .models import (
+    Category, Product, Customer, Sale, SaleItem, DailySales, BestSellerSummary, StockShard,
+    PendingSale
+)
 from .serializers import (
     CategorySerializer, ProductSerializer, CustomerSerializer,
-    SaleSerializer, SaleItemSerializer
+    SaleSerializer, SaleItemSerializer, SaleItemExportSerializer, PendingSaleSerializer
 )
+from .renderers import CSVRenderer, NDJSONRenderer
+
+# Models whose writes invalidate the cached dashboard data
+DASHBOARD_MODELS = [Product, Category, Customer, Sale, SaleItem, BestSellerSummary]
+
+def date_param(params, name):
+    """Parse an optional YYYY-MM-DD query parameter."""
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        parsed = parse_date(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValidationError({name: 'Enter a valid date in YYYY-MM-DD format.'})
+    return parsed
+
+def id_param(params, name):
+    """Parse an optional primary key query parameter."""
+    value = params.get(name)
+    if not value:
+        return None
+    if not value.isdigit():
+        raise ValidationError({name: 'Enter a valid id.'})
+    return int(value)
+
+def list_param(params, name):
+    """Parse an optional comma-separated query parameter."""
+    value = params.get(name)
+    if value is None:
+        return None
+    return [item for item in (part.strip() for part in value.split(',')) if item]
+
+def get_reader(request, serializer_class):
+    """The fast reader for ``serializer_class`` with the request's ?fields= and ?expand=."""
+    params = request.query_params
+    return fastread.reader_for(serializer_class, list_param(params, 'fields'),
+                               list_param(params, 'expand') or ())
+
+def read_page(view, serializer_class, queryset, context=None):
+    """
+    A paginated response of ``queryset`` read through products.fastread,
+    or 304 when the client's copy is current.
+    """
+    reader = get_reader(view.request, serializer_class)
+
+    def get_response():
+        rows = reader.rows(queryset)
+        page = view.paginate_queryset(rows)
+        if page is None:
+            return Response(reader.convert(rows, context))
+        return view.get_paginated_response(reader.convert(page, context))
+    return conditional.respond(view.request, reader.models, get_response)
+
+def export_response(view, serializer_class, queryset, name, date_field):
+    """
+    Stream ``queryset`` as NDJSON or CSV through products.export, limited
+    to the ``from``/``to`` dates of ``date_field``, as ``name``.ndjson or
+    ``name``.csv.
+    """
+    request = view.request
+    queryset = export.in_range(queryset, date_field, date_param(request.query_params, 'from'),
+                               date_param(request.query_params, 'to'))
+    return export.export(request, get_reader(request, serializer_class), queryset, name,
+                         request.accepted_renderer.format, view.get_serializer_context())
+
+class EagerLoadingMixin:
+    """Select and prefetch the relations the action's serializer reads."""
+
+    def get_queryset(self):
+        return prefetch.for_serializer(super().get_queryset(), self.get_serializer_class())
+
+class FastReadMixin:
+    """
+    Serve list and retrieve through products.fastread, reading the
+    serializer's fields with values_list() instead of building instances.
+    Updates answer with the same read of the saved row. ``?fields=`` limits
+    the output to some fields and ``?expand=`` embeds the relations the
+    serializer lists in Meta.expandable_fields. Retrieve only loads the
+    instance when a permission class checks object permissions. Both answer
+    conditional GETs (see products.conditional).
+    """
+
+    def read_object(self, **lookup):
+        reader = get_reader(self.request, self.get_serializer_class())
+        try:
+            rows = list(reader.rows(self.filter_queryset(self.get_queryset()).filter(**lookup))[:1])
+        except (TypeError, ValueError, DjangoValidationError):
+            # Lookup values of the wrong type, as get_object_or_404() treats them
+            raise Http404
+        data = reader.convert(rows, self.get_serializer_context())
+        if not data:
+            raise Http404
+        return data[0]
+
+    def check_read_permissions(self):
+        """check_object_permissions() on the requested instance, if any permission reads it."""
+        if any(type(permission).has_object_permission is not BasePermission.has_object_permission
+               for permission in self.get_permissions()):
+            self.get_object()
+
+    def list(self, request, *args, **kwargs):
+        return read_page(self, self.get_serializer_class(),
+                         self.filter_queryset(self.get_queryset()), self.get_serializer_context())
+
+    def retrieve(self, request, *args, **kwargs):
+        self.check_read_permissions()
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        reader = get_reader(request, self.get_serializer_class())
+        return conditional.respond(request, reader.models, lambda: Response(
+            self.read_object(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})))
 
-class DashboardView(LoginRequiredMixin, TemplateView):
+    def update(self, request, *args, **kwargs):
+        # DRF's update() drops the prefetched relations before serializing
+        partial = kwargs.pop('partial', False)
+        serializer = self.get_serializer(self.get_object(), data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        self.perform_update(serializer)
+        return Response(self.read_object(pk=serializer.instance.pk))
+
+class ConditionalGetMixin:
+    """
+    Answer conditional GETs of a page through products.conditional, with
+    validators from the versions of ``conditional_models``. Pages with
+    pending flash messages are always rendered, and the ETag covers the
+    CSRF cookie that the page's forms embed.
+    """
+    conditional_models = []
+
+    def get_conditional_extra(self):
+        return [self.request.META.get('CSRF_COOKIE')]
+
+    def get(self, request, *args, **kwargs):
+        def get_response():
+            return super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+        if len(messages.get_messages(request)):
+            return get_response()
+        return conditional.respond(request, self.conditional_models, get_response,
+                                   *self.get_conditional_extra())
+
+class DashboardView(LoginRequiredMixin, ConditionalGetMixin, TemplateView):
     template_name = 'products/dashboard.html'
+    conditional_models = DASHBOARD_MODELS
+    # The cached figures are built from one snapshot
+    safe_request_transaction = 'read_only'
+
+    def get_conditional_extra(self):
+        # The cached data is rebuilt each day as well
+        return [*super().get_conditional_extra(), timezone.localdate()]
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context.update(caching.get_or_build(
+            f'dashboard:{timezone.localdate()}', DASHBOARD_MODELS, self.build_dashboard_data
+        ))
+        return context
+
+    @staticmethod
+    def build_dashboard_data():
+        context = {}
         
         # Get date range for filtering (last 30 days)
         end_date = timezone.now()
@@ -28,67 +201,74 @@ class DashboardView(LoginRequiredMixin, TemplateView):
         
         # Basic statistics
         context['total_products'] = Product.objects.count()
-        context['total_stock'] = Product.objects.aggregate(total=Sum('stock'))['total'] or 0
+        context['total_stock'] = (
+            (Product.objects.aggregate(total=Sum('stock'))['total'] or 0)
+            + (StockShard.objects.aggregate(total=Sum('quantity'))['total'] or 0)
+        )
         context['total_categories'] = Category.objects.count()
         context['total_customers'] = Customer.objects.count()
         
-        # Sales data for the chart
-        sales_data = Sale.objects.filter(
-            sale_date__range=(start_date, end_date),
+        # Sales data for the chart, read from the daily rollups
+        completed_days = DailySales.objects.filter(
+            date__range=(rollups.sale_day(start_date), rollups.sale_day(end_date)),
             status='completed'
-        ).annotate(
-            date=TruncDate('sale_date')
-        ).values('date').annotate(
-            amount=Sum('total_amount')
-        ).order_by('date')
+        )
+        sales_data = completed_days.values('date').annotate(
+            sales_count=Sum('sales_count'), total_amount=Sum('total_amount')
+        ).filter(sales_count__gt=0).order_by('date')
         
         if sales_data:
             context['sales_data'] = True
             context['dates'] = [sale['date'].strftime('%Y-%m-%d') for sale in sales_data]
-            context['sales_amounts'] = [float(sale['amount']) for sale in sales_data]
+            context['sales_amounts'] = [float(sale['total_amount']) for sale in sales_data]
         
         # Top selling products
-        context['top_products'] = Product.objects.annotate(
-            sales_count=Count('saleitem')
-        ).order_by('-sales_count')[:5]
+        context['top_products'] = topk.top_products(5)
         
         # Recent sales
-        context['recent_sales'] = Sale.objects.select_related(
+        context['recent_sales'] = list(Sale.objects.select_related(
             'customer'
-        ).order_by('-sale_date')[:5]
+        ).order_by('-sale_date')[:5])
         
         # Low stock products (less than 10 items)
-        context['low_stock_products'] = Product.objects.select_related(
+        context['low_stock_products'] = list(Product.objects.low_stock(9).select_related(
             'category'
-        ).filter(stock__lt=10).order_by('stock')[:5]
+        ).order_by('available_stock')[:5])
         
         # Total sales amount for last 30 days
-        context['total_sales'] = Sale.objects.filter(
-            sale_date__range=(start_date, end_date),
-            status='completed'
-        ).aggregate(total=Sum('total_amount'))['total'] or 0
+        context['total_sales'] = completed_days.aggregate(
+            total=Sum('total_amount'))['total'] or 0
         
         return context
 
-class ProductListView(LoginRequiredMixin, ListView):
+class CachedCategoryChoicesMixin:
+    """Offer the categories of the form's dropdown from products.querycache."""
+
+    def get_form(self, form_class=None):
+        form = super().get_form(form_class)
+        form.fields['category'].queryset = Category.objects.cached()
+        return form
+
+class ProductListView(LoginRequiredMixin, ConditionalGetMixin, ListView):
     model = Product
     template_name = 'products/product_list.html'
     context_object_name = 'products'
     paginate_by = 10
+    conditional_models = [Product, Category]
     
     def get_queryset(self):
         queryset = super().get_queryset()
         category_id = self.request.GET.get('category')
-        search = self.request.GET.get('search')
+        query = self.request.GET.get('search')
         
         if category_id:
             queryset = queryset.filter(category_id=category_id)
-        if search:
-            queryset = queryset.filter(name__icontains=search)
+        if query:
+            queryset = search.search(queryset, query)
         
-        return queryset.select_related('category')
+        return queryset.with_stock().select_related('category')
 
-class ProductCreateView(LoginRequiredMixin, CreateView):
+class ProductCreateView(LoginRequiredMixin, CachedCategoryChoicesMixin, CreateView):
     model = Product
     template_name = 'products/product_form.html'
     fields = ['name', 'description', 'category', 'price', 'stock', 'image']
@@ -98,13 +278,17 @@ class ProductCreateView(LoginRequiredMixin, CreateView):
         messages.success(self.request, 'Product created successfully.')
         return super().form_valid(form)
 
-class ProductUpdateView(LoginRequiredMixin, UpdateView):
+class ProductUpdateView(LoginRequiredMixin, CachedCategoryChoicesMixin, UpdateView):
     model = Product
     template_name = 'products/product_form.html'
     fields = ['name', 'description', 'category', 'price', 'stock', 'image']
     success_url = reverse_lazy('products:product_list')
+
+    def get_initial(self):
+        return {**super().get_initial(), 'stock': self.object.available_stock}
     
     def form_valid(self, form):
+        stock.set_stock(form.instance, form.cleaned_data['stock'])
         messages.success(self.request, 'Product updated successfully.')
         return super().form_valid(form)
 
@@ -144,16 +328,12 @@ class CategoryDeleteView(LoginRequiredMixin, DeleteView):
         messages.success(request, 'Category deleted successfully.')
         return super().delete(request, *args, **kwargs)
 
-class CategoryListView(LoginRequiredMixin, ListView):
+class CategoryListView(LoginRequiredMixin, ConditionalGetMixin, ListView):
     model = Category
     template_name = 'products/category_list.html'
     context_object_name = 'categories'
     paginate_by = 10
-
-    def get_queryset(self):
-        return super().get_queryset().annotate(
-            products_count=Count('products')
-        )
+    conditional_models = [Category, Product]
 
 class CustomerCreateView(LoginRequiredMixin, CreateView):
     model = Customer
@@ -183,67 +363,81 @@ class CustomerDeleteView(LoginRequiredMixin, DeleteView):
         messages.success(request, 'Customer deleted successfully.')
         return super().delete(request, *args, **kwargs)
 
-class CustomerListView(LoginRequiredMixin, ListView):
+class CustomerListView(LoginRequiredMixin, ConditionalGetMixin, ListView):
     model = Customer
     template_name = 'products/customer_list.html'
     context_object_name = 'customers'
     paginate_by = 10
+    conditional_models = [Customer, Sale]
 
     def get_queryset(self):
-        return super().get_queryset().annotate(
-            total_purchases=Count('sales')
-        )
+        return super().get_queryset().order_by('pk')
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(FastReadMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     filter_backends = [filters.SearchFilter]
     search_fields = ['name']
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve', 'products'):
+            queryset = queryset.cached()
+        return queryset
+
     @action(detail=True)
     def products(self, request, pk=None):
         category = self.get_object()
-        products = category.products.all()
-        serializer = ProductSerializer(products, many=True)
-        return Response(serializer.data)
+        products = category.products.with_stock().cached()
+        return read_page(self, ProductSerializer, products)
 
-class ProductViewSet(viewsets.ModelViewSet):
-    queryset = Product.objects.all()
+class ProductViewSet(FastReadMixin, EagerLoadingMixin, viewsets.ModelViewSet):
+    queryset = Product.objects.with_stock()
     serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
+    filter_backends = [DjangoFilterBackend, search.SearchFilter]
     filterset_fields = ['category']
     search_fields = ['name', 'description']
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'retrieve':
+            queryset = queryset.cached()
+        return queryset
+
     @action(detail=False)
     def low_stock(self, request):
         threshold = int(request.query_params.get('threshold', 10))
-        products = Product.objects.filter(stock__lte=threshold)
-        serializer = self.get_serializer(products, many=True)
-        return Response(serializer.data)
+        products = Product.objects.low_stock(threshold)
+        return read_page(self, ProductSerializer, products, self.get_serializer_context())
 
-class CustomerViewSet(viewsets.ModelViewSet):
+class CustomerViewSet(FastReadMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     queryset = Customer.objects.all()
     serializer_class = CustomerSerializer
-    filter_backends = [filters.SearchFilter]
+    filter_backends = [search.SearchFilter]
     search_fields = ['name', 'email']
 
     @action(detail=True)
     def purchase_history(self, request, pk=None):
         customer = self.get_object()
         sales = customer.sales.all()
-        serializer = SaleSerializer(sales, many=True)
-        return Response(serializer.data)
+        return read_page(self, SaleSerializer, sales)
 
-class SaleListView(LoginRequiredMixin, ListView):
+    @action(detail=False, renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        return export_response(self, CustomerSerializer, self.filter_queryset(self.get_queryset()),
+                               'customers', 'created_at')
+
+class SaleListView(LoginRequiredMixin, ConditionalGetMixin, ListView):
     model = Sale
     template_name = 'products/sale_list.html'
     context_object_name = 'sales'
     paginate_by = 10
+    conditional_models = [Sale, Customer]
 
     def get_queryset(self):
-        return super().get_queryset().select_related('customer')
+        return super().get_queryset().select_related('customer').order_by('-sale_date', '-pk')
 
-class SaleViewSet(viewsets.ModelViewSet):
+class SaleViewSet(FastReadMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     queryset = Sale.objects.all()
     serializer_class = SaleSerializer
     filter_backends = [DjangoFilterBackend]
@@ -255,29 +449,178 @@ class SaleViewSet(viewsets.ModelViewSet):
             context={'items': request.data.get('items', [])}
         )
         serializer.is_valid(raise_exception=True)
+        if settings.SALES_WRITE_BEHIND:
+            pending = writebehind.enqueue(
+                serializer.validated_data['customer'].pk,
+                serializer.validated_data.get('status', 'pending'),
+                serializer.get_lines()
+            )
+            return Response(PendingSaleSerializer(pending).data, status=status.HTTP_202_ACCEPTED)
         self.perform_create(serializer)
-        return Response(serializer.data)
+        return Response(self.read_object(pk=serializer.instance.pk))
+
+    @action(detail=False, renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        return export_response(self, SaleSerializer, self.filter_queryset(self.get_queryset()),
+                               'sales', 'sale_date')
 
     @action(detail=False)
+    @transactions.safe_transaction('read_only')
     def dashboard_stats(self, request):
-        total_sales = Sale.objects.filter(status='completed').aggregate(
+        return conditional.respond(request, DASHBOARD_MODELS, lambda: Response(
+            caching.get_or_build('dashboard_stats', DASHBOARD_MODELS, self.build_dashboard_stats)
+        ))
+
+    @staticmethod
+    def build_dashboard_stats():
+        total_sales = DailySales.objects.filter(status='completed').aggregate(
             total=Sum('total_amount'))['total'] or 0
-        top_products = SaleItem.objects.values(
-            'product__name').annotate(
-            total_quantity=Sum('quantity'),
-            total_sales=Sum('total_price')
-        ).order_by('-total_sales')[:5]
-        recent_sales = Sale.objects.filter(
-            status='completed').order_by('-created_at')[:5]
+        best_sellers = topk.best_sellers(5, metric='revenue')
+        quantities = topk.window_summary(metric='quantity')
+        names = dict(Product.objects.filter(
+            pk__in=[entry['product'] for entry in best_sellers]
+        ).values_list('id', 'name'))
+        top_products = [{
+            'product__name': names.get(entry['product']),
+            'total_quantity': int(quantities.estimate(entry['product'])),
+            'total_sales': entry['estimate']
+        } for entry in best_sellers]
+        recent_sales = prefetch.for_serializer(Sale.objects.filter(
+            status='completed'), SaleSerializer).order_by('-created_at')[:5]
 
-        return Response({
+        return {
             'total_sales': total_sales,
             'top_products': top_products,
-            'recent_sales': SaleSerializer(recent_sales, many=True).data
+            'recent_sales': list(SaleSerializer(recent_sales, many=True).data)
+        }
+
+    @action(detail=False)
+    def best_sellers(self, request):
+        params = request.query_params
+        window = params.get('window', 'all')
+        metric = params.get('metric', 'quantity')
+        if window not in topk.WINDOWS:
+            raise ValidationError({'window': 'Must be one of: %s.' % ', '.join(topk.WINDOWS)})
+        if metric not in topk.METRICS:
+            raise ValidationError({'metric': 'Must be one of: %s.' % ', '.join(topk.METRICS)})
+        limit = min(id_param(params, 'limit') or 10, settings.BEST_SELLERS_CAPACITY)
+
+        best_sellers = topk.best_sellers(limit, window, metric)
+        names = dict(Product.objects.filter(
+            pk__in=[entry['product'] for entry in best_sellers]
+        ).values_list('id', 'name'))
+        for entry in best_sellers:
+            entry['product_name'] = names.get(entry['product'])
+        return Response(best_sellers)
+
+    @action(detail=False)
+    def timeseries(self, request):
+        params = request.query_params
+        granularity = params.get('granularity', 'day')
+        if granularity not in rollups.GRANULARITIES:
+            raise ValidationError({'granularity': 'Must be one of: %s.' % ', '.join(rollups.GRANULARITIES)})
+
+        return Response(rollups.sales_timeseries(
+            granularity,
+            date_from=date_param(params, 'from'),
+            date_to=date_param(params, 'to'),
+            status=params.get('status', 'completed'),
+            product=id_param(params, 'product'),
+            category=id_param(params, 'category')
+        ))
+
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
+class SaleBulkView(APIView):
+    """
+    Ingest a JSON array or NDJSON stream of sales in one request. Sales are
+    committed in chunks, so the request is not wrapped in ATOMIC_REQUESTS.
+    """
+
+    def post(self, request):
+        results = []
+        error = None
+        try:
+            for result in ingest.ingest_sales(ingest.iter_records(request.stream or io.BytesIO())):
+                results.append(result)
+        except ValueError as exc:
+            error = str(exc)
+
+        created = sum(result['status'] == 'created' for result in results)
+        body = {'created': created, 'failed': len(results) - created, 'results': results}
+        if error:
+            body['error'] = f'Malformed input after record {len(results)}: {error}'
+            return Response(body, status=status.HTTP_400_BAD_REQUEST)
+        return Response(body)
+
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
+class AutocompleteView(APIView):
+    """
+    Typeahead matches for ``q`` among product or customer names (``type``),
+    answered from this worker's in-memory index without querying the database.
+    """
+
+    def get(self, request):
+        params = request.query_params
+        index = autocomplete.INDEXES.get(params.get('type', 'product'))
+        if index is None:
+            raise ValidationError({'type': f'Choose one of: {", ".join(autocomplete.INDEXES)}.'})
+        try:
+            limit = min(max(int(params.get('limit', 10)), 1), autocomplete.MAX_LIMIT)
+        except ValueError:
+            raise ValidationError({'limit': 'Enter a whole number.'})
+        return Response({'results': index.lookup(params.get('q', ''), limit)})
+
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
+class AutocompleteStatsView(APIView):
+    """Size of this worker's typeahead indexes."""
+
+    def get(self, request):
+        return Response({
+            'pid': os.getpid(),
+            'max_entries': settings.AUTOCOMPLETE_MAX_ENTRIES,
+            'indexes': {name: index.stats() for name, index in autocomplete.INDEXES.items()},
+        })
+
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
+class DatabasePoolStatsView(APIView):
+    """Connection pool counters of this worker, with DATABASE_POOL."""
+
+    def get(self, request):
+        return Response({
+            'pid': os.getpid(),
+            'pools': {
+                alias: connections[alias].pool.stats()
+                for alias in connections if hasattr(connections[alias], 'pool')
+            },
         })
 
-class SaleItemViewSet(viewsets.ModelViewSet):
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
+class QuerysetCacheStatsView(APIView):
+    """Hit and miss counters of this worker's queryset cache."""
+
+    def get(self, request):
+        return Response({
+            'pid': os.getpid(),
+            'enabled': settings.QUERYSET_CACHE,
+            **querycache.stats(),
+        })
+
+class PendingSaleViewSet(routing.PrimaryDatabaseMixin, FastReadMixin, viewsets.ReadOnlyModelViewSet):
+    """Status of sales accepted by the write-behind API, read from the primary as the worker updates it."""
+    queryset = PendingSale.objects.all()
+    serializer_class = PendingSaleSerializer
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ['status']
+
+class SaleItemViewSet(FastReadMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     queryset = SaleItem.objects.all()
     serializer_class = SaleItemSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['sale', 'product']
+
+    @action(detail=False, renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        items = self.filter_queryset(self.get_queryset())
+        if request.query_params.get('status'):
+            items = items.filter(sale__status=request.query_params['status'])
+        return export_response(self, SaleItemExportSerializer, items, 'sale-items', 'sale__sale_date')
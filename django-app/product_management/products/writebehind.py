@@ -0,0 +1,82 @@
+"""
+Write-behind sale ingestion.
+
+With ``SALES_WRITE_BEHIND`` enabled, ``POST /api/sales/`` validates a sale,
+stores it as a PendingSale row and answers 202 with the pending id instead
+of writing the sale. ``manage.py process_sale_queue`` drains the queue in
+group commits: each batch of queued rows is written with the bulk ingestion
+path and marked processed in the same transaction, so a worker that dies
+mid-batch leaves its rows queued for the next run and no sale is written
+twice. A batch that raises is retried one row at a time, and rows that still
+raise are marked failed, so a bad row cannot block the queue. Sales are dated
+when they were accepted, not when they are written. The outcome of an
+accepted sale is served by ``/api/sale-queue/<id>/``.
+"""
+from datetime import timedelta
+
+from django.db import OperationalError, transaction
+from django.utils import timezone
+
+from . import caching, ingest
+from .models import PendingSale
+
+BATCH_SIZE = 500
+
+def enqueue(customer_id, status, lines):
+    """Queue a validated sale of ``(product_id, quantity)`` lines."""
+    return PendingSale.objects.create(payload={
+        'customer': customer_id,
+        'status': status,
+        'items': [{'product': product_id, 'quantity': quantity} for product_id, quantity in lines],
+    })
+
+def _write(rows):
+    """Write queued ``rows`` with the bulk ingestion path and return their results by id."""
+    results = ingest.write_chunk([(row.pk, row.payload) for row in rows],
+                                 sale_dates={row.pk: row.created_at for row in rows})
+    return {result['index']: result for result in results}
+
+def _try_write(rows):
+    """_write() in a savepoint, or None if it raised for any reason but a transient one."""
+    try:
+        with transaction.atomic():
+            return _write(rows)
+    except OperationalError:
+        # Lost connections and deadlocks leave the rows queued for the next run
+        raise
+    except Exception:
+        return None
+
+def drain(batch_size=BATCH_SIZE):
+    """Write up to ``batch_size`` queued sales in one transaction and return how many."""
+    with transaction.atomic():
+        # Concurrent workers skip each other's batches
+        pending = list(PendingSale.objects.select_for_update(skip_locked=True).filter(
+            status='queued').order_by('id')[:batch_size])
+        if not pending:
+            return 0
+
+        results = _try_write(pending)
+        if results is None:
+            results = {}
+            for row in pending:
+                results.update(_try_write([row]) or {row.pk: {
+                    'index': row.pk, 'status': 'error',
+                    'errors': {'non_field_errors': ['The sale could not be written.']},
+                }})
+        now = timezone.now()
+        for row in pending:
+            result = results[row.pk]
+            row.status = 'created' if result['status'] == 'created' else 'failed'
+            row.sale_id = result.get('id')
+            row.errors = result.get('errors')
+            row.processed_at = now
+        PendingSale.objects.bulk_update(pending, ['status', 'sale', 'errors', 'processed_at'])
+        caching.bump_version(PendingSale)
+    return len(pending)
+
+def purge(days):
+    """Delete processed queue entries older than ``days``."""
+    return PendingSale.objects.exclude(status='queued').filter(
+        processed_at__lt=timezone.now() - timedelta(days=days)
+    ).delete()[0]